@@ -1,29 +1,377 @@
-from functools import wraps
+from functools import partial, wraps
+import asyncio
+import json
+import threading
+import time
 import requests
+from collections import OrderedDict
+from concurrent.futures import Future
 from urllib.parse import urljoin, urlparse
 from os.path import join
 from typing import Optional, Dict, Any
 
+try:
+    import aiohttp
+except ImportError:  # aiohttp is only needed for AsyncGeodesignHubClient
+    aiohttp = None
+
+try:
+    import orjson
+except ImportError:  # fall back to the standard library decoder
+    orjson = None
+
+
+def json_loads(content):
+    """Decode JSON with orjson when it is installed, it is several times faster
+    than the standard library on large payloads such as all diagrams"""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def parse_json(response):
+    """Decode the body of a response in a single pass over its raw bytes"""
+    return json_loads(response.content)
+
 # Version: 1.5.2
 
 
+def stored_response(url, content):
+    """A successful requests.Response holding content that was stored earlier"""
+    response = requests.Response()
+    response.status_code = 200
+    response._content = content
+    response.url = url
+    response.encoding = "utf-8"
+    return response
+
+
+class RequestMemo:
+    """In-memory LRU of successful GET responses keyed by URL.
+
+    Identical GETs that are in flight at the same time share one request, the
+    callers that arrive while it is running wait for its response. Any POST
+    through the client clears the memo, as it may change what the GETs
+    return. Responses are shared between callers and must not be modified.
+
+    The memo holds at most max_entries responses and max_bytes of bodies.
+    Bodies larger than max_entry_bytes, such as all diagrams of a project, are
+    read once and are not kept, so they don't stay in memory for the life of
+    the client."""
+
+    def __init__(
+        self,
+        max_entries: int = 128,
+        max_bytes: int = 16 * 1024 * 1024,
+        max_entry_bytes: int = 1024 * 1024,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.bytes = 0
+        self.responses = OrderedDict()
+        self.in_flight = {}
+        self.hits = 0
+        self.coalesced = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _lookup(self, url):
+        """Return (response, in_flight_future, generation), called with the
+        lock held"""
+        if url in self.responses:
+            self.responses.move_to_end(url)
+            self.hits += 1
+            return self.responses[url], None, None
+        if url in self.in_flight:
+            self.coalesced += 1
+            return None, self.in_flight[url], None
+        return None, None, self._generation
+
+    def _store(self, url, future, generation, response):
+        """Called with the lock held once the request for url finished"""
+        if self.in_flight.get(url) is future:
+            del self.in_flight[url]
+        # A response that was requested before the last POST may be stale
+        if response is None or generation != self._generation:
+            return
+        size = len(response.content)
+        if (
+            response.status_code != 200
+            or self.max_entries <= 0
+            or size > min(self.max_entry_bytes, self.max_bytes)
+        ):
+            return
+        if url in self.responses:
+            self.bytes -= len(self.responses.pop(url).content)
+        self.responses[url] = response
+        self.bytes += size
+        while len(self.responses) > self.max_entries or self.bytes > self.max_bytes:
+            _, evicted = self.responses.popitem(last=False)
+            self.bytes -= len(evicted.content)
+
+    def fetch(self, url, send):
+        with self._lock:
+            response, future, generation = self._lookup(url)
+            if response is not None:
+                return response
+            if future is not None:
+                waiting = True
+            else:
+                waiting = False
+                future = self.in_flight[url] = Future()
+        if waiting:
+            return future.result()
+        try:
+            response = send()
+        except BaseException as e:
+            with self._lock:
+                self._store(url, future, generation, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._store(url, future, generation, response)
+        future.set_result(response)
+        return response
+
+    async def fetch_async(self, url, send):
+        """fetch() for coroutines, all callers must run on one event loop"""
+        response, future, generation = self._lookup(url)
+        if response is not None:
+            return response
+        if future is not None:
+            return await asyncio.shield(future)
+        future = self.in_flight[url] = asyncio.get_running_loop().create_future()
+        try:
+            response = await send()
+        except BaseException as e:
+            self._store(url, future, generation, None)
+            future.set_exception(e)
+            # Don't warn about an unretrieved exception when nobody was waiting
+            future.exception()
+            raise
+        self._store(url, future, generation, response)
+        future.set_result(response)
+        return response
+
+    def invalidate(self):
+        with self._lock:
+            self.responses.clear()
+            self.bytes = 0
+            self.in_flight.clear()
+            self._generation += 1
+
+
 class GeodesignHubClient:
-    def __init__(self, token: str, url: Optional[str] = None, project_id: str = ""):
+    def __init__(
+        self,
+        token: str,
+        url: Optional[str] = None,
+        project_id: str = "",
+        pool_maxsize: int = 10,
+        cache=None,
+        timeout: Optional[float] = None,
+        retry_policy=None,
+        rate_limiter=None,
+        memo_size: int = 128,
+        metrics=None,
+        journal=None,
+        session=None,
+    ):
         assert project_id, "Project id is required"
         self.project_id = project_id
         self.token = token
+        # Optional http_cache.ResponseCache used for GET requests
+        self.cache = cache
+        # Responses kept in memory by this client, 0 turns the memo off
+        self.memo = RequestMemo(memo_size) if memo_size else None
+        # Seconds to wait for the server on each request, None waits forever
+        self.timeout = timeout
+        # Optional request_policy.RetryPolicy and request_policy.RateLimiter
+        self.retry_policy = retry_policy
+        self.rate_limiter = rate_limiter
+        # Optional metrics.RequestMetrics recording every request sent
+        self.metrics = metrics
+        # Optional journal.RunJournal of the GET responses of this run
+        self.journal = journal
         self.sec_url = urlparse(url or "https://www.geodesignhub.com/api/v1/")
-        self.session = requests.Session()
-        self.session.headers.update({"Authorization": f"Token {self.token}"})
+        # The token goes on each request rather than the session, so that a
+        # session from create_session() can serve clients with different tokens
+        # and keep its connections open from one project to the next
+        self.headers = {"Authorization": f"Token {self.token}"}
+        self._owns_session = session is None
+        self.session = (
+            session if session is not None else self._new_session(pool_maxsize)
+        )
+
+    def _new_session(self, pool_maxsize):
+        return create_session(pool_maxsize)
 
     def _build_url(self, *parts):
         url = urljoin(self.sec_url.geturl(), join(*parts))
         return url if url.endswith('/') else url + '/'
 
+    def _record_metrics(self, method, full_url, status, start, size=0):
+        if self.metrics is None:
+            return
+        path = urlparse(full_url).path
+        if path.startswith(self.sec_url.path):
+            path = path[len(self.sec_url.path) :]
+        self.metrics.record(method, path, status, time.perf_counter() - start, size)
+
+    def _send(self, method, full_url, *args, **kwargs):
+        """Send a request within the rate limits, retrying it as the retry
+        policy allows"""
+        if self.timeout is not None:
+            kwargs.setdefault("timeout", self.timeout)
+        kwargs["headers"] = {**self.headers, **(kwargs.get("headers") or {})}
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                time.sleep(self.rate_limiter.reserve())
+                self.rate_limiter.acquire()
+            start = time.perf_counter()
+            response = None
+            try:
+                response = self.session.request(method, full_url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                # Give the slot back whatever happened to the request
+                if self.rate_limiter is not None:
+                    self.rate_limiter.release(
+                        throttled=response is not None and response.status_code == 429
+                    )
+            if response is None:
+                self._record_metrics(method, full_url, "error", start)
+                if self.retry_policy is None or not self.retry_policy.should_retry(
+                    method, attempt, exception=error
+                ):
+                    raise error
+                time.sleep(self.retry_policy.delay(attempt))
+                attempt += 1
+                continue
+            self._record_metrics(
+                method,
+                full_url,
+                response.status_code,
+                start,
+                (
+                    int(response.headers.get("Content-Length", 0))
+                    if kwargs.get("stream")
+                    else len(response.content)
+                ),
+            )
+            if self.retry_policy is None or not self.retry_policy.should_retry(
+                method, attempt, status_code=response.status_code
+            ):
+                return response
+            response.close()
+            time.sleep(
+                self.retry_policy.delay(attempt, response.headers.get("Retry-After"))
+            )
+            attempt += 1
+
+    # The layers a request goes through, outermost first: the memo, the
+    # journal, the response cache and _send(), which applies the rate limiter
+    # and the retry policy. The decisions of each layer are made by the
+    # methods below, which AsyncGeodesignHubClient shares, _request(),
+    # _fetch() and _fetch_cached() only chain the layers.
+
+    def _memo_mode(self, method, args, kwargs):
+        """How a request uses the memo: "share" for a plain GET, "invalidate"
+        for requests that may change what GETs return, None to bypass it"""
+        if self.memo is None:
+            return None
+        if method != "GET":
+            return "invalidate"
+        if args or kwargs:
+            return None
+        return "share"
+
+    def _journaled(self, method, kwargs):
+        # Streamed bodies are read by the caller, they can't be journaled
+        return self.journal is not None and method == "GET" and not kwargs.get("stream")
+
+    def _journal_response(self, full_url):
+        """The response journaled by an interrupted run, or None"""
+        content = self.journal.get(full_url)
+        if content is None:
+            return None
+        return self._stored_response(full_url, content)
+
+    def _cached(self, method, kwargs):
+        return self.cache is not None and method == "GET" and not kwargs.get("stream")
+
+    def _cache_lookup(self, entry, kwargs):
+        """The response of a fresh cache entry, or None after adding the
+        headers that revalidate a stale one to kwargs"""
+        if entry is not None and entry.is_fresh():
+            self.cache.record_hit(entry)
+            return self._cached_response(entry)
+        if entry is not None:
+            kwargs["headers"] = {
+                **(kwargs.get("headers") or {}),
+                **entry.revalidation_headers(),
+            }
+        return None
+
+    def _cache_result(self, entry, response):
+        """Returns the response to the caller and whether to store it"""
+        if response.status_code == 304 and entry is not None:
+            self.cache.record_revalidated(entry)
+            return self._cached_response(entry), False
+        self.cache.record_miss()
+        return response, response.status_code == 200
+
+    def _stored_response(self, url, content):
+        return stored_response(url, content)
+
+    def _cached_response(self, entry):
+        return entry.to_response()
+
     @wraps(requests.Session.request)
     def _request(self, method, url, *args, **kwargs):
         full_url = self._build_url(url)
-        return self.session.request(method, full_url, *args, **kwargs)
+        memo_mode = self._memo_mode(method, args, kwargs)
+        if memo_mode == "share":
+            return self.memo.fetch(full_url, partial(self._fetch, method, full_url))
+        if memo_mode == "invalidate":
+            self.memo.invalidate()
+            try:
+                return self._fetch(method, full_url, *args, **kwargs)
+            finally:
+                # GETs sent while the POST was running may have missed it
+                self.memo.invalidate()
+        return self._fetch(method, full_url, *args, **kwargs)
+
+    def _fetch(self, method, full_url, *args, **kwargs):
+        """Answer the request from the journal of an interrupted run, or fetch it
+        and journal the response"""
+        journaled = self._journaled(method, kwargs)
+        if journaled:
+            response = self._journal_response(full_url)
+            if response is not None:
+                return response
+        response = self._fetch_cached(method, full_url, *args, **kwargs)
+        if journaled and response.status_code == 200:
+            self.journal.record_response(full_url, response.content)
+        return response
+
+    def _fetch_cached(self, method, full_url, *args, **kwargs):
+        """Send the request, or answer it from the response cache"""
+        if not self._cached(method, kwargs):
+            return self._send(method, full_url, *args, **kwargs)
+        entry = self.cache.get(full_url, self.token)
+        response = self._cache_lookup(entry, kwargs)
+        if response is not None:
+            return response
+        response, store = self._cache_result(
+            entry, self._send(method, full_url, *args, **kwargs)
+        )
+        if store:
+            self.cache.put(full_url, self.token, response.headers, response.content)
+        return response
 
     def get_project_details(self):
         return self._request("GET", join("projects", self.project_id))
@@ -126,18 +474,7 @@ class GeodesignHubClient:
         )
 
     def get_synthesis_diagrams(self, teamid: int, synthesisid: str):
-        assert isinstance(teamid, int), f"Team id is not an integer: {teamid}"
-        return self._request(
-            "GET",
-            join(
-                "projects",
-                self.project_id,
-                "cteams",
-                str(teamid),
-                synthesisid,
-                "diagrams",
-            ),
-        )
+        return self.get_single_synthesis_diagrams(teamid, synthesisid)
 
     def get_design_team_members(self, teamid: int):
         assert isinstance(teamid, int), f"Team id is not an integer: {teamid}"
@@ -239,7 +576,15 @@ class GeodesignHubClient:
             "GET", join("projects", self.project_id, "diagrams", str(diagid))
         )
 
-    def get_all_diagrams(self):
+    def get_all_diagrams(self, stream: bool = False):
+        """With stream the body is not read, parse it from response.raw and
+        close the response when done"""
+        if stream:
+            return self._request(
+                "GET",
+                join("projects", self.project_id, "diagrams", "all"),
+                stream=True,
+            )
         return self._request(
             "GET", join("projects", self.project_id, "diagrams", "all")
         )
@@ -317,3 +662,212 @@ class GeodesignHubClient:
             "POST", join("projects", "create-igc-project"), json=project_create_payload
         )
 
+
+def create_session(pool_maxsize: int = 10):
+    """Create a requests session that can be shared by several
+    GeodesignHubClient instances. The connection pool is sized so concurrent
+    callers can each keep a connection alive instead of reconnecting."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_maxsize)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def create_async_session(limit_per_host: int = 10, limit: int = 100):
+    """Create an aiohttp session whose connection pool can be shared by several
+    AsyncGeodesignHubClient instances. limit_per_host caps the number of
+    requests in flight to any one host, limit caps the total."""
+    if aiohttp is None:
+        raise ImportError("aiohttp is required for the async Geodesignhub client")
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host)
+    )
+
+
+class AsyncResponse:
+    """The parts of requests.Response used by callers, with the body already read"""
+
+    def __init__(self, status_code: int, content: bytes, url: str, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.url = url
+        self.headers = headers or {}
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json_loads(self.content)
+
+
+class AsyncGeodesignHubClient(GeodesignHubClient):
+    """asyncio variant of GeodesignHubClient built on aiohttp. It has the same
+    endpoint methods, each of which returns a coroutine resolving to an
+    AsyncResponse, e.g. ``await client.get_all_systems()``.
+
+    Pass the same session (see create_async_session) to clients for different
+    projects to share one connection pool and its per-host limit. A client
+    that creates its own session closes it in close()."""
+
+    def __init__(
+        self,
+        token: str,
+        url: Optional[str] = None,
+        project_id: str = "",
+        session=None,
+        limit_per_host: int = 10,
+        cache=None,
+        timeout: Optional[float] = None,
+        retry_policy=None,
+        rate_limiter=None,
+        memo_size: int = 128,
+        metrics=None,
+        journal=None,
+    ):
+        if aiohttp is None:
+            raise ImportError("aiohttp is required for AsyncGeodesignHubClient")
+        self.limit_per_host = limit_per_host
+        super().__init__(
+            token,
+            url,
+            project_id,
+            cache=cache,
+            timeout=timeout,
+            retry_policy=retry_policy,
+            rate_limiter=rate_limiter,
+            memo_size=memo_size,
+            metrics=metrics,
+            journal=journal,
+            session=session,
+        )
+
+    def _new_session(self, pool_maxsize):
+        # Sessions have to be created inside the running event loop, _request()
+        # creates it
+        return None
+
+    def _stored_response(self, url, content):
+        return AsyncResponse(200, content, url)
+
+    def _cached_response(self, entry):
+        return AsyncResponse(200, entry.content, entry.metadata["url"], entry.headers)
+
+    async def _request(self, method, url, *args, **kwargs):
+        if self.session is None:
+            self.session = create_async_session(self.limit_per_host)
+        full_url = self._build_url(url)
+        memo_mode = self._memo_mode(method, args, kwargs)
+        if memo_mode == "share":
+            return await self.memo.fetch_async(
+                full_url, partial(self._fetch, method, full_url)
+            )
+        if memo_mode == "invalidate":
+            self.memo.invalidate()
+            try:
+                return await self._fetch(method, full_url, *args, **kwargs)
+            finally:
+                self.memo.invalidate()
+        return await self._fetch(method, full_url, *args, **kwargs)
+
+    async def _fetch(self, method, full_url, *args, **kwargs):
+        journaled = self._journaled(method, kwargs)
+        if journaled:
+            response = self._journal_response(full_url)
+            if response is not None:
+                return response
+        response = await self._fetch_cached(method, full_url, *args, **kwargs)
+        if journaled and response.status_code == 200:
+            await asyncio.to_thread(
+                self.journal.record_response, full_url, response.content
+            )
+        return response
+
+    async def _fetch_cached(self, method, full_url, *args, **kwargs):
+        if not self._cached(method, kwargs):
+            return await self._send(method, full_url, *args, **kwargs)
+        # The cache does blocking file I/O, keep it off the event loop
+        entry = await asyncio.to_thread(self.cache.get, full_url, self.token)
+        response = self._cache_lookup(entry, kwargs)
+        if response is not None:
+            return response
+        response, store = self._cache_result(
+            entry, await self._send(method, full_url, *args, **kwargs)
+        )
+        if store:
+            await asyncio.to_thread(
+                self.cache.put,
+                full_url,
+                self.token,
+                response.headers,
+                response.content,
+            )
+        return response
+
+    async def _send(self, method, full_url, *args, files=None, **kwargs):
+        if self.timeout is not None:
+            kwargs.setdefault("timeout", aiohttp.ClientTimeout(total=self.timeout))
+        kwargs["headers"] = {**self.headers, **(kwargs.get("headers") or {})}
+        attempt = 0
+        while True:
+            if files:
+                # A form can only be sent once, build it again for each attempt
+                form = aiohttp.FormData()
+                for name, value in files.items():
+                    form.add_field(name, value, filename=name)
+                kwargs["data"] = form
+            if self.rate_limiter is not None:
+                await asyncio.sleep(self.rate_limiter.reserve())
+                await self.rate_limiter.acquire_async()
+            start = time.perf_counter()
+            async_response = None
+            try:
+                async with self.session.request(
+                    method, full_url, *args, **kwargs
+                ) as response:
+                    content = await response.read()
+                    async_response = AsyncResponse(
+                        response.status, content, str(response.url), response.headers
+                    )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            finally:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.release(
+                        throttled=async_response is not None
+                        and async_response.status_code == 429
+                    )
+            if async_response is None:
+                self._record_metrics(method, full_url, "error", start)
+                if self.retry_policy is None or not self.retry_policy.should_retry(
+                    method, attempt, exception=error
+                ):
+                    raise error
+                await asyncio.sleep(self.retry_policy.delay(attempt))
+                attempt += 1
+                continue
+            self._record_metrics(
+                method, full_url, async_response.status_code, start, len(content)
+            )
+            if self.retry_policy is None or not self.retry_policy.should_retry(
+                method, attempt, status_code=async_response.status_code
+            ):
+                return async_response
+            await asyncio.sleep(
+                self.retry_policy.delay(
+                    attempt, async_response.headers.get("Retry-After")
+                )
+            )
+            attempt += 1
+
+    async def close(self):
+        if self._owns_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
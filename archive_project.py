@@ -6,8 +6,130 @@ import logging
 import logging.handlers
 from json.decoder import JSONDecodeError
 from pathlib import Path
-from io import StringIO
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
+import tempfile
+import time
 import uuid
+from stages import Cancelled, Stage, run_stages
+from http_cache import ResponseCache
+from request_policy import RateLimiter, RetryPolicy
+import metrics
+from journal import RunJournal, journal_path
+from archive_writers import ARCHIVE_WRITERS, create_archive_writer
+import table_formats
+import spatial_export
+import zip_compression
+import incremental
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Global_IDs are name based UUIDs in this namespace
+GLOBAL_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "https://www.geodesignhub.com/")
+
+REQUIRED_CONFIG_KEYS = set(["service_url", "project_ids", "api_token"])
+# Optional configuration parameters and the values used when they are omitted
+OPTIONAL_CONFIG_DEFAULTS = {
+    "max_workers": 1,
+    "project_workers": 1,
+    "async_mode": False,
+    "limit_per_host": 10,
+    "cache_directory": None,
+    "cache_ttl": 0,
+    "cache_max_mb": 1024,
+    "incremental_diagrams": False,
+    "incremental_output": "merged",
+    "incremental_full_refresh_days": 1,
+    "state_directory": "state",
+    "archive_writer": "stream",
+    "excel_workbook": True,
+    "output_format": "csv",
+    "parquet_compression": "zstd",
+    "spatial_format": None,
+    "request_timeout": 60,
+    "max_retries": 5,
+    "requests_per_second": None,
+    "max_concurrent_requests": None,
+    "resume_journal": True,
+    "journal_max_age_hours": 24,
+    "negotiation_log_layout": "per_session",
+    "stream_diagrams": False,
+    "stream_chunk_size": 1000,
+    "archive_compression": "deflate",
+    "archive_compression_level": None,
+    "compression_workers": None,
+    "snapshot_directory": "snapshots",
+    "job_database": "state/jobs.sqlite3",
+    "worker_processes": 2,
+    "job_lease_seconds": 900,
+    "max_jobs_per_host": 4,
+    "job_max_attempts": 3,
+    "job_retry_delay": 60,
+}
+
+
+def _is_positive_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def _is_non_negative_number(value):
+    return (
+        isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0
+    )
+
+
+# "per_session" writes a negotiation_log_<session_id> table for every session,
+# "long" writes the moves of all sessions to one negotiation_moves table
+NEGOTIATION_LOG_LAYOUTS = ["per_session", "long", "both"]
+NEGOTIATION_MOVE_COLUMNS = ["diagram", "move", "timestamp"]
+
+OPTIONAL_CONFIG_VALIDATORS = {
+    "max_workers": _is_positive_int,
+    "project_workers": _is_positive_int,
+    "async_mode": lambda value: isinstance(value, bool),
+    "limit_per_host": _is_positive_int,
+    "cache_directory": lambda value: value is None or isinstance(value, str),
+    "cache_ttl": _is_non_negative_number,
+    "cache_max_mb": _is_positive_int,
+    "incremental_diagrams": lambda value: isinstance(value, bool),
+    "incremental_output": lambda value: value in ["merged", "delta"],
+    "incremental_full_refresh_days": _is_non_negative_number,
+    "state_directory": lambda value: isinstance(value, str),
+    "archive_writer": lambda value: value in ARCHIVE_WRITERS,
+    "excel_workbook": lambda value: isinstance(value, bool),
+    "output_format": lambda value: value in table_formats.OUTPUT_FORMATS,
+    "parquet_compression": lambda value: value in table_formats.PARQUET_COMPRESSIONS,
+    "spatial_format": lambda value: value is None
+    or value in spatial_export.SPATIAL_FORMATS,
+    # requests rejects a timeout of 0
+    "request_timeout": lambda value: value is None
+    or (_is_non_negative_number(value) and value > 0),
+    "max_retries": lambda value: value == 0 or _is_positive_int(value),
+    "requests_per_second": lambda value: value is None
+    or (_is_non_negative_number(value) and value > 0),
+    "max_concurrent_requests": lambda value: value is None or _is_positive_int(value),
+    "resume_journal": lambda value: isinstance(value, bool),
+    "journal_max_age_hours": _is_non_negative_number,
+    "negotiation_log_layout": lambda value: value in NEGOTIATION_LOG_LAYOUTS,
+    "stream_diagrams": lambda value: isinstance(value, bool),
+    "stream_chunk_size": _is_positive_int,
+    "archive_compression": lambda value: value in zip_compression.ARCHIVE_COMPRESSIONS,
+    # Checked against the levels of archive_compression as well
+    "archive_compression_level": lambda value: value is None
+    or value == 0
+    or _is_positive_int(value),
+    "compression_workers": lambda value: value is None or _is_positive_int(value),
+    "snapshot_directory": lambda value: isinstance(value, str),
+    "job_database": lambda value: isinstance(value, str),
+    "worker_processes": _is_positive_int,
+    "job_lease_seconds": _is_positive_int,
+    "max_jobs_per_host": _is_positive_int,
+    "job_max_attempts": _is_positive_int,
+    "job_retry_delay": _is_non_negative_number,
+}
 
 
 class ScriptLogger:
@@ -53,26 +175,43 @@ def load_and_validate_config(logger):
 
     logger.info("Validating configuration file parameters")
     try:
-        assert c.keys() == set(["service_url", "project_ids", "api_token"])
+        assert REQUIRED_CONFIG_KEYS <= c.keys()
+        assert c.keys() <= REQUIRED_CONFIG_KEYS | OPTIONAL_CONFIG_DEFAULTS.keys()
+        for key, value in c.items():
+            if key in OPTIONAL_CONFIG_VALIDATORS:
+                assert OPTIONAL_CONFIG_VALIDATORS[key](value), f"Invalid {key}"
+        settings = {**OPTIONAL_CONFIG_DEFAULTS, **c}
+        # The levels depend on the codec, checked here rather than when the
+        # first archive is closed
+        try:
+            zip_compression.check_compression(
+                settings["archive_compression"], settings["archive_compression_level"]
+            )
+        except (ValueError, ImportError) as e:
+            raise AssertionError(f"Invalid archive_compression_level: {e}")
         logger.info("Configuration file parameters validated successfully")
     except AssertionError as ae:
-        logger.error("Error in config file parameters")
+        logger.error("Error in config file parameters %s" % ae)
         sys.exit(1)
 
-    return c
+    return {**OPTIONAL_CONFIG_DEFAULTS, **c}
+
 
+def save_project_details(archive, logger, all_project_details):
+    all_projects_df = pd.DataFrame([all_project_details])
 
-def fetch_and_save_project_details(my_api_helper, project_directory, logger):
+    logger.info("Writing Project data file to disk..")
+    archive.write_table("project", all_projects_df)
+    all_projects_df.name = "Project Details"
+    logger.info("Project data file written")
+
+
+def fetch_and_save_project_details(my_api_helper, archive, logger):
     all_projects_response = my_api_helper.get_project_details()
     if all_projects_response.status_code == 200:
-        all_project_details = all_projects_response.json()
+        all_project_details = GeodesignHub.parse_json(all_projects_response)
         logger.info("Project data downloaded")
-        all_projects_df = pd.DataFrame([all_project_details])
-
-        logger.info("Writing Project data file to disk..")
-        all_projects_df.to_csv(Path.joinpath(project_directory, "project.csv"))
-        all_projects_df.name = "Project Details"
-        logger.info("Project data file written")
+        save_project_details(archive, logger, all_project_details)
     else:
         logger.error(
             "Error in getting project data from Geodesignhub: %s"
@@ -80,28 +219,53 @@ def fetch_and_save_project_details(my_api_helper, project_directory, logger):
         )
 
 
-def fetch_and_save_systems(my_api_helper, project_directory, logger):
+def global_ids(project_id, entity_type, df):
+    """Global_IDs of the rows of df, derived from the project, the entity type
+    and the id the server gave the entity, so they are the same in every
+    archive of the project"""
+    if df.empty:
+        return []
+    return [
+        str(uuid.uuid5(GLOBAL_ID_NAMESPACE, f"{project_id}/{entity_type}/{server_id}"))
+        for server_id in df["id"]
+    ]
+
+
+def save_systems(archive, logger, all_system_details):
+    all_systems_df = pd.DataFrame.from_records(all_system_details)
+    all_systems_df["Global_ID"] = global_ids(
+        archive.project_id, "system", all_systems_df
+    )
+    all_systems_df = all_systems_df.rename(columns={"name": "system_name"})
+    logger.info("Writing Systems file to disk..")
+    archive.write_table("systems", all_systems_df)
+    logger.info("Systems file written")
+
+
+def fetch_and_save_systems(my_api_helper, archive, logger, max_workers=1):
     all_systems_response = my_api_helper.get_all_systems()
     if all_systems_response.status_code == 200:
-        all_systems = all_systems_response.json()
+        all_systems = GeodesignHub.parse_json(all_systems_response)
         all_system_details = []
-        for system in all_systems:
-            system_detail_response = my_api_helper.get_single_system(system["id"])
-            if system_detail_response.status_code != 200:
-                logger.error(
-                    "Error in getting System Details %s" % system_detail_response.text
+        # The detail requests are issued concurrently, map() yields the responses
+        # in the original system order so the output is the same as a serial run
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            system_detail_responses = executor.map(
+                my_api_helper.get_single_system,
+                [system["id"] for system in all_systems],
+            )
+            for system_detail_response in system_detail_responses:
+                if system_detail_response.status_code != 200:
+                    logger.error(
+                        "Error in getting System Details %s"
+                        % system_detail_response.text
+                    )
+                    continue
+                all_system_details.append(
+                    GeodesignHub.parse_json(system_detail_response)
                 )
-                continue
-            all_system_details.append(system_detail_response.json())
 
-        all_systems_df = pd.read_json(StringIO(json.dumps(all_system_details)))
-        all_systems_df["Global_ID"] = [
-            str(uuid.uuid4()) for _ in range(len(all_systems_df))
-        ]
-        all_systems_df = all_systems_df.rename(columns={"name": "system_name"})
-        logger.info("Writing Systems file to disk..")
-        all_systems_df.to_csv(Path.joinpath(project_directory, "systems.csv"))
-        logger.info("Systems file written")
+        save_systems(archive, logger, all_system_details)
     else:
         logger.error(
             "Error in getting systems data from Geodesignhub: %s"
@@ -109,143 +273,405 @@ def fetch_and_save_systems(my_api_helper, project_directory, logger):
         )
 
 
-def fetch_and_save_diagrams(my_api_helper, project_directory, logger):
+def diagrams_frame(project_id, all_diagrams):
+    all_diagrams_df = pd.DataFrame.from_records(all_diagrams)
+    all_diagrams_df["Global_ID"] = global_ids(project_id, "diagram", all_diagrams_df)
+    return all_diagrams_df
+
+
+def save_diagrams(archive, logger, all_diagrams):
+    all_diagrams_df = diagrams_frame(archive.project_id, all_diagrams)
+    all_diagrams_df.name = "Diagrams"
+    logger.info("Writing diagrams to disk..")
+    archive.write_table("diagrams", all_diagrams_df)
+    logger.info("Diagrams file written")
+
+
+def fetch_and_save_diagrams(my_api_helper, archive, logger):
     all_diagrams_response = my_api_helper.get_all_diagrams()
     if all_diagrams_response.status_code == 200:
-        all_diagrams = all_diagrams_response.json()
+        all_diagrams = GeodesignHub.parse_json(all_diagrams_response)
         logger.info("Diagrams data downloaded")
-        all_diagrams_df = pd.read_json(StringIO(json.dumps(all_diagrams)))
-        all_diagrams_df["Global_ID"] = [
-            str(uuid.uuid4()) for _ in range(len(all_diagrams_df))
-        ]
-        all_diagrams_df.name = "Diagrams"
-        logger.info("Writing diagrams to disk..")
-        all_diagrams_df.to_csv(Path.joinpath(project_directory, "diagrams.csv"))
-        logger.info("Diagrams file written")
+        save_diagrams(archive, logger, all_diagrams)
+        return all_diagrams
     else:
         logger.error(
             "Error in getting diagrams data from Geodesignhub: %s"
             % all_diagrams_response.text
         )
+        return None
 
 
-def fetch_and_save_design_teams(my_api_helper, project_directory, logger):
-    all_design_team_details = []
-    all_design_team_response = my_api_helper.get_all_design_teams()
-    if all_design_team_response.status_code == 200:
-        all_design_teams = all_design_team_response.json()
-        all_design_teams_df = pd.read_json(StringIO(json.dumps(all_design_teams)))
-        all_design_teams_df.to_csv(Path.joinpath(project_directory, "design_teams.csv"))
-        for design_team in all_design_teams:
-            design_team_detail_response = my_api_helper.get_all_details_for_design_team(
-                design_team["id"]
-            )
-            if design_team_detail_response.status_code != 200:
+def diagram_fields(diagrams_file):
+    """The fields of the diagrams in a JSON array of diagrams and the
+    properties of their features, each in the order they first appear. Only
+    the keys are looked at, the diagrams are not built."""
+    diagram_keys = {}
+    property_keys = {}
+    for prefix, event, value in ijson.parse(diagrams_file):
+        if event != "map_key":
+            continue
+        if prefix == "item":
+            diagram_keys[value] = None
+        elif prefix == "item.geojson.features.item.properties":
+            property_keys[value] = None
+    return list(diagram_keys), list(property_keys)
+
+
+def fetch_and_save_diagrams_streaming(
+    my_api_helper, archive, logger, chunk_size=1000, spatial_format=None
+):
+    """Parse the diagrams one at a time and write them, and their geometries,
+    chunk_size diagrams at a time. Memory use does not grow with the number of
+    diagrams, so nothing is returned.
+
+    The download is spooled to a temporary file and read twice, first for the
+    fields of all diagrams, which become the columns, then for the diagrams."""
+    all_diagrams_response = my_api_helper.get_all_diagrams(stream=True)
+    # The layer is written to a file first, OGR drivers need a real path
+    with tempfile.TemporaryDirectory(dir=archive.output_directory) as temp_directory:
+        diagrams_path = Path(temp_directory, "diagrams.json")
+        with all_diagrams_response:
+            if all_diagrams_response.status_code != 200:
                 logger.error(
-                    "Error in getting Design Team Details %s"
-                    % design_team_detail_response.text
+                    "Error in getting diagrams data from Geodesignhub: %s"
+                    % all_diagrams_response.text
                 )
-                continue
-            all_design_team_details.append(design_team_detail_response.json())
-        flattened_details = []
-        for team in all_design_team_details:
-            for synth in team.get("synthesis", []):
-                flattened_details.append(synth)
-        all_design_team_details = flattened_details
-        logger.info("Design Team data downloaded")
-        all_designs_in_design_teams_df = pd.read_json(
-            StringIO(json.dumps(all_design_team_details))
-        )
-        all_designs_in_design_teams_df.name = "Design Teams"
-        logger.info("Writing Design Team file to disk..")
-        all_designs_in_design_teams_df.to_csv(
-            Path.joinpath(project_directory, "designs_design_teams.csv")
-        )
-        logger.info("Design Team and Design team details file written")
-    else:
-        logger.error(
-            "Error in getting Design Team data from Geodesignhub: %s"
-            % all_design_team_response.text
+                return None
+            # Let urllib3 undo any gzip content encoding
+            all_diagrams_response.raw.decode_content = True
+            with open(diagrams_path, "wb") as diagrams_file:
+                shutil.copyfileobj(all_diagrams_response.raw, diagrams_file)
+        with open(diagrams_path, "rb") as diagrams_file:
+            diagram_keys, property_keys = diagram_fields(diagrams_file)
+        columns = diagram_keys + [
+            key for key in ["Global_ID"] if key not in diagram_keys
+        ]
+        layer_writer = None
+        if spatial_format:
+            layer_writer = spatial_export.LayerWriter(
+                Path(
+                    temp_directory, spatial_export.file_name("diagrams", spatial_format)
+                ),
+                spatial_format,
+                columns=spatial_export.layer_columns(diagram_keys, property_keys),
+            )
+        with open(diagrams_path, "rb") as diagrams_file, archive.open_table(
+            "diagrams", columns=columns
+        ) as diagrams_table:
+            chunk = []
+            for diagram in ijson.items(diagrams_file, "item", use_float=True):
+                chunk.append(diagram)
+                if len(chunk) < chunk_size:
+                    continue
+                diagrams_table.write(diagrams_frame(archive.project_id, chunk))
+                if layer_writer is not None:
+                    layer_writer.write(chunk)
+                chunk = []
+            if chunk:
+                diagrams_table.write(diagrams_frame(archive.project_id, chunk))
+                if layer_writer is not None:
+                    layer_writer.write(chunk)
+        if layer_writer is not None:
+            layer_writer.close()
+            if layer_writer.written:
+                archive.write_file(layer_writer.path.name, layer_writer.path)
+    table_file = diagrams_table.table_file
+    logger.info("Diagrams file written, %s diagrams" % table_file.rows)
+    dropped_columns = set(table_file.dropped_columns)
+    if layer_writer is not None:
+        dropped_columns.update(layer_writer.dropped_columns)
+    if dropped_columns:
+        # Not expected, the columns come from all diagrams
+        logger.warning(
+            "Diagram fields left out: %s" % ", ".join(sorted(map(str, dropped_columns)))
+        )
+    if layer_writer is not None:
+        logger.info("Diagram geometries written, %s features" % layer_writer.features)
+    return None
+
+
+def export_diagram_geometries(archive, logger, spatial_format, all_diagrams):
+    """Write the features of all diagrams as one spatially indexed layer"""
+    if all_diagrams is None:
+        logger.error("Diagram geometries not exported, diagrams were not downloaded")
+        return
+    logger.info("Writing diagram geometries as %s.." % spatial_format)
+    diagrams_gdf = spatial_export.diagrams_to_geodataframe(all_diagrams)
+    # The layer is written to a file first, OGR drivers need a real path
+    with tempfile.TemporaryDirectory(dir=archive.output_directory) as temp_directory:
+        layer_path = Path(
+            temp_directory, spatial_export.file_name("diagrams", spatial_format)
         )
-    return all_design_team_details
+        spatial_export.write_layer(diagrams_gdf, layer_path, spatial_format)
+        archive.write_file(layer_path.name, layer_path)
+    logger.info("Diagram geometries written, %s features" % len(diagrams_gdf))
 
 
-def fetch_and_save_syntheses(
+def fetch_and_save_diagrams_incrementally(
     my_api_helper,
-    project_directory,
+    archive,
     logger,
-    all_design_team_details,
+    previous_state,
+    output_mode="merged",
+    max_workers=1,
 ):
-    all_design_syntheses_and_diagrams = []
-    for current_team_synthesis in all_design_team_details:
-
-        current_team_id = int(current_team_synthesis["cteamid"])
-        synthesis_id = current_team_synthesis["id"]
-        synthesis_name = current_team_synthesis["description"]
-        synthesis_digrams_response = my_api_helper.get_single_synthesis_diagrams(
-            teamid=current_team_id, synthesisid=synthesis_id
-        )
-        if synthesis_digrams_response.status_code != 200:
-            logger.error(
-                "Error in getting Diagram Details %s" % synthesis_digrams_response.text
+    """Archive diagrams using the change IDs saved by the previous run, only the
+    diagrams whose change ID moved are downloaded again. With output_mode
+    "merged" diagrams.csv holds every diagram, with "delta" it holds only the
+    changed diagrams and diagrams_removed.csv lists the deleted ones. Returns
+    the state to save for the next run, or None if nothing could be fetched."""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if previous_state is None:
+            all_diagrams_response = my_api_helper.get_all_diagrams()
+            if all_diagrams_response.status_code != 200:
+                logger.error(
+                    "Error in getting diagrams data from Geodesignhub: %s"
+                    % all_diagrams_response.text
+                )
+                return None
+            all_diagrams = GeodesignHub.parse_json(all_diagrams_response)
+            logger.info("Diagrams data downloaded")
+            diagrams = {str(diagram["id"]): diagram for diagram in all_diagrams}
+            change_ids = incremental.initial_change_ids(
+                dict(
+                    zip(
+                        diagrams,
+                        executor.map(
+                            my_api_helper.get_diagram_changeid,
+                            [int(diagram_id) for diagram_id in diagrams],
+                        ),
+                    )
+                ),
+                logger,
+            )
+            save_diagrams(archive, logger, all_diagrams)
+            return incremental.new_state(diagrams, change_ids)
+
+        diagram_ids = list(previous_state["diagrams"])
+        change_id_responses = dict(
+            zip(
+                diagram_ids,
+                executor.map(
+                    my_api_helper.get_diagram_changeid,
+                    [int(diagram_id) for diagram_id in diagram_ids],
+                ),
             )
-            continue
-        synthesis_and_diagrams = synthesis_digrams_response.json()
-        synthesis_and_diagrams["diagrams"] = ",".join(
-            [str(diagram) for diagram in synthesis_and_diagrams["diagrams"]]
         )
-        synthesis_and_diagrams["description"] = synthesis_name
-        all_design_syntheses_and_diagrams.append(synthesis_and_diagrams)
+        change_ids, changed, removed = incremental.changed_diagram_ids(
+            previous_state, change_id_responses, logger
+        )
+        changed_diagrams = incremental.refetched_diagrams(
+            dict(
+                zip(
+                    changed,
+                    executor.map(
+                        my_api_helper.get_single_diagram,
+                        [int(diagram_id) for diagram_id in changed],
+                    ),
+                )
+            ),
+            logger,
+        )
 
-    design_synthesis_details_df = pd.read_json(
-        StringIO(json.dumps(all_design_syntheses_and_diagrams))
+    logger.info(
+        "Diagrams data downloaded, %s changed and %s removed since the last archive"
+        % (len(changed_diagrams), len(removed))
+    )
+    diagrams = incremental.merge_diagrams(
+        previous_state, changed_diagrams, removed, change_ids
+    )
+    if output_mode == "delta":
+        save_diagrams(archive, logger, list(changed_diagrams.values()))
+        save_removed_diagrams(archive, logger, removed)
+    else:
+        save_diagrams(archive, logger, list(diagrams.values()))
+    return incremental.new_state(diagrams, change_ids, previous_state)
+
+
+def save_removed_diagrams(archive, logger, removed):
+    removed_diagrams_df = pd.DataFrame({"id": [int(diagram) for diagram in removed]})
+    logger.info("Writing removed diagrams to disk..")
+    archive.write_table("diagrams_removed", removed_diagrams_df)
+
+
+def save_design_teams(archive, logger, all_design_teams):
+    all_design_teams_df = pd.DataFrame.from_records(all_design_teams)
+    archive.write_table("design_teams", all_design_teams_df)
+
+
+def save_designs_in_design_teams(archive, logger, all_design_team_details):
+    flattened_details = []
+    for team in all_design_team_details:
+        for synth in team.get("synthesis", []):
+            flattened_details.append(synth)
+    logger.info("Design Team data downloaded")
+    all_designs_in_design_teams_df = pd.DataFrame.from_records(flattened_details)
+    all_designs_in_design_teams_df.name = "Design Teams"
+    logger.info("Writing Design Team file to disk..")
+    archive.write_table("designs_design_teams", all_designs_in_design_teams_df)
+    logger.info("Design Team and Design team details file written")
+    return flattened_details
+
+
+def fetch_synthesis_diagrams(my_api_helper, logger, current_team_synthesis):
+    current_team_id = int(current_team_synthesis["cteamid"])
+    synthesis_id = current_team_synthesis["id"]
+    synthesis_name = current_team_synthesis["description"]
+    synthesis_digrams_response = my_api_helper.get_single_synthesis_diagrams(
+        teamid=current_team_id, synthesisid=synthesis_id
+    )
+    if synthesis_digrams_response.status_code != 200:
+        logger.error(
+            "Error in getting Diagram Details %s" % synthesis_digrams_response.text
+        )
+        return None
+    synthesis_and_diagrams = GeodesignHub.parse_json(synthesis_digrams_response)
+    synthesis_and_diagrams["diagrams"] = ",".join(
+        [str(diagram) for diagram in synthesis_and_diagrams["diagrams"]]
+    )
+    synthesis_and_diagrams["description"] = synthesis_name
+    # The Global_ID of the synthesis is derived from its id
+    synthesis_and_diagrams.setdefault("id", synthesis_id)
+    return synthesis_and_diagrams
+
+
+def save_syntheses(archive, logger, all_design_syntheses_and_diagrams):
+    design_synthesis_details_df = pd.DataFrame.from_records(
+        all_design_syntheses_and_diagrams
     )
     logger.info("Writing Design Synthesis data file to disk..")
-    design_synthesis_details_df["Global_ID"] = [
-        str(uuid.uuid4()) for _ in range(len(design_synthesis_details_df))
-    ]
+    design_synthesis_details_df["Global_ID"] = global_ids(
+        archive.project_id, "synthesis", design_synthesis_details_df
+    )
     design_synthesis_details_df.name = "Design Syntheses"
 
-    design_synthesis_details_df.to_csv(
-        Path.joinpath(project_directory, "design_syntheses.csv")
-    )
+    archive.write_table("design_syntheses", design_synthesis_details_df)
     logger.info("Design Synthesis file written")
 
 
-def fetch_and_save_negotiation_logs(my_api_helper, project_directory, logger):
-    negotiation_logs_response = my_api_helper.get_project_negotiation_logs()
-    if negotiation_logs_response.status_code == 200:
-        all_negotiation_logs = negotiation_logs_response.json()
-        logger.info("Negotiation Logs data downloaded")
-        negotiation_logs_df = pd.read_json(
-            StringIO(json.dumps(all_negotiation_logs["all_negotiations"]))
-        )
-        negotiation_logs_df.name = "Negotiation Logs"
-        # Check if dataframe is empty
-        if negotiation_logs_df.empty:
-            logger.info("No Negotiation Logs found for this project.")
-            return
-        for index, log in negotiation_logs_df.iterrows():
-            log_file_name = f"negotiation_log_{log['session_id']}.csv"
-            moves = log.get("moves", [])
-            moves_list = []
-            for move in moves:
-                moves_list.append(
-                    {
-                        "diagram": move["diagram"],
-                        "move": move["move"],
-                        "timestamp": move["timestamp"],
-                    }
+def fetch_and_save_design_teams_and_syntheses(
+    my_api_helper, archive, logger, max_workers=1
+):
+    """Fetch the design teams, their details and the diagrams of their
+    syntheses. The synthesis diagrams of a team are queued as soon as that
+    team's details arrive, so the two fan-outs overlap. Rows are written in
+    the order of the teams and of their syntheses."""
+    all_design_team_response = my_api_helper.get_all_design_teams()
+    if all_design_team_response.status_code != 200:
+        logger.error(
+            "Error in getting Design Team data from Geodesignhub: %s"
+            % all_design_team_response.text
+        )
+        save_syntheses(archive, logger, [])
+        return
+    all_design_teams = GeodesignHub.parse_json(all_design_team_response)
+    save_design_teams(archive, logger, all_design_teams)
+
+    all_design_team_details = [None] * len(all_design_teams)
+    synthesis_futures = [[] for _ in all_design_teams]
+    with ThreadPoolExecutor(
+        max_workers=max_workers
+    ) as team_executor, ThreadPoolExecutor(
+        max_workers=max_workers
+    ) as synthesis_executor:
+        team_futures = {
+            team_executor.submit(
+                my_api_helper.get_all_details_for_design_team, design_team["id"]
+            ): team_index
+            for team_index, design_team in enumerate(all_design_teams)
+        }
+        for team_future in as_completed(team_futures):
+            team_index = team_futures[team_future]
+            design_team_detail_response = team_future.result()
+            if design_team_detail_response.status_code != 200:
+                logger.error(
+                    "Error in getting Design Team Details %s"
+                    % design_team_detail_response.text
+                )
+                continue
+            design_team_detail = GeodesignHub.parse_json(design_team_detail_response)
+            all_design_team_details[team_index] = design_team_detail
+            for current_team_synthesis in design_team_detail.get("synthesis", []):
+                synthesis_futures[team_index].append(
+                    synthesis_executor.submit(
+                        fetch_synthesis_diagrams,
+                        my_api_helper,
+                        logger,
+                        current_team_synthesis,
+                    )
                 )
-            log_df = pd.DataFrame(moves_list)
-            log_df.to_csv(Path.joinpath(project_directory, log_file_name), index=False)
 
-        logger.info("Writing Negotiation Logs file to disk..")
-        negotiation_logs_df = negotiation_logs_df.drop(columns=["moves"])
-        negotiation_logs_df.to_csv(
-            Path.joinpath(project_directory, "negotiation_logs.csv")
+        save_designs_in_design_teams(
+            archive,
+            logger,
+            [detail for detail in all_design_team_details if detail is not None],
         )
-        logger.info("Negotiation Logs file written")
+        all_design_syntheses_and_diagrams = []
+        for team_synthesis_futures in synthesis_futures:
+            for synthesis_future in team_synthesis_futures:
+                synthesis_and_diagrams = synthesis_future.result()
+                if synthesis_and_diagrams is not None:
+                    all_design_syntheses_and_diagrams.append(synthesis_and_diagrams)
+
+    save_syntheses(archive, logger, all_design_syntheses_and_diagrams)
+
+
+def negotiation_moves(negotiation_logs_df):
+    """All moves of all sessions as one long table keyed by session_id"""
+    if "moves" not in negotiation_logs_df.columns:
+        return pd.DataFrame(columns=["session_id"] + NEGOTIATION_MOVE_COLUMNS)
+    moves = negotiation_logs_df[["session_id", "moves"]].explode(
+        "moves", ignore_index=True
+    )
+    moves = moves[moves["moves"].notna()]
+    moves_df = pd.DataFrame.from_records(
+        moves["moves"].tolist(), columns=NEGOTIATION_MOVE_COLUMNS
+    )
+    moves_df.insert(0, "session_id", moves["session_id"].to_numpy())
+    return moves_df
+
+
+def save_negotiation_logs(archive, logger, all_negotiation_logs, layout="per_session"):
+    negotiation_logs_df = pd.DataFrame.from_records(
+        all_negotiation_logs["all_negotiations"]
+    )
+    negotiation_logs_df.name = "Negotiation Logs"
+    # Check if dataframe is empty
+    if negotiation_logs_df.empty:
+        logger.info("No Negotiation Logs found for this project.")
+        return
+    moves_df = negotiation_moves(negotiation_logs_df)
+    if layout in ["long", "both"]:
+        archive.write_table("negotiation_moves", moves_df, index=False)
+    if layout in ["per_session", "both"]:
+        session_moves = dict(
+            list(moves_df.groupby("session_id", sort=False, dropna=False))
+        )
+        for session_id in negotiation_logs_df["session_id"]:
+            log_df = session_moves.get(session_id)
+            if log_df is None:
+                log_df = pd.DataFrame(columns=NEGOTIATION_MOVE_COLUMNS)
+            archive.write_table(
+                f"negotiation_log_{session_id}",
+                log_df[NEGOTIATION_MOVE_COLUMNS],
+                index=False,
+            )
+
+    logger.info("Writing Negotiation Logs file to disk..")
+    negotiation_logs_df = negotiation_logs_df.drop(columns=["moves"], errors="ignore")
+    archive.write_table("negotiation_logs", negotiation_logs_df)
+    logger.info("Negotiation Logs file written")
+
+
+def fetch_and_save_negotiation_logs(
+    my_api_helper, archive, logger, layout="per_session"
+):
+    negotiation_logs_response = my_api_helper.get_project_negotiation_logs()
+    if negotiation_logs_response.status_code == 200:
+        all_negotiation_logs = GeodesignHub.parse_json(negotiation_logs_response)
+        logger.info("Negotiation Logs data downloaded")
+        save_negotiation_logs(archive, logger, all_negotiation_logs, layout)
     else:
         logger.error(
             "Error in getting Negotiation Logs data from Geodesignhub: %s"
@@ -253,50 +679,484 @@ def fetch_and_save_negotiation_logs(my_api_helper, project_directory, logger):
         )
 
 
-def process_project(project_id, c, logger):
+def create_response_cache(c):
+    if not c["cache_directory"]:
+        return None
+    return ResponseCache(
+        c["cache_directory"],
+        ttl=c["cache_ttl"],
+        max_bytes=c["cache_max_mb"] * 1024 * 1024,
+    )
+
+
+def create_archive(c, project_id, logger):
+    """The archive writer chosen in the config for project_id"""
+    return create_archive_writer(
+        c["archive_writer"],
+        project_id,
+        excel_workbook=c["excel_workbook"],
+        logger=logger,
+        output_format=c["output_format"],
+        parquet_compression=c["parquet_compression"],
+        compression=c["archive_compression"],
+        compression_level=c["archive_compression_level"],
+        compression_workers=c["compression_workers"],
+        snapshot_directory=c["snapshot_directory"],
+    )
+
+
+def create_retry_policy(c):
+    return RetryPolicy(max_retries=c["max_retries"])
+
+
+def create_rate_limiter(c, max_concurrency):
+    """max_concurrency is the most requests the caller can have in flight, used
+    when max_concurrent_requests is not set"""
+    return RateLimiter(
+        rate=c["requests_per_second"],
+        max_concurrency=c["max_concurrent_requests"] or max_concurrency,
+    )
+
 
+def log_rate_limiter_stats(name, rate_limiter, logger):
+    if rate_limiter.throttled:
+        logger.warning(
+            "Server throttled %s requests for %s, concurrency settled at %s"
+            % (rate_limiter.throttled, name, int(rate_limiter.limit))
+        )
+
+
+def open_journal(project_id, c, logger):
+    if not c["resume_journal"]:
+        return None
+    run_journal = RunJournal(
+        journal_path(c["state_directory"], project_id),
+        max_age_hours=c["journal_max_age_hours"],
+        logger=logger,
+    )
+    if run_journal.resumed:
+        logger.info(
+            "Resuming project %s from its journal, %s responses journaled, completed stages: %s"
+            % (
+                project_id,
+                len(run_journal.responses),
+                ", ".join(run_journal.completed_stages) or "none",
+            )
+        )
+    return run_journal
+
+
+def write_metrics_report(
+    archive, project_id, request_metrics, stage_timings, duration, cache, rate_limiter
+):
+    """Add metrics.json to the archive and return the report"""
+    report = metrics.project_report(
+        project_id,
+        request_metrics,
+        stage_timings,
+        duration,
+        cache=cache.stats() if cache is not None else None,
+        throttled_requests=rate_limiter.throttled if rate_limiter else 0,
+    )
+    archive.write_bytes("metrics.json", metrics.dumps(report))
+    return report
+
+
+def close_archive(archive, report, start, logger):
+    """Close the archive and add the time that took, as the archive_close stage,
+    to the report returned for the run. metrics.json is already in the
+    archive, so the close time is only in the run metrics."""
+    close_start = time.perf_counter()
+    archive.close()
+    close_seconds = time.perf_counter() - close_start
+    logger.info(
+        "Archive of project %s closed in %.2fs" % (report["project_id"], close_seconds)
+    )
+    report["stages_seconds"]["archive_close"] = close_seconds
+    report["duration_seconds"] = time.perf_counter() - start
+
+
+def log_cache_stats(project_id, cache, logger):
+    if cache is None:
+        return
+    stats = cache.stats()
+    logger.info(
+        "Response cache for project %s: %s hits, %s revalidated, %s misses, %s entries (%.1f MB)"
+        % (
+            project_id,
+            stats["hits"],
+            stats["revalidated"],
+            stats["misses"],
+            stats["entries"],
+            stats["bytes"] / (1024 * 1024),
+        )
+    )
+
+
+def connection_pool_size(c):
+    # the systems, design team and synthesis fan-outs run alongside the other
+    # stages
+    return max(3 * c["max_workers"] + 3, 10)
+
+
+def process_project(
+    project_id, c, logger, session=None, response_cache=None, cancel=None
+):
+    """Archive one project and return its metrics report. session is a
+    requests session to reuse, see GeodesignHub.create_session(),
+    response_cache the ResponseCache of the run and cancel a threading.Event
+    that stops the archive between stages and before it is closed."""
+    start = time.perf_counter()
+    if response_cache is None:
+        response_cache = create_response_cache(c)
+    cache = response_cache.for_project() if response_cache is not None else None
+    request_metrics = metrics.RequestMetrics(project_id)
+    pool_maxsize = connection_pool_size(c)
+    rate_limiter = create_rate_limiter(c, pool_maxsize)
+    run_journal = open_journal(project_id, c, logger)
     my_api_helper = GeodesignHub.GeodesignHubClient(
-        url=c["service_url"], project_id=project_id, token=c["api_token"]
+        url=c["service_url"],
+        project_id=project_id,
+        token=c["api_token"],
+        pool_maxsize=pool_maxsize,
+        cache=cache,
+        timeout=c["request_timeout"],
+        retry_policy=create_retry_policy(c),
+        rate_limiter=rate_limiter,
+        metrics=request_metrics,
+        journal=run_journal,
+        session=session,
     )
-    # make output directory if it doesn't exist
-    output_directory = Path("output")
-    output_directory.mkdir(parents=True, exist_ok=True)
-
-    # make project folder
-    project_directory = output_directory / project_id
-    project_directory.mkdir(parents=True, exist_ok=True)
-
-    zip_file_name = project_id
-    zip_file_directory = output_directory / zip_file_name
-
-    fetch_and_save_project_details(my_api_helper, project_directory, logger)
-    fetch_and_save_systems(my_api_helper, project_directory, logger)
-    fetch_and_save_diagrams(my_api_helper, project_directory, logger)
-    all_design_team_details = fetch_and_save_design_teams(
-        my_api_helper, project_directory, logger
+    spatial_export.check_spatial_format(c["spatial_format"])
+    archive = create_archive(c, project_id, logger)
+
+    stream_diagrams = c["stream_diagrams"] and not c["incremental_diagrams"]
+    if c["stream_diagrams"] and c["incremental_diagrams"]:
+        logger.warning(
+            "stream_diagrams is ignored, diagrams are downloaded incrementally"
+        )
+    if stream_diagrams and ijson is None:
+        raise ImportError("stream_diagrams requires ijson, pip install ijson")
+
+    previous_diagram_state = None
+    if c["incremental_diagrams"]:
+        previous_diagram_state = incremental.load_diagram_state(
+            c["state_directory"],
+            project_id,
+            c["incremental_full_refresh_days"],
+            logger,
+        )
+
+    # Design teams and syntheses are pipelined within a single stage, the
+    # remaining stages are independent and are downloaded at the same time
+    stages = [
+        Stage(
+            "project_details",
+            partial(fetch_and_save_project_details, my_api_helper, archive, logger),
+        ),
+        Stage(
+            "systems",
+            partial(
+                fetch_and_save_systems,
+                my_api_helper,
+                archive,
+                logger,
+                max_workers=c["max_workers"],
+            ),
+        ),
+        Stage(
+            "diagrams",
+            (
+                partial(
+                    fetch_and_save_diagrams_incrementally,
+                    my_api_helper,
+                    archive,
+                    logger,
+                    previous_diagram_state,
+                    output_mode=c["incremental_output"],
+                    max_workers=c["max_workers"],
+                )
+                if c["incremental_diagrams"]
+                else (
+                    # The geometries are written while the diagrams stream in
+                    partial(
+                        fetch_and_save_diagrams_streaming,
+                        my_api_helper,
+                        archive,
+                        logger,
+                        chunk_size=c["stream_chunk_size"],
+                        spatial_format=c["spatial_format"],
+                    )
+                    if stream_diagrams
+                    else partial(
+                        fetch_and_save_diagrams, my_api_helper, archive, logger
+                    )
+                )
+            ),
+        ),
+        Stage(
+            "design_teams_and_syntheses",
+            partial(
+                fetch_and_save_design_teams_and_syntheses,
+                my_api_helper,
+                archive,
+                logger,
+                max_workers=c["max_workers"],
+            ),
+        ),
+        Stage(
+            "negotiation_logs",
+            partial(
+                fetch_and_save_negotiation_logs,
+                my_api_helper,
+                archive,
+                logger,
+                layout=c["negotiation_log_layout"],
+            ),
+        ),
+    ]
+    if c["spatial_format"] and not stream_diagrams:
+        stages.append(
+            Stage(
+                "diagram_geometries",
+                lambda diagrams_result: export_diagram_geometries(
+                    archive,
+                    logger,
+                    c["spatial_format"],
+                    (
+                        incremental.state_diagrams(diagrams_result)
+                        if c["incremental_diagrams"]
+                        else diagrams_result
+                    ),
+                ),
+                depends_on=["diagrams"],
+            )
+        )
+    try:
+        stage_results, stage_timings = run_stages(
+            stages,
+            logger,
+            on_complete=run_journal.record_stage if run_journal else None,
+            cancel=cancel,
+        )
+    except Exception:
+        archive.abort()
+        # The journal is kept so that the next run resumes from it
+        if run_journal is not None:
+            run_journal.close()
+        raise
+    logger.info(
+        "Stage timings for project %s: %s"
+        % (
+            project_id,
+            ", ".join(
+                "%s %.2fs" % (name, duration)
+                for name, duration in stage_timings.items()
+            ),
+        )
+    )
+
+    if c["incremental_diagrams"] and stage_results["diagrams"] is not None:
+        archive.write_bytes(
+            "incremental.json",
+            incremental.refresh_report(
+                stage_results["diagrams"], c["incremental_output"]
+            ),
+        )
+    log_cache_stats(project_id, cache, logger)
+    log_rate_limiter_stats("project %s" % project_id, rate_limiter, logger)
+    report = write_metrics_report(
+        archive,
+        project_id,
+        request_metrics,
+        stage_timings,
+        time.perf_counter() - start,
+        cache,
+        rate_limiter,
+    )
+    if cancel is not None and cancel.is_set():
+        # The archive is not renamed into place
+        archive.abort()
+        if run_journal is not None:
+            run_journal.close()
+        raise Cancelled("archive of project %s cancelled" % project_id)
+    close_archive(archive, report, start, logger)
+    if run_journal is not None:
+        run_journal.remove()
+    # Only remember the diagrams once they are safely in an archive
+    if c["incremental_diagrams"] and stage_results["diagrams"] is not None:
+        incremental.save_diagram_state(
+            c["state_directory"], project_id, stage_results["diagrams"]
+        )
+    return report
+
+
+# The response cache of a worker process of archive_projects(), shared by the
+# projects it archives
+_worker_response_cache = None
+
+
+def _init_worker(c):
+    global _worker_response_cache
+    _worker_response_cache = create_response_cache(c)
+
+
+def archive_project_in_worker(project_id, c):
+    """Archive a single project inside a worker process. Each project logs to
+    its own logs/<project_id>.log file so that concurrent workers do not
+    interleave their output or share the rotating root log file."""
+    logger = logging.getLogger("archive.%s" % project_id)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = logging.FileHandler(os.path.join("logs", "%s.log" % project_id))
+    handler.setFormatter(
+        logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s")
+    )
+    logger.addHandler(handler)
+    try:
+        return archive_project_safely(
+            project_id, c, logger, response_cache=_worker_response_cache
+        )
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def archive_project_safely(
+    project_id, c, logger, session=None, response_cache=None, cancel=None
+):
+    """Run process_project, recording the outcome instead of raising so that a
+    failing project does not abort the rest of the run."""
+    start = time.perf_counter()
+    report = None
+    try:
+        report = process_project(
+            project_id,
+            c,
+            logger,
+            session=session,
+            response_cache=response_cache,
+            cancel=cancel,
+        )
+        status, error = "success", None
+    except Cancelled as e:
+        logger.warning("Archiving project %s stopped: %s" % (project_id, e))
+        status, error = "cancelled", str(e)
+    except Exception as e:
+        logger.exception("Error in archiving project %s" % project_id)
+        status, error = "failed", repr(e)
+        # Don't leave a half written project directory behind
+        shutil.rmtree(Path("output", project_id), ignore_errors=True)
+    return {
+        "project_id": project_id,
+        "status": status,
+        "duration": time.perf_counter() - start,
+        "error": error,
+        "metrics": report,
+    }
+
+
+def archive_projects(project_ids, c, logger):
+    if c["project_workers"] == 1:
+        response_cache = create_response_cache(c)
+        return [
+            archive_project_safely(project_id, c, logger, response_cache=response_cache)
+            for project_id in project_ids
+        ]
+
+    logger.info(
+        "Archiving %s projects using %s worker processes"
+        % (len(project_ids), c["project_workers"])
     )
-    fetch_and_save_syntheses(
-        my_api_helper,
-        project_directory,
-        logger,
-        all_design_team_details,
+    results = []
+    with ProcessPoolExecutor(
+        max_workers=c["project_workers"], initializer=_init_worker, initargs=(c,)
+    ) as executor:
+        futures = {
+            executor.submit(archive_project_in_worker, project_id, c): project_id
+            for project_id in project_ids
+        }
+        for future in as_completed(futures):
+            project_id = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker process itself died, e.g. it ran out of memory
+                result = {
+                    "project_id": project_id,
+                    "status": "failed",
+                    "duration": None,
+                    "error": repr(e),
+                    "metrics": None,
+                }
+            logger.info("Project %s finished: %s" % (project_id, result["status"]))
+            results.append(result)
+    # Report in the order the projects were configured
+    return sorted(results, key=lambda result: project_ids.index(result["project_id"]))
+
+
+def log_run_summary(results, logger):
+    failures = [result for result in results if result["status"] != "success"]
+    logger.info(
+        "Run summary: %s projects, %s succeeded, %s failed"
+        % (len(results), len(results) - len(failures), len(failures))
     )
-    fetch_and_save_negotiation_logs(my_api_helper, project_directory, logger)
-
-    # Combine all the csv files as a single Excel workbook with multiple sheets
-    with pd.ExcelWriter(
-        Path.joinpath(project_directory, f"{project_id}_data.xlsx"),
-        engine="openpyxl",
-    ) as writer:
-        for csv_file in project_directory.glob("*.csv"):
-            df = pd.read_csv(csv_file)
-            sheet_name = csv_file.stem
-            df.to_excel(writer, sheet_name=sheet_name, index=False)
-
-    shutil.make_archive(
-        str(Path("output", zip_file_name)), "zip", str(zip_file_directory)
+    for result in results:
+        duration = (
+            "%.2fs" % result["duration"] if result["duration"] is not None else "n/a"
+        )
+        close_seconds = (
+            result["metrics"]["stages_seconds"].get("archive_close")
+            if result.get("metrics")
+            else None
+        )
+        logger.info(
+            "  %s %s %s%s%s"
+            % (
+                result["project_id"],
+                result["status"],
+                duration,
+                (
+                    ", archive closed in %.2fs" % close_seconds
+                    if close_seconds is not None
+                    else ""
+                ),
+                " (%s)" % result["error"] if result["error"] else "",
+            )
+        )
+
+
+def write_run_metrics(results, logger, path=Path("output", "run_metrics.json")):
+    """Write the summed metrics of all archived projects and log the endpoints
+    that took longest"""
+    reports = [result["metrics"] for result in results if result.get("metrics")]
+    if not reports:
+        return
+    summary = metrics.merge_reports(reports)
+    summary["results"] = [
+        {key: value for key, value in result.items() if key != "metrics"}
+        for result in results
+    ]
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    Path(path).write_bytes(metrics.dumps(summary))
+    logger.info(
+        "Run metrics written to %s, %s requests, %.1f MB received"
+        % (
+            path,
+            summary["totals"]["requests"],
+            summary["totals"]["bytes"] / (1024 * 1024),
+        )
     )
-    shutil.rmtree(project_directory)
+    for endpoint, stats in metrics.slowest_endpoints(summary):
+        logger.info(
+            "  %s: %s requests, %.2fs in total, %.0fms on average"
+            % (
+                endpoint,
+                stats["requests"],
+                stats["latency_ms"]["total"] / 1000,
+                stats["latency_ms"]["mean"],
+            )
+        )
 
 
 if __name__ == "__main__":
@@ -307,5 +1167,12 @@ if __name__ == "__main__":
 
     c = load_and_validate_config(logger)
     project_ids = c["project_ids"]
-    for project_id in project_ids:
-        process_project(project_id, c, logger)
+    if c["async_mode"]:
+        import asyncio
+        import async_archive
+
+        results = asyncio.run(async_archive.archive_projects(project_ids, c, logger))
+    else:
+        results = archive_projects(project_ids, c, logger)
+    log_run_summary(results, logger)
+    write_run_metrics(results, logger)
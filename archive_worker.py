@@ -0,0 +1,267 @@
+"""Long running archiver that drains a queue of project archive jobs.
+
+Jobs are kept in the SQLite database job_database of config.json, see
+job_queue.py. A fixed pool of worker_processes processes claims and archives
+them one at a time. The processes import pandas and the writers once and keep
+their HTTP sessions, and so their open connections, from one job to the next.
+The outcome, duration and metrics totals of every job are recorded in the
+database.
+
+    python archive_worker.py submit <project_id> ... [--priority 10]
+    python archive_worker.py submit --file project_ids.txt
+    python archive_worker.py work [--workers 4] [--exit-when-empty]
+    python archive_worker.py status
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+import archive_project
+import GeodesignHub
+import job_queue
+
+# Seconds an idle worker waits before it looks for a job again
+POLL_INTERVAL = 5
+
+
+class LeaseRenewer(threading.Thread):
+    """Renews the lease of a job while it is archived. lost is set when the
+    lease ran out before it could be renewed, the job may then have been
+    claimed by another worker and must stop."""
+
+    def __init__(self, c, job_id, worker, logger):
+        super().__init__(daemon=True)
+        self.c = c
+        self.job_id = job_id
+        self.worker = worker
+        self.logger = logger
+        self.finished = threading.Event()
+        self.lost = threading.Event()
+
+    def run(self):
+        # SQLite connections can't be shared between threads
+        queue = job_queue.JobQueue(self.c["job_database"])
+        try:
+            interval = self.c["job_lease_seconds"] / 3
+            while not self.finished.wait(interval):
+                if not queue.renew(
+                    self.job_id, self.worker, self.c["job_lease_seconds"]
+                ):
+                    self.logger.warning(
+                        "Job %s is no longer leased to %s, stopping it"
+                        % (self.job_id, self.worker)
+                    )
+                    self.lost.set()
+                    return
+        finally:
+            queue.close()
+
+    def stop(self):
+        self.finished.set()
+        self.join()
+
+
+def job_result(result):
+    """The part of the result of archive_project_safely kept in the database"""
+    report = result["metrics"]
+    if report is None:
+        return None
+    return {"totals": report["totals"], "stages_seconds": report["stages_seconds"]}
+
+
+def run_job(queue, job, c, worker, sessions, response_cache, logger):
+    service_url = job["service_url"] or c["service_url"]
+    session = sessions.get(service_url)
+    if session is None:
+        session = sessions[service_url] = GeodesignHub.create_session(
+            archive_project.connection_pool_size(c)
+        )
+    logger.info(
+        "Archiving project %s, job %s attempt %s"
+        % (job["project_id"], job["id"], job["attempts"])
+    )
+    renewer = LeaseRenewer(c, job["id"], worker, logger)
+    renewer.start()
+    try:
+        result = archive_project.archive_project_safely(
+            job["project_id"],
+            {**c, "service_url": service_url},
+            logger,
+            session,
+            response_cache,
+            cancel=renewer.lost,
+        )
+    except BaseException:
+        renewer.stop()
+        queue.release(job["id"], worker)
+        raise
+    renewer.stop()
+    if renewer.lost.is_set():
+        # The job belongs to whoever claimed it since, it records the outcome
+        logger.warning(
+            "Job %s of project %s lost its lease after %.1fs, result not recorded"
+            % (job["id"], job["project_id"], result["duration"])
+        )
+        return
+    if result["status"] == "success":
+        queue.complete(job["id"], worker, result["duration"], job_result(result))
+    else:
+        # Back off exponentially from one attempt to the next
+        queue.fail(
+            job["id"],
+            worker,
+            result["duration"],
+            result["error"],
+            retry_delay=c["job_retry_delay"] * 2 ** (job["attempts"] - 1),
+        )
+    logger.info(
+        "Job %s of project %s finished: %s in %.1fs"
+        % (job["id"], job["project_id"], result["status"], result["duration"])
+    )
+
+
+def work(c, logger, exit_when_empty=False):
+    """Archive jobs until interrupted, or until the queue is empty"""
+    worker = "%s-%s" % (socket.gethostname(), os.getpid())
+    queue = job_queue.JobQueue(c["job_database"], c["service_url"])
+    sessions = {}
+    response_cache = archive_project.create_response_cache(c)
+    jobs_done = 0
+    try:
+        while True:
+            job = queue.claim(worker, c["job_lease_seconds"], c["max_jobs_per_host"])
+            if job is None:
+                if exit_when_empty and queue.pending() == 0:
+                    break
+                time.sleep(POLL_INTERVAL)
+                continue
+            run_job(queue, job, c, worker, sessions, response_cache, logger)
+            jobs_done += 1
+    except KeyboardInterrupt:
+        logger.info("Worker %s interrupted" % worker)
+    finally:
+        for session in sessions.values():
+            session.close()
+        queue.close()
+    logger.info("Worker %s ran %s jobs" % (worker, jobs_done))
+    return jobs_done
+
+
+def work_in_process(number, c, exit_when_empty):
+    """work() in a worker process, logging to logs/worker_<number>.log"""
+    logger = logging.getLogger("worker.%s" % number)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = logging.FileHandler(os.path.join("logs", "worker_%s.log" % number))
+    handler.setFormatter(
+        logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s")
+    )
+    logger.addHandler(handler)
+    work(c, logger, exit_when_empty)
+
+
+def run_workers(c, logger, workers, exit_when_empty=False):
+    if c["async_mode"]:
+        logger.warning("async_mode is not used by the worker, jobs run one at a time")
+    if workers == 1:
+        work(c, logger, exit_when_empty)
+        return
+    logger.info("Starting %s worker processes" % workers)
+    processes = [
+        multiprocessing.Process(
+            target=work_in_process, args=(number, c, exit_when_empty)
+        )
+        for number in range(1, workers + 1)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # The workers got the interrupt as well and release their jobs
+        for process in processes:
+            process.join()
+
+
+def log_status(queue, logger):
+    counts = queue.counts()
+    logger.info(
+        "Jobs: %s"
+        % ", ".join(
+            "%s %s" % (counts.get(status, 0), status)
+            for status in [
+                job_queue.QUEUED,
+                job_queue.RUNNING,
+                job_queue.SUCCEEDED,
+                job_queue.FAILED,
+            ]
+        )
+    )
+    for job in queue.jobs(job_queue.FAILED, limit=20):
+        logger.info(
+            "Failed job %s of project %s after %s attempts: %s"
+            % (job["id"], job["project_id"], job["attempts"], job["error"])
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    submit_parser = commands.add_parser(
+        "submit", help="queue archive jobs, for project_ids of config.json by default"
+    )
+    submit_parser.add_argument("project_ids", nargs="*")
+    submit_parser.add_argument("--file", help="file with a project id per line")
+    submit_parser.add_argument("--priority", type=int, default=0)
+    submit_parser.add_argument(
+        "--service-url", help="the service_url of config.json by default"
+    )
+    work_parser = commands.add_parser("work", help="archive queued projects")
+    work_parser.add_argument(
+        "--workers", type=int, help="worker_processes of config.json by default"
+    )
+    work_parser.add_argument("--exit-when-empty", action="store_true")
+    commands.add_parser("status", help="count the jobs by status")
+    args = parser.parse_args()
+
+    logger = archive_project.ScriptLogger().get_logger()
+    # Log to the console as well, the worker runs in the foreground
+    logger.addHandler(logging.StreamHandler(sys.stderr))
+    c = archive_project.load_and_validate_config(logger)
+
+    if args.command == "submit":
+        project_ids = list(args.project_ids)
+        if args.file:
+            with open(args.file) as project_ids_file:
+                project_ids += [
+                    line.strip() for line in project_ids_file if line.strip()
+                ]
+        if not project_ids:
+            project_ids = c["project_ids"]
+        queue = job_queue.JobQueue(c["job_database"], c["service_url"])
+        job_ids = queue.submit(
+            project_ids,
+            priority=args.priority,
+            service_url=args.service_url,
+            max_attempts=c["job_max_attempts"],
+        )
+        logger.info(
+            "Queued %s jobs, %s projects were queued already"
+            % (len(job_ids), len(project_ids) - len(job_ids))
+        )
+        queue.close()
+    elif args.command == "work":
+        run_workers(
+            c, logger, args.workers or c["worker_processes"], args.exit_when_empty
+        )
+    else:
+        queue = job_queue.JobQueue(c["job_database"], c["service_url"])
+        log_status(queue, logger)
+        queue.close()
@@ -0,0 +1,563 @@
+"""Writers that put the tables of a project into output/<project_id>.zip.
+
+Every save function in archive_project.py hands its DataFrame to
+write_table(), so the way an archive is stored is chosen in one place.
+Tables may be written from several threads at the same time."""
+
+import os
+import re
+import shutil
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+import snapshot_store
+import table_formats
+import zip_compression
+
+try:
+    import xlsxwriter
+except ImportError:  # the workbook falls back to openpyxl's write-only mode
+    xlsxwriter = None
+
+# Limits of the xlsx format
+MAX_SHEET_NAME_LENGTH = 31
+MAX_SHEET_ROWS = 1048576
+
+
+class WorkbookWriter:
+    """Writes DataFrames as sheets of an xlsx workbook, row by row, as they are
+    produced. xlsxwriter's constant_memory mode is used when it is installed,
+    otherwise openpyxl's write-only mode, both flush every row to disk so
+    memory use does not grow with the size of the tables. Each open sheet keeps
+    a temporary file open, so sheets are closed as soon as they are complete;
+    a project with thousands of sheets would otherwise run out of file
+    descriptors."""
+
+    def __init__(self, path, logger=None):
+        self.path = Path(path)
+        self.logger = logger
+        self.sheet_names = set()
+        self._lock = threading.Lock()
+        if xlsxwriter is not None:
+            self.workbook = xlsxwriter.Workbook(
+                str(self.path),
+                {"constant_memory": True, "nan_inf_to_errors": True},
+            )
+        else:
+            from openpyxl import Workbook
+
+            self.workbook = Workbook(write_only=True)
+
+    def _sheet_name(self, name):
+        # Excel does not allow some characters or long names in sheet names
+        sheet_name = re.sub(r"[\[\]:*?/\\]", "_", name)[:MAX_SHEET_NAME_LENGTH]
+        suffix = 1
+        while sheet_name.lower() in self.sheet_names:
+            suffix += 1
+            tag = f"_{suffix}"
+            sheet_name = sheet_name[: MAX_SHEET_NAME_LENGTH - len(tag)] + tag
+        self.sheet_names.add(sheet_name.lower())
+        return sheet_name
+
+    @staticmethod
+    def _cell_value(value):
+        if value is None or value is pd.NaT:
+            return None
+        if isinstance(value, pd.Timestamp):
+            # Excel has no time zones
+            return value.tz_localize(None).to_pydatetime()
+        if isinstance(value, (list, dict)):
+            return str(value)
+        if isinstance(value, float) and value != value:
+            return None
+        return value
+
+    def _rows(self, df, index, header=True):
+        if header:
+            yield ([df.index.name or ""] if index else []) + [
+                str(column) for column in df.columns
+            ]
+        for row in df.itertuples(index=index, name=None):
+            yield [self._cell_value(value) for value in row]
+
+    def open_sheet(self, name, index=True):
+        """Add an empty sheet, its rows are added with WorkbookSheet.append()"""
+        with self._lock:
+            sheet_name = self._sheet_name(name)
+            if xlsxwriter is not None:
+                worksheet = self.workbook.add_worksheet(sheet_name)
+            else:
+                worksheet = self.workbook.create_sheet(sheet_name)
+        return WorkbookSheet(self, name, worksheet, index)
+
+    def add_sheet(self, name, df, index=True):
+        sheet = self.open_sheet(name, index)
+        sheet.append(df)
+        sheet.close()
+
+    def close(self):
+        with self._lock:
+            if xlsxwriter is not None:
+                self.workbook.close()
+            else:
+                self.workbook.save(str(self.path))
+
+
+class WorkbookSheet:
+    """A sheet of a WorkbookWriter that is filled chunk by chunk"""
+
+    def __init__(self, workbook_writer, name, worksheet, index):
+        self.workbook_writer = workbook_writer
+        self.name = name
+        self.worksheet = worksheet
+        self.index = index
+        self.rows_written = 0
+        self.truncated = False
+
+    def append(self, df):
+        rows = self.workbook_writer._rows(df, self.index, header=self.rows_written == 0)
+        with self.workbook_writer._lock:
+            for row in rows:
+                if self.rows_written >= MAX_SHEET_ROWS:
+                    self._warn_truncated()
+                    break
+                if xlsxwriter is not None:
+                    self.worksheet.write_row(self.rows_written, 0, row)
+                else:
+                    self.worksheet.append(row)
+                self.rows_written += 1
+
+    def close(self):
+        """Release the temporary file of the sheet, no rows can be appended
+        after this. The rows stay on disk until the workbook is closed."""
+        with self.workbook_writer._lock:
+            if xlsxwriter is None:
+                self.worksheet.close()
+            elif hasattr(self.worksheet, "_opt_close"):
+                # xlsxwriter reopens the file when it assembles the workbook
+                self.worksheet._opt_close()
+
+    def _warn_truncated(self):
+        if self.truncated or self.workbook_writer.logger is None:
+            return
+        self.truncated = True
+        self.workbook_writer.logger.warning(
+            "Table %s has more rows than fit in the workbook, only the first %s were written"
+            % (self.name, MAX_SHEET_ROWS - 1)
+        )
+
+
+class StreamedTable:
+    """A table that is written chunk by chunk with write(), returned by
+    open_table() of the archive writers"""
+
+    def __init__(self, table_file, sheet=None, on_close=None):
+        self.table_file = table_file
+        self.sheet = sheet
+        self.on_close = on_close
+
+    def write(self, df):
+        df = self.table_file.write(df)
+        if self.sheet is not None:
+            self.sheet.append(df)
+
+    def close(self):
+        self.table_file.close()
+        if self.sheet is not None:
+            self.sheet.close()
+        if self.on_close is not None:
+            self.on_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            # The archive is aborted, only release the file
+            self.table_file.close()
+
+
+class DirectoryArchiveWriter:
+    """Stages every table as a file in output/<project_id>/ and zips the
+    directory when the archive is closed, compressing the files in
+    compression_workers threads"""
+
+    def __init__(
+        self,
+        project_id,
+        output_directory=Path("output"),
+        excel_workbook=True,
+        logger=None,
+        output_format="csv",
+        parquet_compression="zstd",
+        compression="deflate",
+        compression_level=None,
+        compression_workers=None,
+    ):
+        table_formats.check_output_format(output_format)
+        self.project_id = project_id
+        self.output_format = output_format
+        self.parquet_compression = parquet_compression
+        self.compression = zip_compression.MemberCompression(
+            compression, compression_level
+        )
+        self.compression_workers = compression_workers
+        self.output_directory = Path(output_directory)
+        self.project_directory = self.output_directory / project_id
+        # Files left behind by an interrupted run would end up in the zip
+        shutil.rmtree(self.project_directory, ignore_errors=True)
+        self.project_directory.mkdir(parents=True)
+        self.workbook = None
+        if excel_workbook:
+            self.workbook = WorkbookWriter(
+                self.project_directory / f"{project_id}_data.xlsx", logger
+            )
+
+    def write_table(self, name, df, index=True):
+        table_path = Path.joinpath(
+            self.project_directory, table_formats.file_name(name, self.output_format)
+        )
+        with open(table_path, "wb") as table_file:
+            table_formats.write_table(
+                table_file,
+                name,
+                df,
+                self.output_format,
+                index=index,
+                compression=self.parquet_compression,
+            )
+        if self.workbook is not None:
+            self.workbook.add_sheet(name, df, index=index)
+
+    def open_table(self, name, index=True, columns=None):
+        table_file = table_formats.TableFileWriter(
+            self.project_directory / table_formats.file_name(name, self.output_format),
+            name,
+            self.output_format,
+            index=index,
+            compression=self.parquet_compression,
+            columns=columns,
+        )
+        sheet = None
+        if self.workbook is not None:
+            sheet = self.workbook.open_sheet(name, index=index)
+        return StreamedTable(table_file, sheet)
+
+    def write_file(self, name, path):
+        shutil.copyfile(path, self.project_directory / name)
+
+    def write_bytes(self, name, data):
+        (self.project_directory / name).write_bytes(data)
+
+    def _compress(self, path):
+        name = path.relative_to(self.project_directory).as_posix()
+        if not zip_compression.RAW_MEMBERS:
+            # Compressed by ZipFile.write() in close()
+            return name, None, path
+        compressed, data_path = zip_compression.compress_file(
+            path,
+            path.with_name(path.name + ".compressed"),
+            self.compression.for_member(name),
+        )
+        return name, compressed.member_info(name), data_path
+
+    def close(self):
+        if self.workbook is not None:
+            self.workbook.close()
+        paths = sorted(
+            path for path in self.project_directory.rglob("*") if path.is_file()
+        )
+        # The members are compressed in parallel, then copied into the zip
+        with ThreadPoolExecutor(max_workers=self.compression_workers) as executor:
+            members = list(executor.map(self._compress, paths))
+        zip_path = self.output_directory / f"{self.project_id}.zip"
+        partial_path = self.output_directory / f"{self.project_id}.zip.partial"
+        with zipfile.ZipFile(partial_path, "w") as zip_file:
+            for name, member_info, data_path in members:
+                if member_info is None:
+                    zip_compression.add_file(
+                        zip_file, name, data_path, self.compression.for_member(name)
+                    )
+                else:
+                    zip_compression.add_compressed(zip_file, member_info, data_path)
+        os.replace(partial_path, zip_path)
+        shutil.rmtree(self.project_directory)
+
+    def abort(self):
+        shutil.rmtree(self.project_directory, ignore_errors=True)
+        (self.output_directory / f"{self.project_id}.zip.partial").unlink(
+            missing_ok=True
+        )
+
+
+class ZipArchiveWriter:
+    """Encodes every table straight into a member of the project's zip file, so
+    nothing is staged on disk apart from the zip itself and the workbook, which
+    is added to the zip once it is complete. The zip is written under a
+    temporary name and only renamed when it is complete.
+
+    Each member is compressed by the thread that writes it into a staging
+    file, and only copied into the zip under the lock, so tables written at
+    the same time are compressed at the same time."""
+
+    def __init__(
+        self,
+        project_id,
+        output_directory=Path("output"),
+        excel_workbook=True,
+        logger=None,
+        output_format="csv",
+        parquet_compression="zstd",
+        compression="deflate",
+        compression_level=None,
+        compression_workers=None,
+    ):
+        table_formats.check_output_format(output_format)
+        self.project_id = project_id
+        self.output_format = output_format
+        self.parquet_compression = parquet_compression
+        self.compression = zip_compression.MemberCompression(
+            compression, compression_level
+        )
+        self.compression_workers = compression_workers
+        self.output_directory = Path(output_directory)
+        self.output_directory.mkdir(parents=True, exist_ok=True)
+        self.zip_path = self.output_directory / f"{project_id}.zip"
+        self.partial_path = self.output_directory / f"{project_id}.zip.partial"
+        self.zip_file = zipfile.ZipFile(self.partial_path, "w")
+        # A zip file can only have one member open for writing at a time
+        self._lock = threading.Lock()
+        # Files of tables opened with open_table(), removed by abort()
+        self._staging_paths = []
+        self.workbook = None
+        self.workbook_path = self.output_directory / f"{project_id}_data.xlsx.partial"
+        if excel_workbook:
+            self.workbook = WorkbookWriter(self.workbook_path, logger)
+
+    def _add_member(self, name, write):
+        """Call write with a file that compresses into a staging file, then
+        copy the staging file into the zip. Without RAW_MEMBERS the staging
+        file is not compressed and ZipFile.write() compresses it."""
+        compression = self.compression.for_member(name)
+        staging_path = self.output_directory / f"{self.project_id}.{name}.compressed"
+        self._staging_paths.append(staging_path)
+        try:
+            with open(staging_path, "wb") as staging_file:
+                with zip_compression.CompressedFile(
+                    staging_file,
+                    (
+                        compression
+                        if zip_compression.RAW_MEMBERS
+                        else zip_compression.MemberCompression("store")
+                    ),
+                ) as member:
+                    write(member)
+            with self._lock:
+                if zip_compression.RAW_MEMBERS:
+                    zip_compression.add_compressed(
+                        self.zip_file, member.member_info(name), staging_path
+                    )
+                else:
+                    zip_compression.add_file(
+                        self.zip_file, name, staging_path, compression
+                    )
+        finally:
+            staging_path.unlink(missing_ok=True)
+
+    def _add_file(self, name, path):
+        compression = self.compression.for_member(name)
+        if not zip_compression.RAW_MEMBERS:
+            with self._lock:
+                zip_compression.add_file(self.zip_file, name, path, compression)
+            return
+        if compression.codec != "store":
+
+            def copy_file(member):
+                with open(path, "rb") as source:
+                    shutil.copyfileobj(source, member, zip_compression.COPY_CHUNK_SIZE)
+
+            self._add_member(name, copy_file)
+            return
+        # Stored files are copied into the zip as they are
+        compressed, _ = zip_compression.compress_file(path, None, compression)
+        with self._lock:
+            zip_compression.add_compressed(
+                self.zip_file, compressed.member_info(name), path
+            )
+
+    def write_table(self, name, df, index=True):
+        self._add_member(
+            table_formats.file_name(name, self.output_format),
+            lambda member: table_formats.write_table(
+                member,
+                name,
+                df,
+                self.output_format,
+                index=index,
+                compression=self.parquet_compression,
+            ),
+        )
+        if self.workbook is not None:
+            self.workbook.add_sheet(name, df, index=index)
+
+    def open_table(self, name, index=True, columns=None):
+        """The table is staged in a file next to the zip and added to it when
+        it is closed, so other tables can be written in the meantime"""
+        member_name = table_formats.file_name(name, self.output_format)
+        staging_path = (
+            self.output_directory / f"{self.project_id}.{member_name}.partial"
+        )
+        table_file = table_formats.TableFileWriter(
+            staging_path,
+            name,
+            self.output_format,
+            index=index,
+            compression=self.parquet_compression,
+            columns=columns,
+        )
+        sheet = None
+        if self.workbook is not None:
+            sheet = self.workbook.open_sheet(name, index=index)
+
+        def add_to_zip():
+            self._add_file(member_name, staging_path)
+            staging_path.unlink()
+
+        self._staging_paths.append(staging_path)
+        return StreamedTable(table_file, sheet, on_close=add_to_zip)
+
+    def write_file(self, name, path):
+        self._add_file(name, path)
+
+    def write_bytes(self, name, data):
+        self._add_member(name, lambda member: member.write(data))
+
+    def close(self):
+        try:
+            if self.workbook is not None:
+                self.workbook.close()
+                self._add_file(f"{self.project_id}_data.xlsx", self.workbook_path)
+                self.workbook_path.unlink()
+            with self._lock:
+                self.zip_file.close()
+        except Exception:
+            self.abort()
+            raise
+        os.replace(self.partial_path, self.zip_path)
+
+    def abort(self):
+        with self._lock:
+            self.zip_file.close()
+        self.partial_path.unlink(missing_ok=True)
+        self.workbook_path.unlink(missing_ok=True)
+        for staging_path in self._staging_paths:
+            staging_path.unlink(missing_ok=True)
+
+
+class SnapshotArchiveWriter:
+    """Stores the tables and files of a project in a content-addressed
+    snapshot store, see snapshot_store.py. Nothing is written to output/, the
+    zip is made with snapshot_store.materialize() when it is needed. The
+    workbook is not stored, it is made again from the tables."""
+
+    def __init__(
+        self,
+        project_id,
+        output_directory=Path("output"),
+        excel_workbook=True,
+        logger=None,
+        output_format="csv",
+        parquet_compression="zstd",
+        compression="deflate",
+        compression_level=None,
+        compression_workers=None,
+        snapshot_directory="snapshots",
+    ):
+        # The compression options apply to materialized zips
+        table_formats.check_output_format(output_format)
+        self.project_id = project_id
+        self.output_format = output_format
+        self.excel_workbook = excel_workbook
+        self.logger = logger
+        self.output_directory = Path(output_directory)
+        self.output_directory.mkdir(parents=True, exist_ok=True)
+        self.store = snapshot_store.SnapshotStore(snapshot_directory)
+        self.tables = {}
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def _add_table(self, name, table):
+        with self._lock:
+            self.tables[name] = table
+
+    def write_table(self, name, df, index=True):
+        table = snapshot_store.SnapshotTable(self.store, name, index=index)
+        table.write(df)
+        self._add_table(name, table)
+
+    def open_table(self, name, index=True, columns=None):
+        table = snapshot_store.SnapshotTable(
+            self.store, name, index=index, columns=columns
+        )
+        return StreamedTable(table, on_close=lambda: self._add_table(name, table))
+
+    def write_file(self, name, path):
+        digest = self.store.put_file(path)
+        with self._lock:
+            self.files[name] = digest
+
+    def write_bytes(self, name, data):
+        digest = self.store.put(data)
+        with self._lock:
+            self.files[name] = digest
+
+    def close(self):
+        with self._lock:
+            manifest = {
+                "format": snapshot_store.MANIFEST_FORMAT,
+                "project_id": self.project_id,
+                "snapshot_id": time.strftime("%Y%m%dT%H%M%SZ", time.gmtime()),
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "output_format": self.output_format,
+                "excel_workbook": self.excel_workbook,
+                "tables": {
+                    name: table.manifest_entry()
+                    for name, table in sorted(self.tables.items())
+                },
+                "files": dict(sorted(self.files.items())),
+            }
+        manifest_path = self.store.write_manifest(manifest)
+        if self.logger is not None:
+            self.logger.info("Snapshot manifest written to %s" % manifest_path)
+
+    def abort(self):
+        # The objects already stored are removed by SnapshotStore.prune()
+        with self._lock:
+            self.tables.clear()
+            self.files.clear()
+
+
+ARCHIVE_WRITERS = {
+    "stream": ZipArchiveWriter,
+    "directory": DirectoryArchiveWriter,
+    "snapshot": SnapshotArchiveWriter,
+}
+
+
+def create_archive_writer(
+    kind,
+    project_id,
+    output_directory=Path("output"),
+    snapshot_directory="snapshots",
+    **options,
+):
+    if kind == "snapshot":
+        options["snapshot_directory"] = snapshot_directory
+    return ARCHIVE_WRITERS[kind](project_id, output_directory, **options)
@@ -0,0 +1,485 @@
+"""asyncio path of the archiver, built on GeodesignHub.AsyncGeodesignHubClient.
+
+All projects share one event loop and one connection pool, so hundreds of
+requests can be in flight across projects while the per-host limit keeps the
+load on the server bounded. Files are written with the same save functions as
+archive_project.py, in worker threads so they don't block the event loop."""
+
+import asyncio
+import shutil
+import time
+from pathlib import Path
+
+import GeodesignHub
+import archive_project
+import incremental
+import metrics
+import spatial_export
+
+
+async def in_thread(function, *args):
+    """asyncio.to_thread() that, when cancelled, waits for function to return
+    before it raises CancelledError. A thread can't be stopped, so this keeps a
+    cancelled stage from writing to an archive that is being aborted."""
+    future = asyncio.ensure_future(asyncio.to_thread(function, *args))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        raise
+
+
+async def gather_stages(*coroutines):
+    """Run the stages at the same time and return their results in order. When
+    a stage fails the others are cancelled, and awaited, before its exception
+    is raised, like stages.run_stages() does on the sync path."""
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for task in tasks:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+    return [task.result() for task in tasks]
+
+
+async def fetch_and_save_project_details(my_api_helper, archive, logger):
+    all_projects_response = await my_api_helper.get_project_details()
+    if all_projects_response.status_code == 200:
+        all_project_details = GeodesignHub.parse_json(all_projects_response)
+        logger.info("Project data downloaded")
+        await in_thread(
+            archive_project.save_project_details,
+            archive,
+            logger,
+            all_project_details,
+        )
+    else:
+        logger.error(
+            "Error in getting project data from Geodesignhub: %s"
+            % all_projects_response.text
+        )
+
+
+async def fetch_and_save_systems(my_api_helper, archive, logger):
+    all_systems_response = await my_api_helper.get_all_systems()
+    if all_systems_response.status_code == 200:
+        all_systems = GeodesignHub.parse_json(all_systems_response)
+        all_system_details = []
+        # gather() returns the responses in system order
+        system_detail_responses = await asyncio.gather(
+            *[my_api_helper.get_single_system(system["id"]) for system in all_systems]
+        )
+        for system_detail_response in system_detail_responses:
+            if system_detail_response.status_code != 200:
+                logger.error(
+                    "Error in getting System Details %s" % system_detail_response.text
+                )
+                continue
+            all_system_details.append(GeodesignHub.parse_json(system_detail_response))
+        await in_thread(
+            archive_project.save_systems, archive, logger, all_system_details
+        )
+    else:
+        logger.error(
+            "Error in getting systems data from Geodesignhub: %s"
+            % all_systems_response.text
+        )
+
+
+async def fetch_and_save_diagrams(my_api_helper, archive, logger):
+    all_diagrams_response = await my_api_helper.get_all_diagrams()
+    if all_diagrams_response.status_code == 200:
+        all_diagrams = GeodesignHub.parse_json(all_diagrams_response)
+        logger.info("Diagrams data downloaded")
+        await in_thread(archive_project.save_diagrams, archive, logger, all_diagrams)
+        return all_diagrams
+    else:
+        logger.error(
+            "Error in getting diagrams data from Geodesignhub: %s"
+            % all_diagrams_response.text
+        )
+        return None
+
+
+async def fetch_and_save_diagrams_incrementally(
+    my_api_helper, archive, logger, previous_state, output_mode="merged"
+):
+    """asyncio version of archive_project.fetch_and_save_diagrams_incrementally"""
+    if previous_state is None:
+        all_diagrams_response = await my_api_helper.get_all_diagrams()
+        if all_diagrams_response.status_code != 200:
+            logger.error(
+                "Error in getting diagrams data from Geodesignhub: %s"
+                % all_diagrams_response.text
+            )
+            return None
+        all_diagrams = GeodesignHub.parse_json(all_diagrams_response)
+        logger.info("Diagrams data downloaded")
+        diagrams = {str(diagram["id"]): diagram for diagram in all_diagrams}
+        change_id_responses = await asyncio.gather(
+            *[
+                my_api_helper.get_diagram_changeid(int(diagram_id))
+                for diagram_id in diagrams
+            ]
+        )
+        change_ids = incremental.initial_change_ids(
+            dict(zip(diagrams, change_id_responses)), logger
+        )
+        await in_thread(archive_project.save_diagrams, archive, logger, all_diagrams)
+        return incremental.new_state(diagrams, change_ids)
+
+    diagram_ids = list(previous_state["diagrams"])
+    change_id_responses = await asyncio.gather(
+        *[
+            my_api_helper.get_diagram_changeid(int(diagram_id))
+            for diagram_id in diagram_ids
+        ]
+    )
+    change_ids, changed, removed = incremental.changed_diagram_ids(
+        previous_state, dict(zip(diagram_ids, change_id_responses)), logger
+    )
+    diagram_responses = await asyncio.gather(
+        *[my_api_helper.get_single_diagram(int(diagram_id)) for diagram_id in changed]
+    )
+    changed_diagrams = incremental.refetched_diagrams(
+        dict(zip(changed, diagram_responses)), logger
+    )
+
+    logger.info(
+        "Diagrams data downloaded, %s changed and %s removed since the last archive"
+        % (len(changed_diagrams), len(removed))
+    )
+    diagrams = incremental.merge_diagrams(
+        previous_state, changed_diagrams, removed, change_ids
+    )
+    if output_mode == "delta":
+        await in_thread(
+            archive_project.save_diagrams,
+            archive,
+            logger,
+            list(changed_diagrams.values()),
+        )
+        await in_thread(archive_project.save_removed_diagrams, archive, logger, removed)
+    else:
+        await in_thread(
+            archive_project.save_diagrams,
+            archive,
+            logger,
+            list(diagrams.values()),
+        )
+    return incremental.new_state(diagrams, change_ids, previous_state)
+
+
+async def fetch_synthesis_diagrams(my_api_helper, logger, current_team_synthesis):
+    current_team_id = int(current_team_synthesis["cteamid"])
+    synthesis_id = current_team_synthesis["id"]
+    synthesis_name = current_team_synthesis["description"]
+    synthesis_digrams_response = await my_api_helper.get_single_synthesis_diagrams(
+        teamid=current_team_id, synthesisid=synthesis_id
+    )
+    if synthesis_digrams_response.status_code != 200:
+        logger.error(
+            "Error in getting Diagram Details %s" % synthesis_digrams_response.text
+        )
+        return None
+    synthesis_and_diagrams = GeodesignHub.parse_json(synthesis_digrams_response)
+    synthesis_and_diagrams["diagrams"] = ",".join(
+        [str(diagram) for diagram in synthesis_and_diagrams["diagrams"]]
+    )
+    synthesis_and_diagrams["description"] = synthesis_name
+    # The Global_ID of the synthesis is derived from its id
+    synthesis_and_diagrams.setdefault("id", synthesis_id)
+    return synthesis_and_diagrams
+
+
+async def fetch_design_team_and_syntheses(my_api_helper, logger, design_team):
+    """Fetch one team's details and then, straight away, its syntheses"""
+    design_team_detail_response = await my_api_helper.get_all_details_for_design_team(
+        design_team["id"]
+    )
+    if design_team_detail_response.status_code != 200:
+        logger.error(
+            "Error in getting Design Team Details %s" % design_team_detail_response.text
+        )
+        return None, []
+    design_team_detail = GeodesignHub.parse_json(design_team_detail_response)
+    syntheses = await asyncio.gather(
+        *[
+            fetch_synthesis_diagrams(my_api_helper, logger, current_team_synthesis)
+            for current_team_synthesis in design_team_detail.get("synthesis", [])
+        ]
+    )
+    return design_team_detail, syntheses
+
+
+async def fetch_and_save_design_teams_and_syntheses(my_api_helper, archive, logger):
+    all_design_team_response = await my_api_helper.get_all_design_teams()
+    if all_design_team_response.status_code != 200:
+        logger.error(
+            "Error in getting Design Team data from Geodesignhub: %s"
+            % all_design_team_response.text
+        )
+        await in_thread(archive_project.save_syntheses, archive, logger, [])
+        return
+    all_design_teams = GeodesignHub.parse_json(all_design_team_response)
+    await in_thread(
+        archive_project.save_design_teams, archive, logger, all_design_teams
+    )
+    teams_and_syntheses = await asyncio.gather(
+        *[
+            fetch_design_team_and_syntheses(my_api_helper, logger, design_team)
+            for design_team in all_design_teams
+        ]
+    )
+    all_design_team_details = [
+        detail for detail, _ in teams_and_syntheses if detail is not None
+    ]
+    all_design_syntheses_and_diagrams = [
+        synthesis
+        for _, syntheses in teams_and_syntheses
+        for synthesis in syntheses
+        if synthesis is not None
+    ]
+    await in_thread(
+        archive_project.save_designs_in_design_teams,
+        archive,
+        logger,
+        all_design_team_details,
+    )
+    await in_thread(
+        archive_project.save_syntheses,
+        archive,
+        logger,
+        all_design_syntheses_and_diagrams,
+    )
+
+
+async def fetch_and_save_negotiation_logs(
+    my_api_helper, archive, logger, layout="per_session"
+):
+    negotiation_logs_response = await my_api_helper.get_project_negotiation_logs()
+    if negotiation_logs_response.status_code == 200:
+        all_negotiation_logs = GeodesignHub.parse_json(negotiation_logs_response)
+        logger.info("Negotiation Logs data downloaded")
+        await in_thread(
+            archive_project.save_negotiation_logs,
+            archive,
+            logger,
+            all_negotiation_logs,
+            layout,
+        )
+    else:
+        logger.error(
+            "Error in getting Negotiation Logs data from Geodesignhub: %s"
+            % negotiation_logs_response.text
+        )
+
+
+async def timed(name, coroutine, timings, run_journal=None):
+    start = time.perf_counter()
+    result = await coroutine
+    timings[name] = time.perf_counter() - start
+    if run_journal is not None:
+        await in_thread(run_journal.record_stage, name)
+    return result
+
+
+async def process_project(
+    project_id, c, logger, session, rate_limiter=None, response_cache=None
+):
+    """Archive one project and return its metrics report. response_cache is the
+    ResponseCache of the run."""
+    start = time.perf_counter()
+    if response_cache is None:
+        response_cache = await in_thread(archive_project.create_response_cache, c)
+    cache = response_cache.for_project() if response_cache is not None else None
+    request_metrics = metrics.RequestMetrics(project_id)
+    run_journal = await in_thread(archive_project.open_journal, project_id, c, logger)
+    my_api_helper = GeodesignHub.AsyncGeodesignHubClient(
+        url=c["service_url"],
+        project_id=project_id,
+        token=c["api_token"],
+        session=session,
+        cache=cache,
+        timeout=c["request_timeout"],
+        retry_policy=archive_project.create_retry_policy(c),
+        rate_limiter=rate_limiter,
+        metrics=request_metrics,
+        journal=run_journal,
+    )
+    spatial_export.check_spatial_format(c["spatial_format"])
+    archive = archive_project.create_archive(c, project_id, logger)
+    if c["stream_diagrams"]:
+        logger.warning("stream_diagrams is only supported without async_mode")
+
+    if c["incremental_diagrams"]:
+        previous_diagram_state = await in_thread(
+            incremental.load_diagram_state,
+            c["state_directory"],
+            project_id,
+            c["incremental_full_refresh_days"],
+            logger,
+        )
+        diagrams_stage = fetch_and_save_diagrams_incrementally(
+            my_api_helper,
+            archive,
+            logger,
+            previous_diagram_state,
+            output_mode=c["incremental_output"],
+        )
+    else:
+        diagrams_stage = fetch_and_save_diagrams(my_api_helper, archive, logger)
+
+    async def fetch_and_save_diagrams_and_geometries():
+        diagrams_result = await diagrams_stage
+        if c["spatial_format"]:
+            await in_thread(
+                archive_project.export_diagram_geometries,
+                archive,
+                logger,
+                c["spatial_format"],
+                (
+                    incremental.state_diagrams(diagrams_result)
+                    if c["incremental_diagrams"]
+                    else diagrams_result
+                ),
+            )
+        return diagrams_result
+
+    try:
+        # All stages run at the same time, syntheses are fetched as soon as the
+        # details of their team arrive
+        stage_timings = {}
+        _, _, diagram_state, _, _ = await gather_stages(
+            timed(
+                "project_details",
+                fetch_and_save_project_details(my_api_helper, archive, logger),
+                stage_timings,
+                run_journal,
+            ),
+            timed(
+                "systems",
+                fetch_and_save_systems(my_api_helper, archive, logger),
+                stage_timings,
+                run_journal,
+            ),
+            timed(
+                "diagrams",
+                fetch_and_save_diagrams_and_geometries(),
+                stage_timings,
+                run_journal,
+            ),
+            timed(
+                "design_teams_and_syntheses",
+                fetch_and_save_design_teams_and_syntheses(
+                    my_api_helper, archive, logger
+                ),
+                stage_timings,
+                run_journal,
+            ),
+            timed(
+                "negotiation_logs",
+                fetch_and_save_negotiation_logs(
+                    my_api_helper, archive, logger, c["negotiation_log_layout"]
+                ),
+                stage_timings,
+                run_journal,
+            ),
+        )
+    except Exception:
+        await in_thread(archive.abort)
+        # The journal is kept so that the next run resumes from it
+        if run_journal is not None:
+            run_journal.close()
+        raise
+    if c["incremental_diagrams"] and diagram_state is not None:
+        await in_thread(
+            archive.write_bytes,
+            "incremental.json",
+            incremental.refresh_report(diagram_state, c["incremental_output"]),
+        )
+    archive_project.log_cache_stats(project_id, cache, logger)
+    report = await in_thread(
+        archive_project.write_metrics_report,
+        archive,
+        project_id,
+        request_metrics,
+        stage_timings,
+        time.perf_counter() - start,
+        cache,
+        rate_limiter,
+    )
+    await in_thread(archive_project.close_archive, archive, report, start, logger)
+    if run_journal is not None:
+        await in_thread(run_journal.remove)
+    if c["incremental_diagrams"] and diagram_state is not None:
+        await in_thread(
+            incremental.save_diagram_state,
+            c["state_directory"],
+            project_id,
+            diagram_state,
+        )
+    return report
+
+
+async def archive_project_safely(
+    project_id,
+    c,
+    logger,
+    session,
+    project_slots,
+    rate_limiter=None,
+    response_cache=None,
+):
+    async with project_slots:
+        start = time.perf_counter()
+        report = None
+        try:
+            report = await process_project(
+                project_id, c, logger, session, rate_limiter, response_cache
+            )
+            status, error = "success", None
+        except Exception as e:
+            logger.exception("Error in archiving project %s" % project_id)
+            status, error = "failed", repr(e)
+            shutil.rmtree(Path("output", project_id), ignore_errors=True)
+        return {
+            "project_id": project_id,
+            "status": status,
+            "duration": time.perf_counter() - start,
+            "error": error,
+            "metrics": report,
+        }
+
+
+async def archive_projects(project_ids, c, logger):
+    """Archive the projects on one event loop, at most project_workers at a time,
+    sharing a connection pool limited to limit_per_host concurrent requests and
+    one rate limiter and response cache"""
+    project_slots = asyncio.Semaphore(c["project_workers"])
+    rate_limiter = archive_project.create_rate_limiter(c, c["limit_per_host"])
+    # Scanning the cache directory is blocking file I/O
+    response_cache = await in_thread(archive_project.create_response_cache, c)
+    async with GeodesignHub.create_async_session(
+        limit_per_host=c["limit_per_host"]
+    ) as session:
+        results = await asyncio.gather(
+            *[
+                archive_project_safely(
+                    project_id,
+                    c,
+                    logger,
+                    session,
+                    project_slots,
+                    rate_limiter,
+                    response_cache,
+                )
+                for project_id in project_ids
+            ]
+        )
+    archive_project.log_rate_limiter_stats("all projects", rate_limiter, logger)
+    return results
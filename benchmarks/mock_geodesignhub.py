@@ -0,0 +1,328 @@
+"""A local stand-in for the Geodesignhub API serving a synthetic project.
+
+The project has a configurable number of systems, diagrams with polygon
+geometries, design teams with syntheses and negotiation sessions, generated
+from a fixed seed so every run serves the same data. Latency, server errors
+and 429 throttling can be injected to see how the archiver copes. The server
+counts the requests it answered and the bytes it sent.
+
+Run it on its own with python benchmarks/mock_geodesignhub.py --port 8765 and
+point service_url at http://127.0.0.1:8765/api/v1/."""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class SyntheticProject:
+    """The data of one synthetic project, generated up front so the server
+    does not slow the benchmark down"""
+
+    def __init__(
+        self,
+        project_id,
+        systems=10,
+        diagrams=200,
+        features_per_diagram=5,
+        vertices_per_feature=20,
+        teams=5,
+        syntheses_per_team=4,
+        negotiation_sessions=3,
+        moves_per_session=50,
+        seed=0,
+    ):
+        rng = random.Random(seed)
+        self.project_id = project_id
+        self.systems = [
+            {"id": system_id, "name": f"System {system_id}", "syscolor": "#3388ff"}
+            for system_id in range(1, systems + 1)
+        ]
+        self.diagrams = {
+            diagram_id: {
+                "id": diagram_id,
+                "description": f"Diagram {diagram_id}",
+                "sysid": 1 + diagram_id % systems,
+                "projectorpolicy": "project" if diagram_id % 2 else "policy",
+                "fundingtype": "pu",
+                "geojson": self._feature_collection(
+                    rng, features_per_diagram, vertices_per_feature
+                ),
+            }
+            for diagram_id in range(1, diagrams + 1)
+        }
+        self.teams = [
+            {"id": team_id, "title": f"Team {team_id}"}
+            for team_id in range(1, teams + 1)
+        ]
+        self.syntheses = {
+            team["id"]: [
+                {
+                    "id": f"{team['id']:08d}{synthesis:08d}",
+                    "cteamid": team["id"],
+                    "description": f"Synthesis {synthesis} of team {team['id']}",
+                }
+                for synthesis in range(syntheses_per_team)
+            ]
+            for team in self.teams
+        }
+        diagram_ids = list(self.diagrams) or [0]
+        self.synthesis_diagrams = {
+            synthesis["id"]: sorted(rng.sample(diagram_ids, min(len(diagram_ids), 20)))
+            for team_syntheses in self.syntheses.values()
+            for synthesis in team_syntheses
+        }
+        self.negotiation_logs = {
+            "all_negotiations": [
+                {
+                    "session_id": f"session{session}",
+                    "title": f"Negotiation {session}",
+                    "moves": [
+                        {
+                            "diagram": rng.choice(diagram_ids),
+                            "move": rng.choice(["add", "remove"]),
+                            "timestamp": "2024-01-01T%02d:%02d:00Z"
+                            % (move // 60 % 24, move % 60),
+                        }
+                        for move in range(moves_per_session)
+                    ],
+                }
+                for session in range(negotiation_sessions)
+            ]
+        }
+
+    @staticmethod
+    def _feature_collection(rng, features, vertices):
+        collection = {"type": "FeatureCollection", "features": []}
+        for _ in range(features):
+            x, y = rng.uniform(-180, 170), rng.uniform(-80, 70)
+            ring = [
+                [x + rng.uniform(0, 1), y + rng.uniform(0, 1)]
+                for _ in range(max(vertices, 3))
+            ]
+            ring.append(ring[0])
+            collection["features"].append(
+                {
+                    "type": "Feature",
+                    "properties": {"areatype": "project"},
+                    "geometry": {"type": "Polygon", "coordinates": [ring]},
+                }
+            )
+        return collection
+
+    def payload(self, parts):
+        """The object served for the path parts after projects/<project_id>/,
+        or None for an unknown path"""
+        if not parts:
+            return {"id": self.project_id, "name": "Benchmark", "description": ""}
+        if parts == ["systems"]:
+            return self.systems
+        if parts[0] == "systems" and len(parts) == 2:
+            return self.systems[int(parts[1]) - 1]
+        if parts == ["diagrams", "all"]:
+            return list(self.diagrams.values())
+        if parts[0] == "diagrams" and len(parts) >= 2:
+            diagram = self.diagrams.get(int(parts[1]))
+            if diagram is None:
+                return None
+            if parts[2:] == ["changeid"]:
+                return {"changeid": f"change{diagram['id']}"}
+            return diagram
+        if parts == ["cteams"]:
+            return self.teams
+        if parts[0] == "cteams" and len(parts) == 2:
+            team_id = int(parts[1])
+            return {"id": team_id, "synthesis": self.syntheses.get(team_id, [])}
+        if parts[0] == "cteams" and parts[3:] == ["diagrams"]:
+            return {"id": parts[2], "diagrams": self.synthesis_diagrams[parts[2]]}
+        if parts == ["negotiation_logs"]:
+            return self.negotiation_logs
+        return None
+
+
+class MockGeodesignHub:
+    """Serves a SyntheticProject on 127.0.0.1 from a background thread.
+
+    latency is added to every response, error_rate is the share of requests
+    answered with 500 and throttle_rate the share answered with 429 and a
+    Retry-After header."""
+
+    def __init__(
+        self, project, port=0, latency=0.0, error_rate=0.0, throttle_rate=0.0, seed=0
+    ):
+        self.project = project
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self._rng = random.Random(seed)
+        self._encoded = {}
+        self._lock = threading.Lock()
+        self.reset_stats()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%s/api/v1/" % self.server.server_address[1]
+
+    def reset_stats(self):
+        with self._lock:
+            self.requests = 0
+            self.bytes_sent = 0
+            self.status_counts = Counter()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "bytes_sent": self.bytes_sent,
+                "status_counts": dict(self.status_counts),
+            }
+
+    def _record(self, status, size):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += size
+            self.status_counts[status] += 1
+
+    def _injected_status(self):
+        with self._lock:
+            draw = self._rng.random()
+        if draw < self.error_rate:
+            return 500
+        if draw < self.error_rate + self.throttle_rate:
+            return 429
+        return None
+
+    def _encode(self, path, parts):
+        if path not in self._encoded:
+            payload = self.project.payload(parts)
+            if payload is None:
+                return None
+            body = json.dumps(payload).encode()
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            self._encoded[path] = (body, etag)
+        return self._encoded[path]
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _send(self, status, body=b"", headers=()):
+                self.send_response(status)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                mock._record(status, len(body))
+
+            def do_GET(self):
+                if mock.latency:
+                    time.sleep(mock.latency)
+                injected = mock._injected_status()
+                if injected == 429:
+                    return self._send(429, b"Throttled", [("Retry-After", "0.1")])
+                if injected == 500:
+                    return self._send(500, b"Injected error")
+                parts = [part for part in self.path.split("/") if part]
+                # api/v1/projects/<project_id>/...
+                if parts[:3] != ["api", "v1", "projects"] or len(parts) < 4:
+                    return self._send(404, b"Not found")
+                try:
+                    encoded = mock._encode(self.path, parts[4:])
+                except (ValueError, KeyError, IndexError):
+                    encoded = None
+                if encoded is None:
+                    return self._send(404, b"Not found")
+                body, etag = encoded
+                if self.headers.get("If-None-Match") == etag:
+                    return self._send(304, headers=[("ETag", etag)])
+                self._send(
+                    200,
+                    body,
+                    [("Content-Type", "application/json"), ("ETag", etag)],
+                )
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def add_project_arguments(parser):
+    """Command line options describing the synthetic project and the server"""
+    parser.add_argument("--project-id", default="BENCHMARK0000000")
+    parser.add_argument("--systems", type=int, default=10)
+    parser.add_argument("--diagrams", type=int, default=200)
+    parser.add_argument("--features-per-diagram", type=int, default=5)
+    parser.add_argument("--vertices-per-feature", type=int, default=20)
+    parser.add_argument("--teams", type=int, default=5)
+    parser.add_argument("--syntheses-per-team", type=int, default=4)
+    parser.add_argument("--negotiation-sessions", type=int, default=3)
+    parser.add_argument("--moves-per-session", type=int, default=50)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds added to every response"
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def create_mock_server(args, port=0):
+    project = SyntheticProject(
+        args.project_id,
+        systems=args.systems,
+        diagrams=args.diagrams,
+        features_per_diagram=args.features_per_diagram,
+        vertices_per_feature=args.vertices_per_feature,
+        teams=args.teams,
+        syntheses_per_team=args.syntheses_per_team,
+        negotiation_sessions=args.negotiation_sessions,
+        moves_per_session=args.moves_per_session,
+        seed=args.seed,
+    )
+    return MockGeodesignHub(
+        project,
+        port=port,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_project_arguments(parser)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    server = create_mock_server(args, port=args.port).start()
+    print("Serving project %s at %s" % (args.project_id, server.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,158 @@
+"""Benchmark archive_project.process_project against the local mock server.
+
+Every run archives the synthetic project end to end in a fresh child process
+and working directory, and records the wall time, the number of requests the
+server answered, the bytes it sent, the peak RSS of the child and the size of
+the zip. Options of config.json are passed with --config, e.g.
+
+    python benchmarks/run_benchmark.py --diagrams 2000 --latency 0.02 \\
+        --config '{"max_workers": 8}' --repeat 3 --output results.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import archive_project
+import async_archive
+import GeodesignHub
+from mock_geodesignhub import add_project_arguments, create_mock_server
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+async def process_project_async(project_id, c, logger):
+    async with GeodesignHub.create_async_session(
+        limit_per_host=c["limit_per_host"]
+    ) as session:
+        await async_archive.process_project(project_id, c, logger, session)
+
+
+def run_once(project_id, c, working_directory, results):
+    """Archive the project in working_directory, runs in a child process"""
+    os.chdir(working_directory)
+    logger = logging.getLogger("benchmark")
+    logger.addHandler(logging.FileHandler("benchmark.log"))
+    logger.setLevel(logging.INFO)
+    start = time.perf_counter()
+    if c["async_mode"]:
+        asyncio.run(process_project_async(project_id, c, logger))
+    else:
+        archive_project.process_project(project_id, c, logger)
+    results.put(
+        {
+            "wall_time": time.perf_counter() - start,
+            "peak_rss_mb": peak_rss_mb(),
+            "archive_bytes": Path("output", f"{project_id}.zip").stat().st_size,
+        }
+    )
+
+
+def build_config(service_url, project_id, overrides):
+    c = {
+        **archive_project.OPTIONAL_CONFIG_DEFAULTS,
+        "service_url": service_url,
+        "project_ids": [project_id],
+        "api_token": "benchmark",
+        **overrides,
+    }
+    for key, value in overrides.items():
+        validator = archive_project.OPTIONAL_CONFIG_VALIDATORS.get(key)
+        if validator is None or not validator(value):
+            raise ValueError(f"Invalid config option {key}: {value!r}")
+    return c
+
+
+def run_benchmark(server, project_id, c, repeat):
+    # The child is spawned rather than forked, a forked child would inherit the
+    # memory of the mock server and its synthetic project, and its peak RSS
+    # would include them
+    context = multiprocessing.get_context("spawn")
+    runs = []
+    for _ in range(repeat):
+        server.reset_stats()
+        results = context.Queue()
+        with tempfile.TemporaryDirectory() as working_directory:
+            child = context.Process(
+                target=run_once, args=(project_id, c, working_directory, results)
+            )
+            child.start()
+            child.join()
+            if child.exitcode != 0:
+                log_path = Path(working_directory, "benchmark.log")
+                raise RuntimeError(
+                    "Benchmark run failed:\n%s"
+                    % (log_path.read_text() if log_path.exists() else "")
+                )
+            run = results.get()
+        run.update(server.stats())
+        runs.append(run)
+    return runs
+
+
+def summarize(runs):
+    return {
+        key: statistics.median(run[key] for run in runs)
+        for key in ["wall_time", "requests", "bytes_sent", "peak_rss_mb"]
+        if runs[0][key] is not None
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_project_arguments(parser)
+    parser.add_argument(
+        "--config",
+        default="{}",
+        help="JSON object of config.json options, e.g. '{\"max_workers\": 4}'",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    with create_mock_server(args) as server:
+        c = build_config(server.url, args.project_id, json.loads(args.config))
+        runs = run_benchmark(server, args.project_id, c, args.repeat)
+
+    for number, run in enumerate(runs, 1):
+        print(
+            "run %s: %.2f s, %s requests, %.1f MB received, peak RSS %s MB, archive %.1f MB"
+            % (
+                number,
+                run["wall_time"],
+                run["requests"],
+                run["bytes_sent"] / (1024 * 1024),
+                "%.0f" % run["peak_rss_mb"] if run["peak_rss_mb"] else "n/a",
+                run["archive_bytes"] / (1024 * 1024),
+            )
+        )
+    summary = summarize(runs)
+    print("median: %s" % json.dumps(summary))
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(
+                {"arguments": vars(args), "runs": runs, "median": summary},
+                output_file,
+                indent=2,
+            )
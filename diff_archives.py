@@ -0,0 +1,266 @@
+"""Report the rows added, changed and removed between two project archives.
+
+Tables whose member has the same CRC-32 and size in both zips are unchanged
+and are not read at all. The others are streamed row by row, keeping only a
+short hash of every row under its key: the Global_ID, or the id the server
+gave the record, so memory use does not grow with the size of the rows. Rows
+of tables without a key, such as negotiation moves, are keyed by their
+content, so they are only ever added or removed.
+
+With --delta the added and changed rows of the newer archive, and the keys of
+the removed rows, are written to a zip of csv files for downstream sync.
+
+    python diff_archives.py output/old.zip output/new.zip --delta delta.zip
+"""
+
+import argparse
+import csv
+import hashlib
+import io
+import json
+import logging
+import sys
+import zipfile
+
+import table_formats
+import verify_archives
+import zip_compression
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is only needed for Parquet archives
+    pq = None
+
+# Columns identifying the rows of each table, tables not listed have no key
+TABLE_KEYS = {
+    "project": "id",
+    "systems": "Global_ID",
+    "diagrams": "Global_ID",
+    "diagrams_removed": "id",
+    "design_teams": "id",
+    "designs_design_teams": "id",
+    "design_syntheses": "Global_ID",
+    "negotiation_logs": "session_id",
+}
+BATCH_SIZE = 10000
+
+
+def _row_hash(values):
+    row_hash = hashlib.blake2b(digest_size=16)
+    for value in values:
+        row_hash.update(value.encode("utf-8"))
+        row_hash.update(b"\x1f")
+    return row_hash.digest()
+
+
+def _text(value):
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def iter_rows(zip_file, info):
+    """The header and then the rows of a table member, as lists of text. The
+    row index written to csv files is left out."""
+    _, extension = verify_archives.table_name(info.filename)
+    with zip_compression.open_member(zip_file, info) as member:
+        if extension == "csv":
+            csv.field_size_limit(sys.maxsize)
+            reader = csv.reader(io.TextIOWrapper(member, encoding="utf-8", newline=""))
+            header = next(reader, [])
+            # An unnamed first column is the row index
+            skip = 1 if header[:1] == [""] else 0
+            yield header[skip:]
+            for row in reader:
+                yield row[skip:]
+        else:
+            parquet_file = pq.ParquetFile(member)
+            columns = parquet_file.schema_arrow.names
+            yield columns
+            for batch in parquet_file.iter_batches(batch_size=BATCH_SIZE):
+                for row in batch.to_pylist():
+                    yield [_text(row[column]) for column in columns]
+
+
+def _keyed_rows(table, header, rows):
+    """(key, row hash, row) for the rows of a table"""
+    key_column = TABLE_KEYS.get(table)
+    key_index = header.index(key_column) if key_column in header else None
+    seen = {}
+    for row in rows:
+        row_hash = _row_hash(row)
+        if key_index is not None:
+            key = row[key_index]
+        else:
+            # Identical rows of a keyless table are told apart by a counter
+            occurrence = seen.get(row_hash, 0)
+            seen[row_hash] = occurrence + 1
+            key = "%s:%s" % (row_hash.hex(), occurrence)
+        yield key, row_hash, row
+
+
+def keyed_rows(zip_file, info, table):
+    rows = iter_rows(zip_file, info)
+    header = next(rows)
+    return header, _keyed_rows(table, header, rows)
+
+
+def row_hashes(zip_file, info, table):
+    _, rows = keyed_rows(zip_file, info, table)
+    return {key: row_hash for key, row_hash, _ in rows}
+
+
+def _table_members(zip_file):
+    members = {}
+    for info in zip_file.infolist():
+        table, _ = verify_archives.table_name(info.filename)
+        if table is not None:
+            members[table] = info
+    return members
+
+
+def diff_table(old_zip, new_zip, table, old_info, new_info):
+    if old_info is None:
+        new_keys = list(row_hashes(new_zip, new_info, table))
+        return {"status": "added", "added": new_keys, "changed": [], "removed": []}
+    if new_info is None:
+        old_keys = list(row_hashes(old_zip, old_info, table))
+        return {"status": "removed", "added": [], "changed": [], "removed": old_keys}
+    if (old_info.CRC, old_info.file_size) == (new_info.CRC, new_info.file_size):
+        return {"status": "unchanged", "added": [], "changed": [], "removed": []}
+    old_hashes = row_hashes(old_zip, old_info, table)
+    added, changed = [], []
+    _, new_rows = keyed_rows(new_zip, new_info, table)
+    for key, row_hash, _ in new_rows:
+        old_hash = old_hashes.pop(key, None)
+        if old_hash is None:
+            added.append(key)
+        elif old_hash != row_hash:
+            changed.append(key)
+    removed = list(old_hashes)
+    status = "changed" if added or changed or removed else "unchanged"
+    return {"status": status, "added": added, "changed": changed, "removed": removed}
+
+
+def diff_archives(old_path, new_path):
+    """The differences between two archives of the same project"""
+    with zipfile.ZipFile(old_path) as old_zip, zipfile.ZipFile(new_path) as new_zip:
+        old_tables = _table_members(old_zip)
+        new_tables = _table_members(new_zip)
+        tables = {
+            table: diff_table(
+                old_zip, new_zip, table, old_tables.get(table), new_tables.get(table)
+            )
+            for table in sorted(old_tables.keys() | new_tables.keys())
+        }
+        old_files = {
+            info.filename: info
+            for info in old_zip.infolist()
+            if verify_archives.table_name(info.filename)[0] is None
+        }
+        new_files = {
+            info.filename: info
+            for info in new_zip.infolist()
+            if verify_archives.table_name(info.filename)[0] is None
+        }
+    files = {}
+    for name in sorted(old_files.keys() | new_files.keys()):
+        if name not in old_files:
+            files[name] = "added"
+        elif name not in new_files:
+            files[name] = "removed"
+        elif (old_files[name].CRC, old_files[name].file_size) == (
+            new_files[name].CRC,
+            new_files[name].file_size,
+        ):
+            files[name] = "unchanged"
+        else:
+            files[name] = "changed"
+    return {
+        "old": str(old_path),
+        "new": str(new_path),
+        "tables": tables,
+        "files": files,
+    }
+
+
+def write_delta(new_path, report, delta_path):
+    """Write the added and changed rows of every table of the newer archive,
+    and removed.csv with the keys of the removed rows"""
+    with zipfile.ZipFile(new_path) as new_zip, zipfile.ZipFile(
+        delta_path, "w", compression=zipfile.ZIP_DEFLATED
+    ) as delta_zip:
+        new_tables = _table_members(new_zip)
+        for table, table_report in report["tables"].items():
+            wanted = set(table_report["added"]) | set(table_report["changed"])
+            if not wanted:
+                continue
+            header, rows = keyed_rows(new_zip, new_tables[table], table)
+            with delta_zip.open(table_formats.file_name(table, "csv"), "w") as member:
+                text = io.TextIOWrapper(member, encoding="utf-8", newline="")
+                writer = csv.writer(text)
+                writer.writerow(header)
+                for key, _, row in rows:
+                    if key in wanted:
+                        writer.writerow(row)
+                text.flush()
+                text.detach()
+        with delta_zip.open("removed.csv", "w") as member:
+            text = io.TextIOWrapper(member, encoding="utf-8", newline="")
+            writer = csv.writer(text)
+            writer.writerow(["table", "key"])
+            for table, table_report in report["tables"].items():
+                for key in table_report["removed"]:
+                    writer.writerow([table, key])
+            text.flush()
+            text.detach()
+
+
+def summarize(report):
+    return {
+        table: {
+            "status": table_report["status"],
+            "added": len(table_report["added"]),
+            "changed": len(table_report["changed"]),
+            "removed": len(table_report["removed"]),
+        }
+        for table, table_report in report["tables"].items()
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("old", help="the earlier archive")
+    parser.add_argument("new", help="the later archive")
+    parser.add_argument(
+        "--report", help="write the keys of all rows that differ to this JSON file"
+    )
+    parser.add_argument("--delta", help="write the added and changed rows to this zip")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s"
+    )
+    logger = logging.getLogger("diff_archives")
+    report = diff_archives(args.old, args.new)
+    for table, counts in summarize(report).items():
+        logger.info(
+            "%s: %s, %s added, %s changed, %s removed"
+            % (
+                table,
+                counts["status"],
+                counts["added"],
+                counts["changed"],
+                counts["removed"],
+            )
+        )
+    for name, status in report["files"].items():
+        logger.info("%s: %s" % (name, status))
+    if args.report:
+        with open(args.report, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+    if args.delta:
+        write_delta(args.new, report, args.delta)
+        logger.info("Delta written to %s" % args.delta)
@@ -0,0 +1,223 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# Response headers kept with each entry, the validators are sent back to the
+# server when the entry is revalidated
+STORED_HEADERS = ["Content-Type", "ETag", "Last-Modified"]
+
+
+class CacheEntry:
+    def __init__(self, cache, key, metadata, content):
+        self.cache = cache
+        self.key = key
+        self.metadata = metadata
+        # The body is read with the metadata, so an entry that is evicted while
+        # it is being revalidated can still be served
+        self.content = content
+
+    @property
+    def headers(self):
+        return CaseInsensitiveDict(self.metadata["headers"])
+
+    def is_fresh(self):
+        return time.time() - self.metadata["stored_at"] < self.cache.ttl
+
+    def revalidation_headers(self):
+        headers = {}
+        if "ETag" in self.headers:
+            headers["If-None-Match"] = self.headers["ETag"]
+        if "Last-Modified" in self.headers:
+            headers["If-Modified-Since"] = self.headers["Last-Modified"]
+        return headers
+
+    def to_response(self):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = self.content
+        response.headers = self.headers
+        response.url = self.metadata["url"]
+        response.encoding = "utf-8"
+        return response
+
+
+class ResponseCache:
+    """On-disk cache of successful GET responses, keyed by URL and token.
+
+    Entries younger than ttl seconds are served without contacting the server,
+    older entries are revalidated with If-None-Match / If-Modified-Since and
+    reused if the server answers 304 Not Modified. When the bodies grow beyond
+    max_bytes the least recently used entries are evicted."""
+
+    def __init__(self, directory, ttl: float = 0, max_bytes: int = 1024**3):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> [size, last used], the last use is kept as the body's mtime so
+        # that it survives between runs
+        self._index = {}
+        for body_path in self.directory.glob("*.body"):
+            stat = body_path.stat()
+            self._index[body_path.stem] = [stat.st_size, stat.st_mtime]
+
+    @staticmethod
+    def make_key(url, scope):
+        # Only a hash of the token is used, it is never written to disk
+        scope_hash = hashlib.sha256(scope.encode("utf-8")).hexdigest()
+        return hashlib.sha256(f"{scope_hash}\0{url}".encode("utf-8")).hexdigest()
+
+    def body_path(self, key):
+        return self.directory / f"{key}.body"
+
+    def metadata_path(self, key):
+        return self.directory / f"{key}.json"
+
+    def get(self, url, scope):
+        key = self.make_key(url, scope)
+        try:
+            metadata = json.loads(self.metadata_path(key).read_text())
+            content = self.body_path(key).read_bytes()
+        except (FileNotFoundError, ValueError):
+            return None
+        return CacheEntry(self, key, metadata, content)
+
+    def put(self, url, scope, headers, content):
+        metadata = {
+            "url": url,
+            "stored_at": time.time(),
+            "headers": {
+                name: headers[name] for name in STORED_HEADERS if name in headers
+            },
+        }
+        self._write(self.make_key(url, scope), metadata, content)
+
+    def _write(self, key, metadata, content):
+        # Write to temporary files first so that a concurrent reader never sees
+        # a partial entry
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        body_tmp = self.directory / f"{key}.body{suffix}"
+        metadata_tmp = self.directory / f"{key}.json{suffix}"
+        body_tmp.write_bytes(content)
+        metadata_tmp.write_text(json.dumps(metadata))
+        os.replace(body_tmp, self.body_path(key))
+        os.replace(metadata_tmp, self.metadata_path(key))
+        with self._lock:
+            self._index[key] = [len(content), time.time()]
+            self._evict()
+
+    def refresh(self, entry):
+        """Restart the TTL of an entry the server confirmed is unchanged"""
+        entry.metadata["stored_at"] = time.time()
+        with self._lock:
+            evicted = entry.key not in self._index
+        if evicted:
+            self._write(entry.key, entry.metadata, entry.content)
+        else:
+            self.metadata_path(entry.key).write_text(json.dumps(entry.metadata))
+
+    def record_hit(self, entry):
+        self._touch(entry.key)
+        with self._lock:
+            self.hits += 1
+
+    def record_revalidated(self, entry):
+        self.refresh(entry)
+        self._touch(entry.key)
+        with self._lock:
+            self.revalidated += 1
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def for_project(self):
+        """A view of the cache that counts the hits and misses of one project"""
+        return ProjectCache(self)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "revalidated": self.revalidated,
+                "misses": self.misses,
+                "entries": len(self._index),
+                "bytes": sum(size for size, _ in self._index.values()),
+            }
+
+    def _touch(self, key):
+        now = time.time()
+        try:
+            os.utime(self.body_path(key), (now, now))
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if key in self._index:
+                self._index[key][1] = now
+
+    def _evict(self):
+        total = sum(size for size, _ in self._index.values())
+        if total <= self.max_bytes:
+            return
+        for key, (size, _) in sorted(self._index.items(), key=lambda item: item[1][1]):
+            if total <= self.max_bytes:
+                break
+            for path in [self.body_path(key), self.metadata_path(key)]:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+            del self._index[key]
+            total -= size
+
+
+class ProjectCache:
+    """One project's view of a ResponseCache shared by the whole run. Entries
+    and their size are those of the shared cache, the hits, revalidations and
+    misses are counted for the project alone."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, url, scope):
+        return self.cache.get(url, scope)
+
+    def put(self, url, scope, headers, content):
+        self.cache.put(url, scope, headers, content)
+
+    def record_hit(self, entry):
+        self.cache.record_hit(entry)
+        with self._lock:
+            self.hits += 1
+
+    def record_revalidated(self, entry):
+        self.cache.record_revalidated(entry)
+        with self._lock:
+            self.revalidated += 1
+
+    def record_miss(self):
+        self.cache.record_miss()
+        with self._lock:
+            self.misses += 1
+
+    def stats(self):
+        stats = self.cache.stats()
+        with self._lock:
+            stats.update(
+                hits=self.hits, revalidated=self.revalidated, misses=self.misses
+            )
+        return stats
@@ -0,0 +1,180 @@
+"""State kept between runs for incremental diagram archiving.
+
+For every diagram the state holds the change ID returned by
+GeodesignHubClient.get_diagram_changeid and the diagram payload from the last
+archive. A later run asks the server only for change IDs and downloads the
+diagrams whose change ID moved with get_single_diagram.
+
+There is no endpoint listing diagram IDs without their contents, so diagrams
+added since the last full download are picked up by the next full refresh,
+which happens when there is no state or the state is older than
+full_refresh_days. Until then they are missing from the archive, which
+records in incremental.json how old its last full refresh is, and every run
+logs a warning naming that window."""
+
+import json
+import os
+import time
+from pathlib import Path
+
+import GeodesignHub
+
+
+def state_path(state_directory, project_id):
+    return Path(state_directory, project_id, "diagrams.json")
+
+
+def load_diagram_state(state_directory, project_id, full_refresh_days, logger):
+    """Return the saved state, or None if a full download is needed"""
+    path = state_path(state_directory, project_id)
+    try:
+        with open(path) as state_file:
+            state = json.load(state_file)
+    except FileNotFoundError:
+        logger.info("No incremental state for project %s" % project_id)
+        return None
+    except ValueError as e:
+        logger.error("Incremental state file %s is corrupt: %s" % (path, e))
+        return None
+    age_days = (time.time() - state["full_refresh_at"]) / 86400
+    if age_days >= full_refresh_days:
+        logger.info(
+            "Incremental state for project %s is %.1f days old, doing a full refresh"
+            % (project_id, age_days)
+        )
+        return None
+    # The change IDs only cover the diagrams known at the last full refresh
+    logger.warning(
+        "Diagrams created in project %s since the last full refresh at %s (%.1f"
+        " days ago) are not archived until the next one in %.1f days"
+        % (
+            project_id,
+            time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(state["full_refresh_at"])),
+            age_days,
+            full_refresh_days - age_days,
+        )
+    )
+    return state
+
+
+def save_diagram_state(state_directory, project_id, state):
+    path = state_path(state_directory, project_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".json.tmp")
+    with open(tmp_path, "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(tmp_path, path)
+
+
+def new_state(diagrams, change_ids, previous_state=None):
+    """Build the state for this run. diagrams and change_ids are keyed by the
+    diagram ID as a string, the order of diagrams is kept."""
+    return {
+        "full_refresh_at": (
+            previous_state["full_refresh_at"] if previous_state else time.time()
+        ),
+        "updated_at": time.time(),
+        "diagrams": {
+            diagram_id: {"change_id": change_ids[diagram_id], "diagram": diagram}
+            for diagram_id, diagram in diagrams.items()
+        },
+    }
+
+
+def refresh_report(state, output_mode):
+    """incremental.json of an archive: when the diagrams were last downloaded in
+    full. Diagrams created since then are not in the archive yet."""
+    now = time.time()
+    return json.dumps(
+        {
+            "output_mode": output_mode,
+            "full_refresh_at": time.strftime(
+                "%Y-%m-%dT%H:%M:%SZ", time.gmtime(state["full_refresh_at"])
+            ),
+            "full_refresh_age_days": round((now - state["full_refresh_at"]) / 86400, 2),
+            "diagrams": len(state["diagrams"]),
+        },
+        indent=2,
+    ).encode("utf-8")
+
+
+def state_diagrams(state):
+    """The diagram payloads held in a state, in order"""
+    if state is None:
+        return None
+    return [saved["diagram"] for saved in state["diagrams"].values()]
+
+
+def initial_change_ids(change_id_responses, logger):
+    """The change IDs of a full download. change_id_responses maps diagram ID
+    to the get_diagram_changeid response."""
+    change_ids = {}
+    for diagram_id, response in change_id_responses.items():
+        if response.status_code != 200:
+            logger.error(
+                "Error in getting change id for diagram %s: %s"
+                % (diagram_id, response.text)
+            )
+            # Without a change id the diagram is downloaded again next run
+            change_ids[diagram_id] = None
+            continue
+        change_ids[diagram_id] = GeodesignHub.parse_json(response)
+    return change_ids
+
+
+def changed_diagram_ids(previous_state, change_id_responses, logger):
+    """Compare the current change IDs with the saved ones.
+
+    change_id_responses maps diagram ID to the get_diagram_changeid response.
+    Returns (change_ids, changed, removed), diagrams whose change ID could not
+    be fetched are treated as unchanged so they are not dropped."""
+    change_ids = {}
+    changed = []
+    removed = []
+    for diagram_id, response in change_id_responses.items():
+        previous_change_id = previous_state["diagrams"][diagram_id]["change_id"]
+        if response.status_code == 404:
+            removed.append(diagram_id)
+            continue
+        if response.status_code != 200:
+            logger.error(
+                "Error in getting change id for diagram %s: %s"
+                % (diagram_id, response.text)
+            )
+            change_ids[diagram_id] = previous_change_id
+            continue
+        change_ids[diagram_id] = GeodesignHub.parse_json(response)
+        if change_ids[diagram_id] != previous_change_id:
+            changed.append(diagram_id)
+    return change_ids, changed, removed
+
+
+def refetched_diagrams(diagram_responses, logger):
+    """The payloads of the changed diagrams, keyed by diagram ID.
+    diagram_responses maps diagram ID to the get_single_diagram response, the
+    diagrams that could not be fetched are left out."""
+    changed_diagrams = {}
+    for diagram_id, diagram_response in diagram_responses.items():
+        if diagram_response.status_code != 200:
+            logger.error(
+                "Error in getting Diagram %s: %s" % (diagram_id, diagram_response.text)
+            )
+            continue
+        changed_diagrams[diagram_id] = GeodesignHub.parse_json(diagram_response)
+    return changed_diagrams
+
+
+def merge_diagrams(previous_state, changed_diagrams, removed, change_ids):
+    """Apply the refetched diagrams to the previous ones, keeping their order.
+    A diagram that could not be refetched keeps its previous payload and
+    change ID so that it is retried on the next run."""
+    diagrams = {}
+    for diagram_id, saved in previous_state["diagrams"].items():
+        if diagram_id in removed:
+            continue
+        if diagram_id in changed_diagrams:
+            diagrams[diagram_id] = changed_diagrams[diagram_id]
+        else:
+            diagrams[diagram_id] = saved["diagram"]
+            change_ids[diagram_id] = saved["change_id"]
+    return diagrams
@@ -0,0 +1,225 @@
+"""SQLite queue of project archive jobs.
+
+Jobs are submitted with a priority and claimed by workers, highest priority
+first and oldest first within a priority. A claimed job is leased to its
+worker for lease_seconds and the worker renews the lease while it works; when
+a worker dies its lease runs out and the job is queued again. A failed job is
+retried after a backoff until it has been attempted max_attempts times. At
+most max_jobs_per_host jobs run at the same time against any one server.
+
+The database is opened in WAL mode and every claim is a single IMMEDIATE
+transaction, so any number of worker processes can share it."""
+
+import json
+import sqlite3
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = "queued", "running", "succeeded", "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    project_id TEXT NOT NULL,
+    service_url TEXT,
+    host TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    submitted_at REAL NOT NULL,
+    available_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    lease_expires_at REAL,
+    worker TEXT,
+    duration REAL,
+    error TEXT,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_claim
+    ON jobs (status, priority DESC, id);
+CREATE INDEX IF NOT EXISTS jobs_host ON jobs (status, host);
+"""
+
+
+class JobQueue:
+    def __init__(self, path, default_service_url=None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.default_service_url = default_service_url
+        # Transactions are started explicitly
+        self.connection = sqlite3.connect(
+            str(self.path), timeout=60, isolation_level=None
+        )
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def _transaction(self):
+        return _Transaction(self.connection)
+
+    def submit(self, project_ids, priority=0, service_url=None, max_attempts=3):
+        """Queue a job per project, projects that already have a queued or
+        running job are skipped. Returns the ids of the new jobs."""
+        service_url = service_url or self.default_service_url
+        host = urlparse(service_url or "").netloc
+        now = time.time()
+        job_ids = []
+        with self._transaction() as cursor:
+            for project_id in project_ids:
+                pending = cursor.execute(
+                    "SELECT 1 FROM jobs WHERE project_id = ? AND host = ?"
+                    " AND status IN (?, ?)",
+                    (project_id, host, QUEUED, RUNNING),
+                ).fetchone()
+                if pending:
+                    continue
+                cursor.execute(
+                    "INSERT INTO jobs (project_id, service_url, host, priority,"
+                    " status, max_attempts, submitted_at, available_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        project_id,
+                        service_url,
+                        host,
+                        priority,
+                        QUEUED,
+                        max_attempts,
+                        now,
+                        now,
+                    ),
+                )
+                job_ids.append(cursor.lastrowid)
+        return job_ids
+
+    def _expire_leases(self, cursor, now):
+        """Queue the jobs of workers that stopped renewing their lease again"""
+        cursor.execute(
+            "UPDATE jobs SET status = CASE WHEN attempts >= max_attempts"
+            " THEN ? ELSE ? END, error = 'lease expired', worker = NULL,"
+            " finished_at = CASE WHEN attempts >= max_attempts THEN ? END"
+            " WHERE status = ? AND lease_expires_at < ?",
+            (FAILED, QUEUED, now, RUNNING, now),
+        )
+
+    def claim(self, worker, lease_seconds=900, max_jobs_per_host=4):
+        """Lease the next job to worker, None when no job can run now"""
+        now = time.time()
+        with self._transaction() as cursor:
+            self._expire_leases(cursor, now)
+            job = cursor.execute(
+                "SELECT * FROM jobs AS job WHERE status = ? AND available_at <= ?"
+                " AND (SELECT COUNT(*) FROM jobs AS running"
+                " WHERE running.status = ? AND running.host = job.host) < ?"
+                " ORDER BY priority DESC, id LIMIT 1",
+                (QUEUED, now, RUNNING, max_jobs_per_host),
+            ).fetchone()
+            if job is None:
+                return None
+            cursor.execute(
+                "UPDATE jobs SET status = ?, worker = ?, attempts = attempts + 1,"
+                " started_at = ?, lease_expires_at = ? WHERE id = ?",
+                (RUNNING, worker, now, now + lease_seconds, job["id"]),
+            )
+        return dict(job, attempts=job["attempts"] + 1)
+
+    def renew(self, job_id, worker, lease_seconds=900):
+        """Extend the lease, False if the job is no longer leased to worker"""
+        with self._transaction() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET lease_expires_at = ?"
+                " WHERE id = ? AND worker = ? AND status = ?",
+                (time.time() + lease_seconds, job_id, worker, RUNNING),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, duration, result=None):
+        with self._transaction() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, duration = ?,"
+                " result = ?, error = NULL, lease_expires_at = NULL"
+                " WHERE id = ? AND worker = ?",
+                (
+                    SUCCEEDED,
+                    time.time(),
+                    duration,
+                    json.dumps(result) if result is not None else None,
+                    job_id,
+                    worker,
+                ),
+            )
+
+    def fail(self, job_id, worker, duration, error, retry_delay=60):
+        """Record a failed attempt, the job is queued again after retry_delay
+        seconds unless it has been attempted max_attempts times"""
+        now = time.time()
+        with self._transaction() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= max_attempts"
+                " THEN ? ELSE ? END, finished_at = CASE WHEN attempts >="
+                " max_attempts THEN ? END, available_at = ?, duration = ?,"
+                " error = ?, worker = NULL, lease_expires_at = NULL"
+                " WHERE id = ? AND worker = ?",
+                (
+                    FAILED,
+                    QUEUED,
+                    now,
+                    now + retry_delay,
+                    duration,
+                    error,
+                    job_id,
+                    worker,
+                ),
+            )
+
+    def release(self, job_id, worker):
+        """Queue a job again that its worker gave up without trying it to the
+        end, e.g. because the worker is shutting down"""
+        with self._transaction() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts - 1, worker = NULL,"
+                " lease_expires_at = NULL WHERE id = ? AND worker = ? AND status = ?",
+                (QUEUED, job_id, worker, RUNNING),
+            )
+
+    def counts(self):
+        """Number of jobs by status"""
+        rows = self.connection.execute(
+            "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+        ).fetchall()
+        return {status: count for status, count in rows}
+
+    def pending(self):
+        """Number of jobs that are queued or running"""
+        counts = self.counts()
+        return counts.get(QUEUED, 0) + counts.get(RUNNING, 0)
+
+    def jobs(self, status=None, limit=100):
+        query = "SELECT * FROM jobs"
+        parameters = []
+        if status is not None:
+            query += " WHERE status = ?"
+            parameters.append(status)
+        query += " ORDER BY id DESC LIMIT ?"
+        parameters.append(limit)
+        return [dict(row) for row in self.connection.execute(query, parameters)]
+
+
+class _Transaction:
+    """An IMMEDIATE transaction, so that concurrent claims are serialized
+    instead of failing when they upgrade to a write lock"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection.cursor()
+
+    def __exit__(self, exc_type, *exc_info):
+        self.connection.execute("COMMIT" if exc_type is None else "ROLLBACK")
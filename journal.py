@@ -0,0 +1,123 @@
+"""Journal that lets an interrupted project archive resume.
+
+While a project is archived every finished stage and the URL of every
+successful GET response are appended to
+<state_directory>/<project_id>/journal.jsonl. The body of each response is
+written as it was received to a file in journal_bodies/ next to it, so large
+bodies such as all diagrams are neither decoded nor escaped. If the run is
+interrupted the journal stays behind, and the next run answers the journaled
+requests from it instead of the server, so only the systems, teams,
+syntheses etc. that had not been fetched are requested again. Bodies are
+read when they are asked for, not when the journal is opened. The archive
+itself is always written from scratch. The journal is removed once the
+archive is complete, and ignored when it is older than max_age_hours."""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+
+def journal_path(state_directory, project_id):
+    return Path(state_directory, project_id, "journal.jsonl")
+
+
+class RunJournal:
+    def __init__(self, path, max_age_hours=24, logger=None):
+        self.path = Path(path)
+        self.body_directory = self.path.with_name(self.path.stem + "_bodies")
+        self.logger = logger
+        # URL -> name of the file in body_directory holding its body
+        self.responses = {}
+        self.completed_stages = []
+        self._lock = threading.Lock()
+        intact_length = self._load(max_age_hours)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+        if self.resumed:
+            # Continue after the last intact record
+            self._file.truncate(intact_length)
+        else:
+            self._file.truncate(0)
+            shutil.rmtree(self.body_directory, ignore_errors=True)
+            self._append({"created_at": time.time()})
+        self.body_directory.mkdir(exist_ok=True)
+
+    @property
+    def resumed(self):
+        return bool(self.responses or self.completed_stages)
+
+    def _load(self, max_age_hours):
+        """Read the journal of an earlier run, return the length of its intact
+        part"""
+        try:
+            journal_file = open(self.path, "rb")
+        except FileNotFoundError:
+            return 0
+        intact_length = 0
+        with journal_file:
+            for line_number, line in enumerate(journal_file):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line of a run that was killed may be incomplete
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                if line_number == 0:
+                    age_hours = (time.time() - record.get("created_at", 0)) / 3600
+                    if age_hours > max_age_hours:
+                        if self.logger is not None:
+                            self.logger.info(
+                                "Ignoring journal %s, it is %.1f hours old"
+                                % (self.path, age_hours)
+                            )
+                        return 0
+                elif "stage" in record:
+                    self.completed_stages.append(record["stage"])
+                else:
+                    self.responses[record["url"]] = record["file"]
+                intact_length += len(line)
+        return intact_length
+
+    def _append(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            # Flush every record, a killed process must not lose what it fetched
+            self._file.flush()
+
+    def get(self, url):
+        """The journaled body of a GET of url, or None"""
+        with self._lock:
+            name = self.responses.pop(url, None)
+        if name is None:
+            return None
+        try:
+            return (self.body_directory / name).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def record_response(self, url, content):
+        name = hashlib.sha256(url.encode("utf-8")).hexdigest() + ".body"
+        # The record is only appended once the body is complete
+        partial_path = self.body_directory / (
+            "%s.%s.partial" % (name, threading.get_ident())
+        )
+        partial_path.write_bytes(content)
+        os.replace(partial_path, self.body_directory / name)
+        self._append({"url": url, "file": name})
+
+    def record_stage(self, name):
+        self._append({"stage": name})
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def remove(self):
+        self.close()
+        self.path.unlink(missing_ok=True)
+        shutil.rmtree(self.body_directory, ignore_errors=True)
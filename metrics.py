@@ -0,0 +1,183 @@
+"""Request and stage metrics of an archive run.
+
+A RequestMetrics instance is handed to GeodesignHubClient, which records
+every request it sends over the network: its endpoint, status, latency and
+response size. project_report() combines them with the stage timings into
+the metrics.json added to each project's zip, merge_reports() sums the
+reports of all projects into the summary of the run."""
+
+import json
+import math
+import threading
+import time
+from collections import Counter
+
+# Upper bounds of the latency histogram buckets in milliseconds, the last
+# bucket holds everything slower
+LATENCY_BUCKETS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+BUCKET_LABELS = ["<=%s" % bound for bound in LATENCY_BUCKETS_MS] + [
+    ">%s" % LATENCY_BUCKETS_MS[-1]
+]
+
+
+def endpoint_name(method, path, project_id):
+    """Name requests for different entities of one endpoint alike, e.g.
+    GET projects/{project_id}/systems/{id}"""
+    parts = []
+    for part in path.strip("/").split("/"):
+        if part == project_id:
+            part = "{project_id}"
+        elif any(character.isdigit() for character in part):
+            part = "{id}"
+        parts.append(part)
+    return "%s %s" % (method, "/".join(parts))
+
+
+def _bucket_label(milliseconds):
+    for bound, label in zip(LATENCY_BUCKETS_MS, BUCKET_LABELS):
+        if milliseconds <= bound:
+            return label
+    return BUCKET_LABELS[-1]
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[
+        min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1)
+    ]
+
+
+def _histogram_percentile(histogram, count, fraction):
+    """Upper bound of the bucket holding the given fraction of requests"""
+    seen = 0
+    for bound, label in zip(LATENCY_BUCKETS_MS + [math.inf], BUCKET_LABELS):
+        seen += histogram.get(label, 0)
+        if count and seen >= fraction * count:
+            return bound if bound != math.inf else None
+    return None
+
+
+class RequestMetrics:
+    """Thread safe collection of request metrics for one project"""
+
+    def __init__(self, project_id):
+        self.project_id = project_id
+        self._latencies = {}
+        self._statuses = {}
+        self._bytes = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, method, path, status, seconds, size=0):
+        """status is the HTTP status code, or "error" when no response came"""
+        endpoint = endpoint_name(method, path, self.project_id)
+        with self._lock:
+            self._latencies.setdefault(endpoint, []).append(seconds * 1000)
+            self._statuses.setdefault(endpoint, Counter())[str(status)] += 1
+            self._bytes[endpoint] += size
+
+    def endpoints(self):
+        with self._lock:
+            report = {}
+            for endpoint, latencies in self._latencies.items():
+                latencies = sorted(latencies)
+                report[endpoint] = {
+                    "requests": len(latencies),
+                    "statuses": dict(self._statuses[endpoint]),
+                    "bytes": self._bytes[endpoint],
+                    "latency_ms": {
+                        "total": sum(latencies),
+                        "mean": sum(latencies) / len(latencies),
+                        "p50": _percentile(latencies, 0.5),
+                        "p90": _percentile(latencies, 0.9),
+                        "p99": _percentile(latencies, 0.99),
+                        "max": latencies[-1],
+                    },
+                    "histogram_ms": dict(Counter(map(_bucket_label, latencies))),
+                }
+            return report
+
+
+def _totals(endpoints):
+    statuses = Counter()
+    for stats in endpoints.values():
+        statuses.update(stats["statuses"])
+    return {
+        "requests": sum(stats["requests"] for stats in endpoints.values()),
+        "bytes": sum(stats["bytes"] for stats in endpoints.values()),
+        "statuses": dict(statuses),
+    }
+
+
+def project_report(project_id, request_metrics, stage_timings, duration, **extra):
+    """The metrics of one archived project. extra holds further sections, e.g.
+    the response cache statistics."""
+    endpoints = request_metrics.endpoints()
+    return {
+        "project_id": project_id,
+        "finished_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "duration_seconds": duration,
+        "stages_seconds": dict(stage_timings),
+        "totals": _totals(endpoints),
+        "endpoints": endpoints,
+        **extra,
+    }
+
+
+def merge_reports(reports):
+    """Sum the endpoint metrics of several project reports. Percentiles of the
+    merged latencies are estimated from the histograms, as the upper bound of
+    the bucket they fall in."""
+    endpoints = {}
+    for report in reports:
+        for endpoint, stats in report["endpoints"].items():
+            merged = endpoints.setdefault(
+                endpoint,
+                {
+                    "requests": 0,
+                    "statuses": Counter(),
+                    "bytes": 0,
+                    "latency_ms": {"total": 0.0, "max": 0.0},
+                    "histogram_ms": Counter(),
+                },
+            )
+            merged["requests"] += stats["requests"]
+            merged["statuses"].update(stats["statuses"])
+            merged["bytes"] += stats["bytes"]
+            merged["latency_ms"]["total"] += stats["latency_ms"]["total"]
+            merged["latency_ms"]["max"] = max(
+                merged["latency_ms"]["max"], stats["latency_ms"]["max"]
+            )
+            merged["histogram_ms"].update(stats["histogram_ms"])
+    for merged in endpoints.values():
+        latency = merged["latency_ms"]
+        latency["mean"] = latency["total"] / merged["requests"]
+        for name, fraction in [("p50", 0.5), ("p90", 0.9), ("p99", 0.99)]:
+            latency[name] = _histogram_percentile(
+                merged["histogram_ms"], merged["requests"], fraction
+            )
+        merged["statuses"] = dict(merged["statuses"])
+        merged["histogram_ms"] = dict(merged["histogram_ms"])
+    stages = Counter()
+    for report in reports:
+        stages.update(report["stages_seconds"])
+    return {
+        "projects": [report["project_id"] for report in reports],
+        "finished_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "stages_seconds": dict(stages),
+        "totals": _totals(endpoints),
+        "endpoints": endpoints,
+    }
+
+
+def slowest_endpoints(report, count=5):
+    """Endpoints that took the most time in total, slowest first"""
+    return sorted(
+        report["endpoints"].items(),
+        key=lambda item: item[1]["latency_ms"]["total"],
+        reverse=True,
+    )[:count]
+
+
+def dumps(report):
+    return json.dumps(report, indent=2, sort_keys=True).encode("utf-8")
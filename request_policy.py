@@ -0,0 +1,165 @@
+"""Retry and rate limiting policies for GeodesignHubClient.
+
+RetryPolicy decides whether a failed request is sent again and how long to
+wait first. RateLimiter spaces requests out with a token bucket and caps the
+number of requests in flight with a limit that adapts to the server: it grows
+by one for every limit's worth of successful requests and halves when the
+server answers 429 Too Many Requests (AIMD)."""
+
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+# Methods that can safely be sent twice, a POST is only retried when the server
+# refused it with a 429 and so did not process it
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def parse_retry_after(value):
+    """Seconds to wait according to a Retry-After header, which holds either a
+    number of seconds or an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 60.0,
+        retry_statuses=RETRY_STATUSES,
+    ):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_statuses = set(retry_statuses)
+
+    def should_retry(self, method, attempt, status_code=None, exception=None):
+        if attempt >= self.max_retries:
+            return False
+        if status_code == 429:
+            return True
+        if method.upper() not in IDEMPOTENT_METHODS:
+            return False
+        return exception is not None or status_code in self.retry_statuses
+
+    def delay(self, attempt, retry_after=None):
+        """Exponential backoff with full jitter, unless the server said when to
+        come back"""
+        server_delay = parse_retry_after(retry_after)
+        if server_delay is not None:
+            return min(server_delay, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+
+class RateLimiter:
+    """Token bucket of rate requests per second (None for no limit) combined with
+    an adaptive limit on concurrent requests between min_concurrency and
+    max_concurrency. Thread safe, one limiter can be shared by several clients
+    talking to the same server. Coroutines wait for a slot with
+    acquire_async(), which does not block the event loop."""
+
+    def __init__(
+        self,
+        rate=None,
+        burst=None,
+        max_concurrency: int = 16,
+        min_concurrency: int = 1,
+        initial_concurrency=None,
+    ):
+        self.rate = rate
+        self.burst = burst or (max(1.0, rate) if rate else None)
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(initial_concurrency or min(4, max_concurrency))
+        self.in_flight = 0
+        self.throttled = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        # (loop, future) of the coroutines waiting in acquire_async()
+        self._async_waiters = deque()
+
+    def reserve(self):
+        """Take a token and return the seconds to wait before using it"""
+        if not self.rate:
+            return 0.0
+        with self._condition:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.last_refill) * self.rate
+            )
+            self.last_refill = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                waiter = (loop, loop.create_future())
+                self._async_waiters.append(waiter)
+            try:
+                await waiter[1]
+            except asyncio.CancelledError:
+                with self._condition:
+                    if waiter in self._async_waiters:
+                        self._async_waiters.remove(waiter)
+                    else:
+                        # Woken up already, pass the free slot on
+                        self._wake_async_waiters()
+                raise
+
+    def _wake_async_waiters(self):
+        # Called with the lock held, wakes as many waiters as there are free
+        # slots, they check the limit again when they run
+        for _ in range(int(self.limit) - self.in_flight):
+            if not self._async_waiters:
+                break
+            loop, future = self._async_waiters.popleft()
+            loop.call_soon_threadsafe(_wake, future)
+
+    def release(self, throttled=False):
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.throttled += 1
+                # One decrease per burst of 429s, they usually arrive together
+                if now - self._last_decrease > 1.0:
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+            self._wake_async_waiters()
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
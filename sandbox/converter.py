@@ -1,24 +1,17 @@
-import geopandas as gpd
-import pandas as pd
 import json
 import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import spatial_export
 
 
 if __name__ == "__main__":
     with open('all_diagrams.json', 'r') as f:
         all_diagrams = json.load(f)
-    combined_gdf = gpd.GeoDataFrame()
-    for diagram in all_diagrams:
-        gdf = gpd.GeoDataFrame.from_features(diagram['geojson'])
-
-        for key in diagram:
-            if key not in ['geojson', 'name']:
-                gdf[key] = diagram[key]
-                for feature in diagram['geojson']['features']:
-                    feature['properties'][key] = diagram[key]
-
-        combined_gdf = pd.concat([combined_gdf, gdf], ignore_index=True)
+    # All features are collected in one pass and the diagram attributes are
+    # attached column by column, instead of concatenating a frame per diagram
+    combined_gdf = spatial_export.diagrams_to_geodataframe(all_diagrams)
     os.makedirs('diagrams', exist_ok=True)
     combined_gdf.to_file("diagrams/combined.geojson", driver='GeoJSON')
-
-    
\ No newline at end of file
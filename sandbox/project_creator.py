@@ -1,11 +1,25 @@
+import csv
+import io
+import logging
+import logging.handlers
 import os
+import sys
 import zipfile
-import logging
+from dataclasses import dataclass
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import verify_archives
+
 OUTPUT_DIR = "output"  # Change this if your output directory is different
 
+
 @dataclass
 class ProjectDetails:
-    
+    id: str
+    name: str
+    description: str
+
 
 class ScriptLogger:
     def __init__(self):
@@ -34,70 +48,43 @@ class ScriptLogger:
     def get_logger(self):
         return self.logger
 
-def find_zip_files(directory):
-    return [f for f in os.listdir(directory) if f.endswith('.zip')]
-
-def unzip_file(zip_path, extract_to):
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall(extract_to)
-        return zip_ref.namelist()
-
-def verify_contents(extract_to, expected_files=None):
-    actual_files = []
-    for root, _, files in os.walk(extract_to):
-        for file in files:
-            rel_path = os.path.relpath(os.path.join(root, file), extract_to)
-            actual_files.append(rel_path)
-    if expected_files is not None:
-        missing = set(expected_files) - set(actual_files)
-        extra = set(actual_files) - set(expected_files)
-        return missing, extra
-    return actual_files
+
+def read_project_details(zip_path):
+    """Read the project row straight from the project.csv member, None for
+    archives written as Parquet"""
+    with zipfile.ZipFile(zip_path) as zip_file:
+        if "project.csv" not in zip_file.namelist():
+            return None
+        with zip_file.open("project.csv") as member:
+            rows = csv.DictReader(io.TextIOWrapper(member, encoding="utf-8"))
+            row = next(rows)
+    return ProjectDetails(
+        id=row.get("id", ""),
+        name=row.get("name", ""),
+        description=row.get("description", ""),
+    )
+
 
 def main():
     myLogger = ScriptLogger()
     logger = myLogger.get_logger()
-    zip_files = find_zip_files(OUTPUT_DIR)
-    if not zip_files:
+    zip_paths = verify_archives.find_archives(OUTPUT_DIR)
+    if not zip_paths:
         print("No zip files found in output directory.")
         return
 
-    for zip_file in zip_files:
-        zip_path = os.path.join(OUTPUT_DIR, zip_file)
-        extract_dir = os.path.join(OUTPUT_DIR, f"unzipped_{os.path.splitext(zip_file)[0]}")
-        os.makedirs(extract_dir, exist_ok=True)
-        logger.info(f"Unzipping {zip_file} to {extract_dir}...")
-        contents = unzip_file(zip_path, extract_dir)
-        logger.info("Contents in zip:", contents)
-        actual_files = verify_contents(extract_dir)
-        logger.info("Extracted files:", actual_files)
-        # Check for expected CSV files
-        expected_files = [
-            "design_syntheses.csv",
-            "design_teams.csv",
-            "diagrams.csv",
-            "project.csv",
-            "systems.csv"
-        ]
-        missing, extra = verify_contents(extract_dir, expected_files)
-        logger.info("Missing:", missing, "Extra:", extra)
-        if missing:
-            logger.error(f"Missing expected files: {missing}")
-            sys.exit(1)
-        if extra:
-            logger.warning(f"Extra files found: {extra}")
-            sys.exit(1)
-    
-    
-    # Process each file starting with 'project.csv'
-    for file in actual_files:
-        if file.startswith("project.csv"):
-            project_csv_path = os.path.join(extract_dir, file)
-            logger.info(f"Processing file: {project_csv_path}")
-            with open(project_csv_path, 'r') as f:
-
-
-        
+    # The archives are checked in place, nothing is extracted
+    reports = verify_archives.verify_archives(zip_paths)
+    verify_archives.log_reports(reports, logger)
+    if not all(report["ok"] for report in reports):
+        sys.exit(1)
+
+    for zip_path in zip_paths:
+        project_details = read_project_details(zip_path)
+        if project_details is None:
+            continue
+        logger.info("Processing project: %s" % project_details)
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
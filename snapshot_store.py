@@ -0,0 +1,275 @@
+"""Content-addressed store of project snapshots.
+
+Instead of a standalone zip per run, the "snapshot" archive writer stores
+every table row, and every other file of the archive, as an object named by
+the SHA-256 of its content. A record that is byte-identical to one of an
+earlier run, or of another project, is stored once. Each run adds a small
+manifest that lists, per table, the object holding its row list:
+
+    snapshots/objects/3f/a9c2...          zlib compressed content
+    snapshots/manifests/<project_id>/<snapshot_id>.json
+
+Global_IDs are derived by the archiver from the project id, so they are kept
+in objects of their own and records of different projects can still match.
+materialize() turns any snapshot back into output/<project_id>.zip, laid out
+exactly like the zips of the other archive writers, workbook included.
+
+    python snapshot_store.py list
+    python snapshot_store.py materialize snapshots/manifests/<project_id>/<snapshot_id>.json
+    python snapshot_store.py prune
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import tempfile
+import zlib
+from pathlib import Path
+
+import pandas as pd
+
+import table_formats
+
+MANIFEST_FORMAT = 1
+# Columns whose values are assigned by the archiver and stored apart from the
+# rows
+RUN_ASSIGNED_COLUMNS = ["Global_ID"]
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def _json_default(value):
+    # numpy scalars and pandas timestamps
+    if hasattr(value, "item"):
+        return value.item()
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _clean(value):
+    # Missing values of any kind are stored as null
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return value
+
+
+def encode_json(value):
+    # Keys keep their order, nested values such as GeoJSON must come back
+    # as they were. Records of the same table have their columns in the same
+    # order, so identical records still encode to identical bytes.
+    return json.dumps(value, separators=(",", ":"), default=_json_default).encode(
+        "utf-8"
+    )
+
+
+class SnapshotStore:
+    def __init__(self, directory="snapshots"):
+        self.directory = Path(directory)
+        self.objects_directory = self.directory / "objects"
+        self.manifests_directory = self.directory / "manifests"
+
+    def object_path(self, digest):
+        return self.objects_directory / digest[:2] / digest[2:]
+
+    def _store(self, digest, chunks):
+        path = self.object_path(digest)
+        if path.exists():
+            return digest
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Written under a temporary name, concurrent writers of the same
+        # object write the same bytes and the last rename wins
+        compressor = zlib.compressobj()
+        with tempfile.NamedTemporaryFile(
+            dir=path.parent, prefix=path.name, suffix=".partial", delete=False
+        ) as temporary_file:
+            for chunk in chunks:
+                temporary_file.write(compressor.compress(chunk))
+            temporary_file.write(compressor.flush())
+        os.replace(temporary_file.name, path)
+        return digest
+
+    def put(self, data):
+        """Store data unless it is stored already, returns its digest"""
+        return self._store(hashlib.sha256(data).hexdigest(), [data])
+
+    def get(self, digest):
+        return zlib.decompress(self.object_path(digest).read_bytes())
+
+    def put_json(self, value):
+        return self.put(encode_json(value))
+
+    def get_json(self, digest):
+        return json.loads(self.get(digest))
+
+    def _read_chunks(self, path):
+        with open(path, "rb") as source:
+            while chunk := source.read(COPY_CHUNK_SIZE):
+                yield chunk
+
+    def put_file(self, path):
+        """Store the file at path, it is read in chunks"""
+        file_hash = hashlib.sha256()
+        for chunk in self._read_chunks(path):
+            file_hash.update(chunk)
+        return self._store(file_hash.hexdigest(), self._read_chunks(path))
+
+    def manifest_paths(self, project_id=None):
+        pattern = f"{project_id}/*.json" if project_id else "*/*.json"
+        return sorted(self.manifests_directory.glob(pattern))
+
+    def write_manifest(self, manifest):
+        project_directory = self.manifests_directory / manifest["project_id"]
+        project_directory.mkdir(parents=True, exist_ok=True)
+        path = project_directory / f"{manifest['snapshot_id']}.json"
+        suffix = 1
+        while path.exists():
+            suffix += 1
+            path = project_directory / f"{manifest['snapshot_id']}_{suffix}.json"
+        partial_path = path.with_suffix(".json.partial")
+        partial_path.write_text(json.dumps(manifest, indent=2))
+        os.replace(partial_path, path)
+        return path
+
+    def referenced_objects(self):
+        referenced = set()
+        for manifest_path in self.manifest_paths():
+            manifest = json.loads(manifest_path.read_text())
+            referenced.update(manifest["files"].values())
+            for table in manifest["tables"].values():
+                referenced.add(table["rows"])
+                referenced.update(self.get_json(table["rows"]))
+                referenced.update(table["run_assigned"].values())
+        return referenced
+
+    def prune(self):
+        """Remove the objects no manifest refers to, returns their number. Run
+        it only while no snapshot is being written."""
+        referenced = self.referenced_objects()
+        removed = 0
+        for path in self.objects_directory.glob("*/*"):
+            if path.parent.name + path.name not in referenced:
+                path.unlink()
+                removed += 1
+        return removed
+
+
+class SnapshotTable:
+    """The rows of one table, stored chunk by chunk. Has the interface of
+    table_formats.TableFileWriter, so it can back a StreamedTable."""
+
+    def __init__(self, store, name, index=True, columns=None):
+        self.store = store
+        self.name = name
+        self.index = index
+        self.columns = [str(column) for column in columns] if columns else None
+        self.dropped_columns = set()
+        self.rows = 0
+        self.row_digests = []
+        self.run_assigned = {}
+
+    def write(self, df):
+        if self.columns is None:
+            self.columns = [str(column) for column in df.columns]
+        else:
+            df = table_formats.reindex_chunk(
+                df.rename(columns=str), self.columns, self.dropped_columns
+            )
+        df = df.set_axis(pd.RangeIndex(self.rows, self.rows + len(df)))
+        df.columns = self.columns
+        assigned = [column for column in RUN_ASSIGNED_COLUMNS if column in df]
+        for column in assigned:
+            self.run_assigned.setdefault(column, []).extend(
+                _clean(value) for value in df[column]
+            )
+        for record in df.drop(columns=assigned).to_dict("records"):
+            record = {key: _clean(value) for key, value in record.items()}
+            self.row_digests.append(self.store.put_json(record))
+        self.rows += len(df)
+        return df
+
+    def close(self):
+        if self.columns is None:
+            self.columns = list(table_formats.column_types_for(self.name))
+
+    def manifest_entry(self):
+        return {
+            "columns": self.columns or [],
+            "index": self.index,
+            "rows": self.store.put_json(self.row_digests),
+            "run_assigned": {
+                column: self.store.put_json(values)
+                for column, values in self.run_assigned.items()
+            },
+        }
+
+
+def load_table(store, entry):
+    """The DataFrame of a table entry of a manifest"""
+    records = [store.get_json(digest) for digest in store.get_json(entry["rows"])]
+    df = pd.DataFrame.from_records(records, columns=entry["columns"])
+    for column, digest in entry["run_assigned"].items():
+        df[column] = store.get_json(digest)
+    return df[entry["columns"]]
+
+
+def materialize(manifest_path, store=None, output_directory=Path("output"), **options):
+    """Write the snapshot as output_directory/<project_id>.zip, options are
+    passed on to the zip archive writer"""
+    # Imported here, archive_writers imports this module
+    from archive_writers import ZipArchiveWriter
+
+    manifest_path = Path(manifest_path)
+    manifest = json.loads(manifest_path.read_text())
+    if store is None:
+        # manifests/<project_id>/<snapshot_id>.json
+        store = SnapshotStore(manifest_path.parent.parent.parent)
+    options.setdefault("output_format", manifest["output_format"])
+    options.setdefault("excel_workbook", manifest["excel_workbook"])
+    archive = ZipArchiveWriter(manifest["project_id"], output_directory, **options)
+    try:
+        for name, entry in manifest["tables"].items():
+            archive.write_table(name, load_table(store, entry), index=entry["index"])
+        for name, digest in manifest["files"].items():
+            archive.write_bytes(name, store.get(digest))
+    except Exception:
+        archive.abort()
+        raise
+    archive.close()
+    return archive.zip_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--store", default="snapshots", help="snapshot directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+    list_parser = commands.add_parser("list", help="list the snapshots")
+    list_parser.add_argument("--project-id")
+    materialize_parser = commands.add_parser(
+        "materialize", help="write a snapshot as a zip"
+    )
+    materialize_parser.add_argument("manifest")
+    materialize_parser.add_argument("--output", default="output")
+    materialize_parser.add_argument(
+        "--output-format", help="csv or parquet, the format of the run by default"
+    )
+    commands.add_parser("prune", help="remove objects of deleted snapshots")
+    args = parser.parse_args()
+
+    store = SnapshotStore(args.store)
+    if args.command == "list":
+        for manifest_path in store.manifest_paths(args.project_id):
+            manifest = json.loads(manifest_path.read_text())
+            print(
+                "%s  %s  %s tables"
+                % (manifest_path, manifest["created_at"], len(manifest["tables"]))
+            )
+    elif args.command == "materialize":
+        options = {}
+        if args.output_format:
+            options["output_format"] = args.output_format
+        Path(args.output).mkdir(parents=True, exist_ok=True)
+        print(materialize(args.manifest, store, Path(args.output), **options))
+    else:
+        print("Removed %s unreferenced objects" % store.prune())
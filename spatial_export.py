@@ -0,0 +1,176 @@
+"""Export of diagram geometries as a single FlatGeobuf or GeoPackage layer.
+
+Every feature of every diagram becomes one row of the layer, with the
+attributes of its diagram attached. Needs geopandas and pyogrio."""
+
+import json
+from pathlib import Path
+
+import pandas as pd
+
+try:
+    import geopandas as gpd
+    import pyogrio
+    import pyogrio.raw
+except ImportError:  # geopandas is only needed for spatial export
+    gpd = None
+
+# Format name in config.json -> (OGR driver, file extension)
+SPATIAL_FORMATS = {"flatgeobuf": ("FlatGeobuf", "fgb"), "geopackage": ("GPKG", "gpkg")}
+
+# Diagram keys that are not copied onto the features
+EXCLUDED_DIAGRAM_KEYS = ["geojson", "name"]
+
+
+def check_spatial_format(spatial_format):
+    if spatial_format is not None and gpd is None:
+        raise ImportError("geopandas and pyogrio are required for spatial export")
+
+
+def file_name(name, spatial_format):
+    return f"{name}.{SPATIAL_FORMATS[spatial_format][1]}"
+
+
+def _to_text(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    return value
+
+
+def diagrams_to_geodataframe(all_diagrams):
+    """Build one GeoDataFrame holding the features of all diagrams.
+
+    The features are collected in a single pass and the diagram attributes are
+    attached as whole columns, by repeating each diagram's row once for every
+    one of its features."""
+    features = []
+    diagram_positions = []
+    for position, diagram in enumerate(all_diagrams):
+        diagram_features = (diagram.get("geojson") or {}).get("features") or []
+        features.extend(diagram_features)
+        diagram_positions.extend([position] * len(diagram_features))
+
+    if features:
+        gdf = gpd.GeoDataFrame.from_features(features, crs="EPSG:4326")
+    else:
+        gdf = gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
+
+    attributes = pd.DataFrame.from_records(all_diagrams)
+    attributes = attributes.drop(
+        columns=[key for key in EXCLUDED_DIAGRAM_KEYS if key in attributes.columns]
+    )
+    attributes = attributes.iloc[diagram_positions].reset_index(drop=True)
+    # Diagram attributes take precedence over feature properties of the same name
+    gdf = gdf.drop(columns=[column for column in attributes.columns if column in gdf])
+    gdf[list(attributes.columns)] = attributes
+    # OGR formats have no nested types
+    for column in gdf.columns:
+        if column != gdf.geometry.name and gdf[column].dtype == object:
+            gdf[column] = gdf[column].map(_to_text)
+    return gdf
+
+
+def write_layer(gdf, path, spatial_format, layer="diagrams"):
+    driver = SPATIAL_FORMATS[spatial_format][0]
+    gdf.to_file(
+        path,
+        driver=driver,
+        layer=layer,
+        engine="pyogrio",
+        # Packed Hilbert R-tree for FlatGeobuf, R*Tree for GeoPackage
+        layer_options={"SPATIAL_INDEX": "YES"},
+    )
+
+
+def layer_columns(diagram_keys, property_keys):
+    """The columns of a layer of diagrams that have the fields diagram_keys and
+    features with the properties property_keys between them"""
+    sample_diagram = {key: None for key in diagram_keys}
+    sample_diagram["geojson"] = {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": None,
+                "properties": {key: None for key in property_keys},
+            }
+        ],
+    }
+    return list(diagrams_to_geodataframe([sample_diagram]).columns)
+
+
+def copy_layer(source, path, spatial_format, layer="diagrams"):
+    """Copy the layer of source into a spatially indexed layer of path. The
+    features are streamed, so the index is built once over all of them."""
+    driver = SPATIAL_FORMATS[spatial_format][0]
+    if pyogrio.__gdal_version__ < (3, 8, 0):
+        # Writing Arrow streams needs GDAL 3.8, read the layer at once instead
+        write_layer(gpd.read_file(source, layer=layer), path, spatial_format, layer)
+        return
+    with pyogrio.raw.open_arrow(source, layer=layer) as (meta, stream):
+        pyogrio.raw.write_arrow(
+            stream,
+            path,
+            layer=layer,
+            driver=driver,
+            geometry_name=meta["geometry_name"],
+            geometry_type=meta["geometry_type"],
+            crs=meta["crs"],
+            layer_options={"SPATIAL_INDEX": "YES"},
+        )
+
+
+class LayerWriter:
+    """Writes the features of diagrams to a layer chunk by chunk. The columns
+    of the layer are columns, see layer_columns(), or else those of the first
+    chunk.
+
+    The chunks are appended to an unindexed GeoPackage next to path and
+    close() copies them into path in one pass. Appending to path itself would
+    rebuild the spatial index, and for FlatGeobuf rewrite the whole file, for
+    every chunk."""
+
+    def __init__(self, path, spatial_format, layer="diagrams", columns=None):
+        check_spatial_format(spatial_format)
+        self.path = Path(path)
+        self.staging_path = self.path.with_name(self.path.name + ".staging.gpkg")
+        self.spatial_format = spatial_format
+        self.layer = layer
+        self.columns = columns
+        self.written = False
+        self.dropped_columns = set()
+        self.features = 0
+
+    def write(self, diagrams):
+        gdf = diagrams_to_geodataframe(diagrams)
+        if gdf.empty:
+            return
+        if self.columns is None:
+            self.columns = list(gdf.columns)
+        else:
+            self.dropped_columns.update(set(gdf.columns) - set(self.columns))
+            missing = [column for column in self.columns if column not in gdf]
+            gdf = gdf.reindex(columns=self.columns)
+            for column in missing:
+                gdf[column] = pd.Series(None, index=gdf.index, dtype=object)
+        if not self.written:
+            options = {"mode": "w", "layer_options": {"SPATIAL_INDEX": "NO"}}
+        else:
+            options = {"mode": "a"}
+        gdf.to_file(
+            self.staging_path,
+            driver="GPKG",
+            layer=self.layer,
+            engine="pyogrio",
+            # Later chunks may hold other geometry types than the first
+            geometry_type="Unknown",
+            **options,
+        )
+        self.written = True
+        self.features += len(gdf)
+
+    def close(self):
+        """Write the layer to path, if any feature was written"""
+        if self.written:
+            copy_layer(self.staging_path, self.path, self.spatial_format, self.layer)
+        self.staging_path.unlink(missing_ok=True)
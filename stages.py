@@ -0,0 +1,85 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Stage:
+    """A unit of archive work. The results of the stages listed in depends_on
+    are passed to function as positional arguments, in the same order."""
+
+    def __init__(self, name, function, depends_on=()):
+        self.name = name
+        self.function = function
+        self.depends_on = tuple(depends_on)
+
+
+class Cancelled(Exception):
+    """Raised by run_stages() when its cancel event was set"""
+
+
+def _timed_call(stage, *args):
+    start = time.perf_counter()
+    result = stage.function(*args)
+    return result, time.perf_counter() - start
+
+
+def run_stages(stages, logger, max_workers=None, on_complete=None, cancel=None):
+    """Run every stage as soon as all of its dependencies have finished.
+
+    Independent stages run concurrently, so the total time is that of the
+    longest dependency chain. Returns a tuple of (results, timings), both keyed
+    by stage name. If a stage raises no new stages are started and the first
+    exception is re-raised once the running stages have finished. on_complete
+    is called with the name of every stage that finished successfully. Once
+    the threading.Event cancel is set no new stages are started either, and
+    Cancelled is raised."""
+    stages_by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        for dependency in stage.depends_on:
+            assert (
+                dependency in stages_by_name
+            ), f"Stage {stage.name} depends on unknown stage {dependency}"
+
+    results = {}
+    timings = {}
+    pending = dict(stages_by_name)
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=max_workers or len(stages) or 1) as executor:
+        while pending or running:
+            if error is None and cancel is not None and cancel.is_set():
+                logger.warning("Cancelled, no more stages are started")
+                error = Cancelled("stages cancelled")
+            if error is None:
+                ready = [
+                    stage
+                    for stage in pending.values()
+                    if all(dependency in results for dependency in stage.depends_on)
+                ]
+                for stage in ready:
+                    del pending[stage.name]
+                    logger.info("Starting stage %s" % stage.name)
+                    args = [results[dependency] for dependency in stage.depends_on]
+                    running[executor.submit(_timed_call, stage, *args)] = stage
+            if not running:
+                if pending and error is None:
+                    raise ValueError(
+                        "Stages have circular dependencies: %s" % ", ".join(pending)
+                    )
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    results[stage.name], timings[stage.name] = future.result()
+                except Exception as e:
+                    logger.error("Stage %s failed: %s" % (stage.name, e))
+                    error = error or e
+                    continue
+                logger.info(
+                    "Stage %s finished in %.2fs" % (stage.name, timings[stage.name])
+                )
+                if on_complete is not None:
+                    on_complete(stage.name)
+    if error is not None:
+        raise error
+    return results, timings
@@ -0,0 +1,221 @@
+"""Encoding of archive tables as csv or Parquet files.
+
+Parquet files get an explicit schema: the columns the archiver knows about have
+fixed types, other columns are inferred and nested values such as GeoJSON are
+stored as JSON text, so every file of a table can be read with the same
+schema."""
+
+import io
+import json
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is only needed for Parquet output
+    pa = None
+    pq = None
+
+OUTPUT_FORMATS = ["csv", "parquet"]
+PARQUET_COMPRESSIONS = ["zstd", "snappy", "gzip", "brotli", "lz4", "none"]
+
+# Column types of the tables written by archive_project.py, per session
+# negotiation logs share the "negotiation_log" entry
+TABLE_COLUMN_TYPES = {
+    "project": {"id": "string", "name": "string", "description": "string"},
+    "systems": {"id": "int64", "system_name": "string", "Global_ID": "string"},
+    "diagrams": {
+        "id": "int64",
+        "description": "string",
+        "sysid": "int64",
+        "geojson": "string",
+        "Global_ID": "string",
+    },
+    "diagrams_removed": {"id": "int64"},
+    "design_teams": {"id": "int64", "title": "string"},
+    "designs_design_teams": {
+        "id": "string",
+        "cteamid": "int64",
+        "description": "string",
+    },
+    "design_syntheses": {
+        "id": "string",
+        "diagrams": "string",
+        "description": "string",
+        "Global_ID": "string",
+    },
+    "negotiation_logs": {"session_id": "string"},
+    "negotiation_log": {"diagram": "int64", "move": "string", "timestamp": "string"},
+    "negotiation_moves": {
+        "session_id": "string",
+        "diagram": "int64",
+        "move": "string",
+        "timestamp": "string",
+    },
+}
+
+
+def file_name(name, output_format):
+    return f"{name}.{output_format}"
+
+
+def column_types_for(name):
+    if name.startswith("negotiation_log_"):
+        return TABLE_COLUMN_TYPES["negotiation_log"]
+    return TABLE_COLUMN_TYPES.get(name, {})
+
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+
+def _to_text(value):
+    if _is_missing(value):
+        return None
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    return str(value)
+
+
+def _arrow_type(type_name):
+    return {"string": pa.string(), "int64": pa.int64(), "float64": pa.float64()}[
+        type_name
+    ]
+
+
+def to_arrow_table(name, df):
+    column_types = column_types_for(name)
+    arrays = []
+    fields = []
+    for column in df.columns:
+        values = df[column]
+        if column in column_types:
+            arrow_type = _arrow_type(column_types[column])
+            if arrow_type == pa.string():
+                values = values.map(_to_text)
+            array = pa.array(values, type=arrow_type, from_pandas=True)
+        elif values.dtype == object:
+            if values.map(lambda value: isinstance(value, (dict, list))).any():
+                array = pa.array(values.map(_to_text), type=pa.string())
+            else:
+                try:
+                    array = pa.array(values, from_pandas=True)
+                except (pa.ArrowInvalid, pa.ArrowTypeError):
+                    # Mixed types in one column
+                    array = pa.array(values.map(_to_text), type=pa.string())
+        else:
+            array = pa.array(values, from_pandas=True)
+        arrays.append(array)
+        fields.append(pa.field(str(column), array.type))
+    return pa.Table.from_arrays(
+        arrays, schema=pa.schema(fields, metadata={"table": name})
+    )
+
+
+def check_output_format(output_format):
+    if output_format == "parquet" and pa is None:
+        raise ImportError("pyarrow is required to write Parquet archives")
+
+
+def write_table(stream, name, df, output_format, index=True, compression="zstd"):
+    """Write df to the binary stream in the given format"""
+    if output_format == "csv":
+        text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+        df.to_csv(text, index=index)
+        text.flush()
+        # Leave the stream open for the caller
+        text.detach()
+    elif output_format == "parquet":
+        check_output_format(output_format)
+        # The row index is a plain counter, Parquet readers don't need it
+        pq.write_table(
+            to_arrow_table(name, df),
+            stream,
+            compression=None if compression == "none" else compression,
+        )
+    else:
+        raise ValueError(f"Unknown output format {output_format}")
+
+
+def reindex_chunk(df, columns, dropped_columns):
+    """df with exactly columns, the ones it doesn't have are added empty and
+    the ones that aren't in columns are dropped and added to dropped_columns"""
+    dropped_columns.update(set(df.columns) - set(columns))
+    missing = [column for column in columns if column not in df.columns]
+    df = df.reindex(columns=columns)
+    # Without a value rather than NaN, which would make the column a float
+    # column in Parquet files
+    for column in missing:
+        df[column] = pd.Series(None, index=df.index, dtype=object)
+    return df
+
+
+class TableFileWriter:
+    """Writes a table to a file in chunks, for tables too large to hold in
+    memory at once. The columns of the table are columns, when they are known
+    up front, otherwise those of the first chunk. Columns missing from a chunk
+    are left empty, columns that are not in the table are left out and listed
+    in dropped_columns."""
+
+    def __init__(
+        self, path, name, output_format, index=True, compression="zstd", columns=None
+    ):
+        check_output_format(output_format)
+        self.name = name
+        self.output_format = output_format
+        self.index = index
+        self.compression = compression
+        self.columns = list(columns) if columns is not None else None
+        self.dropped_columns = set()
+        self.rows = 0
+        self._file = open(path, "wb")
+        self._parquet_writer = None
+
+    def write(self, df):
+        """Append the rows of df, returns them as they were written"""
+        if self.columns is None:
+            self.columns = list(df.columns)
+        else:
+            df = reindex_chunk(df, self.columns, self.dropped_columns)
+        # The row index carries on from the previous chunks
+        df = df.set_axis(pd.RangeIndex(self.rows, self.rows + len(df)))
+        if self.output_format == "csv":
+            text = io.TextIOWrapper(self._file, encoding="utf-8", newline="")
+            df.to_csv(text, index=self.index, header=self.rows == 0)
+            text.flush()
+            text.detach()
+        else:
+            table = to_arrow_table(self.name, df)
+            if self._parquet_writer is None:
+                # A column without values in the first chunk holds text
+                schema = pa.schema(
+                    [
+                        (
+                            field.with_type(pa.string())
+                            if pa.types.is_null(field.type)
+                            else field
+                        )
+                        for field in table.schema
+                    ],
+                    metadata=table.schema.metadata,
+                )
+                self._parquet_writer = pq.ParquetWriter(
+                    self._file,
+                    schema,
+                    compression=(
+                        None if self.compression == "none" else self.compression
+                    ),
+                )
+            self._parquet_writer.write_table(table.cast(self._parquet_writer.schema))
+        self.rows += len(df)
+        return df
+
+    def close(self):
+        if self.columns is None:
+            self.write(pd.DataFrame(columns=list(column_types_for(self.name))))
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+        self._file.close()
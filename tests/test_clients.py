@@ -0,0 +1,150 @@
+"""The request layers shared by GeodesignHubClient and AsyncGeodesignHubClient:
+the memo, the journal and the response cache"""
+
+import asyncio
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import GeodesignHub
+from http_cache import ResponseCache
+
+PROJECT_ID = "AAAAAAAAAAAAAAAA"
+BODY = b'[{"id": 1}]'
+
+
+class FakeServer:
+    """Answers every GET with BODY and an ETag, and 304 when it is sent back"""
+
+    def __init__(self):
+        self.requests = []
+
+    def answer(self, method, url, headers):
+        self.requests.append((method, headers.get("If-None-Match")))
+        if method == "GET" and headers.get("If-None-Match") == '"v1"':
+            return 304, b""
+        return 200, BODY
+
+
+class FakeSession:
+    def __init__(self, server):
+        self.server = server
+
+    def request(self, method, url, *args, headers=None, **kwargs):
+        status, content = self.server.answer(method, url, headers or {})
+        return SimpleNamespace(
+            status_code=status, content=content, headers={"ETag": '"v1"'}
+        )
+
+
+class FakeAsyncResponse:
+    def __init__(self, status, content, url):
+        self.status = status
+        self.content = content
+        self.url = url
+        self.headers = {"ETag": '"v1"'}
+
+    async def read(self):
+        return self.content
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeAsyncSession:
+    def __init__(self, server):
+        self.server = server
+
+    def request(self, method, url, *args, headers=None, **kwargs):
+        status, content = self.server.answer(method, url, headers or {})
+        return FakeAsyncResponse(status, content, url)
+
+
+class ClientLayersTest:
+    """Run by the sync and async variants below"""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.cache = ResponseCache(directory, ttl=0)
+        self.server = FakeServer()
+
+    def test_memo(self):
+        client = self.client()
+        self.assertEqual(self.get(client).content, BODY)
+        self.assertEqual(self.get(client).content, BODY)
+        self.assertEqual(len(self.server.requests), 1)
+        self.run_request(client, "POST", "projects/%s/tags/" % PROJECT_ID)
+        self.get(client)
+        self.assertEqual(
+            [method for method, _ in self.server.requests], ["GET", "POST", "GET"]
+        )
+
+    def test_cache_revalidation(self):
+        self.get(self.client(cache=self.cache))
+        response = self.get(self.client(cache=self.cache))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, BODY)
+        self.assertEqual(self.server.requests, [("GET", None), ("GET", '"v1"')])
+        self.assertEqual((self.cache.misses, self.cache.revalidated), (1, 1))
+
+    def test_journal(self):
+        journal = FakeJournal()
+        self.get(self.client(journal=journal))
+        self.assertEqual(list(journal.responses.values()), [BODY])
+        response = self.get(self.client(journal=journal))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, BODY)
+        self.assertEqual(len(self.server.requests), 1)
+
+
+class FakeJournal:
+    def __init__(self):
+        self.responses = {}
+
+    def get(self, url):
+        return self.responses.get(url)
+
+    def record_response(self, url, content):
+        self.responses[url] = content
+
+
+class SyncClientTest(ClientLayersTest, unittest.TestCase):
+    def client(self, **kwargs):
+        return GeodesignHub.GeodesignHubClient(
+            token="token",
+            project_id=PROJECT_ID,
+            session=FakeSession(self.server),
+            **kwargs
+        )
+
+    def get(self, client):
+        return client.get_all_systems()
+
+    def run_request(self, client, method, url):
+        return client._request(method, url)
+
+
+@unittest.skipIf(GeodesignHub.aiohttp is None, "aiohttp is not installed")
+class AsyncClientTest(ClientLayersTest, unittest.TestCase):
+    def client(self, **kwargs):
+        return GeodesignHub.AsyncGeodesignHubClient(
+            token="token",
+            project_id=PROJECT_ID,
+            session=FakeAsyncSession(self.server),
+            **kwargs
+        )
+
+    def get(self, client):
+        return asyncio.run(client.get_all_systems())
+
+    def run_request(self, client, method, url):
+        return asyncio.run(client._request(method, url))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+"""Validation of config.json by archive_project.load_and_validate_config"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import archive_project
+
+REQUIRED = {
+    "service_url": "http://localhost/api/v1/",
+    "project_ids": ["AAAAAAAAAAAAAAAA"],
+    "api_token": "token",
+}
+
+
+class LoadConfigTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(directory)
+        self.logger = logging.getLogger("test_config")
+        self.logger.disabled = True
+
+    def load(self, **options):
+        with open("config.json", "w") as config:
+            json.dump({**REQUIRED, **options}, config)
+        return archive_project.load_and_validate_config(self.logger)
+
+    def assertInvalid(self, **options):
+        with self.assertRaises(SystemExit):
+            self.load(**options)
+
+    def test_defaults(self):
+        c = self.load()
+        self.assertEqual(c["archive_compression"], "deflate")
+        self.assertIsNone(c["archive_compression_level"])
+
+    def test_archive_compression_level(self):
+        self.assertEqual(
+            self.load(archive_compression_level=9)["archive_compression_level"], 9
+        )
+        self.assertInvalid(archive_compression_level=10)
+        self.assertInvalid(archive_compression="zstd", archive_compression_level=0)
+        self.assertInvalid(archive_compression_level=-1)
+
+    def test_request_timeout(self):
+        self.assertIsNone(self.load(request_timeout=None)["request_timeout"])
+        self.assertEqual(self.load(request_timeout=0.5)["request_timeout"], 0.5)
+        self.assertInvalid(request_timeout=0)
+        self.assertInvalid(request_timeout=-1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+"""State of incremental diagram archiving"""
+
+import logging
+import shutil
+import tempfile
+import time
+import unittest
+
+import incremental
+
+
+class LoadDiagramStateTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.logger = logging.getLogger("test_incremental")
+
+    def save(self, age_days):
+        state = incremental.new_state({"1": {"id": 1}}, {"1": "c1"})
+        state["full_refresh_at"] = time.time() - age_days * 86400
+        incremental.save_diagram_state(self.directory, "A", state)
+
+    def test_no_state(self):
+        self.assertIsNone(
+            incremental.load_diagram_state(self.directory, "A", 1, self.logger)
+        )
+
+    def test_stale_window_is_logged(self):
+        self.save(0.5)
+        with self.assertLogs(self.logger, "WARNING") as logs:
+            state = incremental.load_diagram_state(self.directory, "A", 1, self.logger)
+        self.assertEqual(list(state["diagrams"]), ["1"])
+        self.assertIn("since the last full refresh", logs.output[0])
+        self.assertIn("0.5 days", logs.output[0])
+
+    def test_full_refresh_when_old(self):
+        self.save(1.5)
+        self.assertIsNone(
+            incremental.load_diagram_state(self.directory, "A", 1, self.logger)
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,182 @@
+"""job_queue.JobQueue and the lease handling of archive_worker"""
+
+import logging
+import shutil
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import archive_worker
+import job_queue
+from stages import Cancelled, Stage, run_stages
+
+SERVICE_URL = "https://www.geodesignhub.com/api/v1/"
+
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.queue = job_queue.JobQueue(self.directory / "jobs.db", SERVICE_URL)
+        self.addCleanup(self.queue.close)
+        self.now = 1000.0
+        patcher = mock.patch.object(
+            job_queue.time, "time", side_effect=lambda: self.now
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def job(self, job_id):
+        return self.queue.connection.execute(
+            "SELECT * FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+
+    def test_claim_order(self):
+        self.assertEqual(len(self.queue.submit(["A", "B"])), 2)
+        self.queue.submit(["C"], priority=10)
+        # A project with a pending job is not queued twice
+        self.assertEqual(self.queue.submit(["A"]), [])
+        claimed = [self.queue.claim("w")["project_id"] for _ in range(3)]
+        self.assertEqual(claimed, ["C", "A", "B"])
+        self.assertIsNone(self.queue.claim("w"))
+        self.assertEqual(self.queue.counts(), {job_queue.RUNNING: 3})
+
+    def test_jobs_per_host(self):
+        self.queue.submit(["A", "B", "C"])
+        self.queue.submit(["D"], service_url="https://other.example.com/api/v1/")
+        claimed = [self.queue.claim("w", max_jobs_per_host=2) for _ in range(4)]
+        self.assertEqual(
+            [job and job["project_id"] for job in claimed], ["A", "B", "D", None]
+        )
+
+    def test_lease_expiry(self):
+        (job_id,) = self.queue.submit(["A"])
+        job = self.queue.claim("w1", lease_seconds=60)
+        self.assertEqual(job["attempts"], 1)
+        self.now += 30
+        self.assertTrue(self.queue.renew(job_id, "w1", lease_seconds=60))
+        self.now += 61
+        # w1 stopped renewing, the job is queued again for another worker
+        job = self.queue.claim("w2", lease_seconds=60)
+        self.assertEqual((job["id"], job["attempts"]), (job_id, 2))
+        self.assertFalse(self.queue.renew(job_id, "w1"))
+        # w1 can't record an outcome for a job it no longer holds
+        self.queue.complete(job_id, "w1", 1.0)
+        self.queue.fail(job_id, "w1", 1.0, "error")
+        row = self.job(job_id)
+        self.assertEqual((row["status"], row["worker"]), (job_queue.RUNNING, "w2"))
+
+    def test_lease_expiry_after_max_attempts(self):
+        (job_id,) = self.queue.submit(["A"], max_attempts=1)
+        self.queue.claim("w1", lease_seconds=60)
+        self.now += 61
+        self.assertIsNone(self.queue.claim("w2"))
+        row = self.job(job_id)
+        self.assertEqual(row["status"], job_queue.FAILED)
+        self.assertEqual(row["error"], "lease expired")
+
+    def test_retry(self):
+        (job_id,) = self.queue.submit(["A"], max_attempts=2)
+        self.queue.claim("w")
+        self.queue.fail(job_id, "w", 1.0, "boom", retry_delay=60)
+        self.assertEqual(self.job(job_id)["status"], job_queue.QUEUED)
+        # Not before the retry delay
+        self.assertIsNone(self.queue.claim("w"))
+        self.now += 60
+        self.assertEqual(self.queue.claim("w")["attempts"], 2)
+        self.queue.fail(job_id, "w", 1.0, "boom again")
+        row = self.job(job_id)
+        self.assertEqual(
+            (row["status"], row["error"]), (job_queue.FAILED, "boom again")
+        )
+        self.now += 3600
+        self.assertIsNone(self.queue.claim("w"))
+
+    def test_complete(self):
+        (job_id,) = self.queue.submit(["A"])
+        self.queue.claim("w")
+        self.queue.complete(job_id, "w", 2.5, {"totals": {"requests": 3}})
+        row = self.job(job_id)
+        self.assertEqual(row["status"], job_queue.SUCCEEDED)
+        self.assertEqual(row["result"], '{"totals": {"requests": 3}}')
+        self.assertEqual(self.queue.pending(), 0)
+
+    def test_release(self):
+        (job_id,) = self.queue.submit(["A"])
+        self.queue.claim("w")
+        self.queue.release(job_id, "w")
+        # A released job is not counted as an attempt
+        self.assertEqual(self.queue.claim("w")["attempts"], 1)
+
+
+class LeaseLostTest(unittest.TestCase):
+    def setUp(self):
+        directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, directory)
+        self.c = {
+            "job_database": str(directory / "jobs.db"),
+            "job_lease_seconds": 0.3,
+            "service_url": SERVICE_URL,
+            "job_retry_delay": 0,
+        }
+        self.queue = job_queue.JobQueue(self.c["job_database"], SERVICE_URL)
+        self.addCleanup(self.queue.close)
+        self.logger = logging.getLogger("test_job_queue")
+        self.logger.disabled = True
+
+    def test_job_stops_and_records_nothing(self):
+        (job_id,) = self.queue.submit(["A"])
+        job = self.queue.claim("w1", lease_seconds=60)
+        # Another worker took the job over
+        self.queue.connection.execute(
+            "UPDATE jobs SET worker = 'w2' WHERE id = ?", (job_id,)
+        )
+
+        def archive_project_safely(project_id, c, logger, session, cache, cancel):
+            self.assertTrue(cancel.wait(5))
+            return {"status": "cancelled", "duration": 0.1, "error": "cancelled"}
+
+        with mock.patch.object(
+            archive_worker.archive_project,
+            "archive_project_safely",
+            side_effect=archive_project_safely,
+        ):
+            archive_worker.run_job(
+                self.queue,
+                job,
+                self.c,
+                "w1",
+                {SERVICE_URL: mock.sentinel.session},
+                None,
+                self.logger,
+            )
+        row = self.queue.connection.execute(
+            "SELECT * FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        self.assertEqual((row["status"], row["worker"]), (job_queue.RUNNING, "w2"))
+
+
+class CancelStagesTest(unittest.TestCase):
+    def test_no_stage_starts_after_cancel(self):
+        cancel = threading.Event()
+        started = []
+
+        def first():
+            started.append("first")
+            cancel.set()
+
+        stages = [
+            Stage("first", first),
+            Stage("second", lambda _: started.append("second"), ["first"]),
+        ]
+        logger = logging.getLogger("test_job_queue")
+        logger.disabled = True
+        with self.assertRaises(Cancelled):
+            run_stages(stages, logger, cancel=cancel)
+        self.assertEqual(started, ["first"])
+
+
+if __name__ == "__main__":
+    unittest.main()
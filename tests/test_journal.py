@@ -0,0 +1,96 @@
+"""journal.RunJournal, the journal an interrupted archive resumes from"""
+
+import json
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import journal
+from journal import RunJournal
+
+URL = "https://www.geodesignhub.com/api/v1/projects/AAAAAAAAAAAAAAAA/diagrams/all/"
+BODY = b'[{"id": 1, "description": "caf\xc3\xa9"}]'
+
+
+class RunJournalTest(unittest.TestCase):
+    def setUp(self):
+        directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = journal.journal_path(directory, "AAAAAAAAAAAAAAAA")
+
+    def interrupted_run(self):
+        run_journal = RunJournal(self.path)
+        run_journal.record_response(URL, BODY)
+        run_journal.record_stage("systems")
+        run_journal.close()
+
+    def test_resume(self):
+        self.interrupted_run()
+        run_journal = RunJournal(self.path)
+        self.addCleanup(run_journal.close)
+        self.assertTrue(run_journal.resumed)
+        self.assertEqual(run_journal.completed_stages, ["systems"])
+        self.assertEqual(len(run_journal.responses), 1)
+        self.assertEqual(run_journal.get(URL), BODY)
+        # Each body is answered once
+        self.assertIsNone(run_journal.get(URL))
+
+    def test_bodies_are_raw_files_read_on_get(self):
+        self.interrupted_run()
+        self.assertNotIn(b"caf", self.path.read_bytes())
+        (body_path,) = (self.path.parent / "journal_bodies").iterdir()
+        self.assertEqual(body_path.read_bytes(), BODY)
+        with mock.patch.object(Path, "read_bytes", return_value=BODY) as read_bytes:
+            run_journal = RunJournal(self.path)
+            self.addCleanup(run_journal.close)
+            read_bytes.assert_not_called()
+            run_journal.get(URL)
+            read_bytes.assert_called_once_with()
+
+    def test_binary_body(self):
+        run_journal = RunJournal(self.path)
+        run_journal.record_response(URL, b"\xff\x00")
+        run_journal.close()
+        run_journal = RunJournal(self.path)
+        self.addCleanup(run_journal.close)
+        self.assertEqual(run_journal.get(URL), b"\xff\x00")
+
+    def test_incomplete_last_line(self):
+        self.interrupted_run()
+        with open(self.path, "a", encoding="utf-8") as journal_file:
+            journal_file.write('{"stage": "desig')
+        run_journal = RunJournal(self.path)
+        self.assertEqual(run_journal.completed_stages, ["systems"])
+        run_journal.record_stage("design_teams")
+        run_journal.close()
+        lines = self.path.read_text(encoding="utf-8").splitlines()
+        self.assertEqual(json.loads(lines[-1]), {"stage": "design_teams"})
+
+    def test_missing_body(self):
+        self.interrupted_run()
+        shutil.rmtree(self.path.parent / "journal_bodies")
+        run_journal = RunJournal(self.path)
+        self.addCleanup(run_journal.close)
+        self.assertIsNone(run_journal.get(URL))
+
+    def test_old_journal_is_ignored(self):
+        self.interrupted_run()
+        with mock.patch.object(journal.time, "time", return_value=1e12):
+            run_journal = RunJournal(self.path, max_age_hours=24)
+        self.addCleanup(run_journal.close)
+        self.assertFalse(run_journal.resumed)
+        self.assertIsNone(run_journal.get(URL))
+        self.assertEqual(list(run_journal.body_directory.iterdir()), [])
+
+    def test_remove(self):
+        run_journal = RunJournal(self.path)
+        run_journal.record_response(URL, BODY)
+        run_journal.remove()
+        self.assertFalse(self.path.exists())
+        self.assertFalse(run_journal.body_directory.exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
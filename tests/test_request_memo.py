@@ -0,0 +1,218 @@
+"""GeodesignHub.RequestMemo, the in-memory memo of GET responses"""
+
+import asyncio
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+
+import GeodesignHub
+from GeodesignHub import RequestMemo
+
+
+def response(content=b"{}", status_code=200):
+    return SimpleNamespace(status_code=status_code, content=content, headers={})
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.001)
+
+
+class FetchTest(unittest.TestCase):
+    def fetch_in_threads(self, memo, url, send, callers):
+        results = [None] * callers
+
+        def fetch(index):
+            try:
+                results[index] = memo.fetch(url, send)
+            except Exception as e:
+                results[index] = e
+
+        threads = [
+            threading.Thread(target=fetch, args=(index,)) for index in range(callers)
+        ]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_coalesces_requests_in_flight(self):
+        memo = RequestMemo()
+        release = threading.Event()
+        sent = []
+
+        def send():
+            sent.append(1)
+            release.wait(5)
+            return response(b"diagrams")
+
+        threads, results = self.fetch_in_threads(memo, "a", send, 5)
+        wait_for(lambda: memo.coalesced == 4)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(sent), 1)
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertEqual(results[0].content, b"diagrams")
+        # Later callers are answered from the memo
+        self.assertIs(memo.fetch("a", send), results[0])
+        self.assertEqual(memo.hits, 1)
+        self.assertEqual(memo.in_flight, {})
+
+    def test_error_reaches_every_waiter_and_is_not_kept(self):
+        memo = RequestMemo()
+        release = threading.Event()
+
+        def fail():
+            release.wait(5)
+            raise ConnectionError("connection reset")
+
+        threads, results = self.fetch_in_threads(memo, "a", fail, 3)
+        wait_for(lambda: memo.coalesced == 2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(isinstance(result, ConnectionError) for result in results))
+        self.assertEqual(memo.in_flight, {})
+        self.assertEqual(len(memo.responses), 0)
+        # The next caller sends the request again
+        self.assertEqual(memo.fetch("a", lambda: response(b"ok")).content, b"ok")
+
+    def test_only_successful_responses_are_kept(self):
+        memo = RequestMemo()
+        memo.fetch("a", lambda: response(b"missing", 404))
+        self.assertEqual(len(memo.responses), 0)
+        self.assertEqual(memo.fetch("a", lambda: response(b"ok")).content, b"ok")
+        self.assertEqual(len(memo.responses), 1)
+
+    def test_lru_byte_budget(self):
+        memo = RequestMemo(max_entries=10, max_bytes=10, max_entry_bytes=6)
+        for url in ["a", "b"]:
+            memo.fetch(url, lambda: response(b"1234"))
+        # a was used last, so b is evicted when c goes over max_bytes
+        memo.fetch("a", None)
+        memo.fetch("c", lambda: response(b"1234"))
+        self.assertEqual(list(memo.responses), ["a", "c"])
+        self.assertEqual(memo.bytes, 8)
+        # Bodies over max_entry_bytes are passed on but not kept
+        big = memo.fetch("d", lambda: response(b"1234567"))
+        self.assertEqual(big.content, b"1234567")
+        self.assertEqual(list(memo.responses), ["a", "c"])
+        self.assertEqual(memo.bytes, 8)
+
+    def test_max_entries(self):
+        memo = RequestMemo(max_entries=2)
+        for url in ["a", "b", "c"]:
+            memo.fetch(url, lambda: response())
+        self.assertEqual(list(memo.responses), ["b", "c"])
+
+    def test_invalidate_drops_responses_in_flight(self):
+        memo = RequestMemo()
+        memo.fetch("a", lambda: response(b"old"))
+
+        def send():
+            # A POST lands while this GET is running
+            memo.invalidate()
+            return response(b"stale")
+
+        self.assertEqual(memo.fetch("b", send).content, b"stale")
+        self.assertEqual(len(memo.responses), 0)
+        self.assertEqual(memo.bytes, 0)
+        self.assertEqual(memo.fetch("a", lambda: response(b"new")).content, b"new")
+
+
+class FetchAsyncTest(unittest.TestCase):
+    def test_coalesces_requests_in_flight(self):
+        async def main():
+            memo = RequestMemo()
+            sent = []
+
+            async def send():
+                sent.append(1)
+                await asyncio.sleep(0.01)
+                return response(b"diagrams")
+
+            results = await asyncio.gather(
+                *[memo.fetch_async("a", send) for _ in range(5)]
+            )
+            self.assertEqual(len(sent), 1)
+            self.assertTrue(all(result is results[0] for result in results))
+            self.assertEqual(memo.coalesced, 4)
+            self.assertIs(await memo.fetch_async("a", send), results[0])
+            self.assertEqual(memo.in_flight, {})
+
+        asyncio.run(main())
+
+    def test_error_reaches_every_waiter_and_is_not_kept(self):
+        async def main():
+            memo = RequestMemo()
+
+            async def fail():
+                await asyncio.sleep(0.01)
+                raise ConnectionError("connection reset")
+
+            results = await asyncio.gather(
+                *[memo.fetch_async("a", fail) for _ in range(3)],
+                return_exceptions=True,
+            )
+            self.assertTrue(
+                all(isinstance(result, ConnectionError) for result in results)
+            )
+            self.assertEqual(memo.in_flight, {})
+            self.assertEqual(len(memo.responses), 0)
+
+            async def send():
+                return response(b"ok")
+
+            self.assertEqual((await memo.fetch_async("a", send)).content, b"ok")
+
+        asyncio.run(main())
+
+    def test_cancelled_waiter_leaves_the_request_running(self):
+        async def main():
+            memo = RequestMemo()
+
+            async def send():
+                await asyncio.sleep(0.05)
+                return response(b"diagrams")
+
+            first = asyncio.ensure_future(memo.fetch_async("a", send))
+            second = asyncio.ensure_future(memo.fetch_async("a", send))
+            await asyncio.sleep(0.01)
+            second.cancel()
+            self.assertEqual((await first).content, b"diagrams")
+            self.assertTrue(second.cancelled())
+
+        asyncio.run(main())
+
+
+class FakeSession:
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, *args, **kwargs):
+        self.requests.append((method, url))
+        return response(b'{"id": 1}')
+
+
+class ClientMemoTest(unittest.TestCase):
+    def test_post_clears_the_memo(self):
+        session = FakeSession()
+        client = GeodesignHub.GeodesignHubClient(
+            token="token", project_id="AAAAAAAAAAAAAAAA", session=session
+        )
+        client.get_all_systems()
+        client.get_all_systems()
+        self.assertEqual(len(session.requests), 1)
+        client._request("POST", "projects/AAAAAAAAAAAAAAAA/cteams/1/1/")
+        client.get_all_systems()
+        self.assertEqual(
+            [method for method, _ in session.requests], ["GET", "POST", "GET"]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
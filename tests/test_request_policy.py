@@ -0,0 +1,186 @@
+"""RetryPolicy and RateLimiter of request_policy"""
+
+import asyncio
+import threading
+import unittest
+from email.utils import formatdate
+from unittest import mock
+
+import request_policy
+from request_policy import RateLimiter, RetryPolicy, parse_retry_after
+
+
+class ParseRetryAfterTest(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after("120"), 120.0)
+        self.assertEqual(parse_retry_after("1.5"), 1.5)
+        self.assertEqual(parse_retry_after("-3"), 0.0)
+
+    def test_http_date(self):
+        with mock.patch.object(request_policy.time, "time", return_value=1000.0):
+            self.assertAlmostEqual(
+                parse_retry_after(formatdate(1030.0, usegmt=True)), 30.0
+            )
+            # A date in the past means now
+            self.assertEqual(parse_retry_after(formatdate(900.0, usegmt=True)), 0.0)
+
+    def test_missing_or_invalid(self):
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after(""))
+        self.assertIsNone(parse_retry_after("soon"))
+
+
+class RetryPolicyTest(unittest.TestCase):
+    def test_should_retry(self):
+        policy = RetryPolicy(max_retries=2)
+        self.assertTrue(policy.should_retry("GET", 0, status_code=503))
+        self.assertTrue(policy.should_retry("GET", 1, exception=OSError()))
+        self.assertFalse(policy.should_retry("GET", 2, status_code=503))
+        self.assertFalse(policy.should_retry("GET", 0, status_code=404))
+        # A POST may have been processed, unless the server refused it
+        self.assertFalse(policy.should_retry("POST", 0, status_code=503))
+        self.assertFalse(policy.should_retry("POST", 0, exception=OSError()))
+        self.assertTrue(policy.should_retry("POST", 0, status_code=429))
+
+    def test_jitter_bounds(self):
+        policy = RetryPolicy(backoff_base=0.5, backoff_max=3.0)
+        for attempt, bound in [(0, 0.5), (1, 1.0), (2, 2.0), (3, 3.0), (10, 3.0)]:
+            delays = [policy.delay(attempt) for _ in range(200)]
+            self.assertTrue(all(0 <= delay <= bound for delay in delays))
+            # Full jitter spreads the delays over the whole range
+            self.assertLess(min(delays), bound / 4)
+            self.assertGreater(max(delays), bound * 3 / 4)
+
+    def test_retry_after(self):
+        policy = RetryPolicy(backoff_max=60.0)
+        self.assertEqual(policy.delay(0, "7"), 7.0)
+        self.assertEqual(policy.delay(0, "3600"), 60.0)
+        self.assertLessEqual(policy.delay(0, "soon"), policy.backoff_base)
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_no_rate(self):
+        limiter = RateLimiter()
+        self.assertEqual([limiter.reserve() for _ in range(100)], [0.0] * 100)
+
+    def test_rate(self):
+        now = [100.0]
+        with mock.patch.object(
+            request_policy.time, "monotonic", side_effect=lambda: now[0]
+        ):
+            limiter = RateLimiter(rate=10, burst=2)
+            self.assertEqual(limiter.reserve(), 0.0)
+            self.assertEqual(limiter.reserve(), 0.0)
+            # The burst is used up, every further request waits a tenth of a
+            # second longer than the one before
+            self.assertAlmostEqual(limiter.reserve(), 0.1)
+            self.assertAlmostEqual(limiter.reserve(), 0.2)
+            now[0] += 1.0
+            # The bucket refills at rate, but never beyond burst
+            self.assertEqual(limiter.reserve(), 0.0)
+            now[0] += 60.0
+            self.assertEqual(limiter.reserve(), 0.0)
+            self.assertEqual(limiter.reserve(), 0.0)
+            self.assertAlmostEqual(limiter.reserve(), 0.1)
+
+
+class AdaptiveConcurrencyTest(unittest.TestCase):
+    def request(self, limiter, throttled=False):
+        limiter.acquire()
+        limiter.release(throttled=throttled)
+
+    def test_grows_on_success(self):
+        limiter = RateLimiter(max_concurrency=8, initial_concurrency=4)
+        for _ in range(4):
+            self.request(limiter)
+        # One more slot for every limit's worth of successful requests
+        self.assertAlmostEqual(limiter.limit, 5.0, delta=0.1)
+        for _ in range(1000):
+            self.request(limiter)
+        self.assertEqual(limiter.limit, 8)
+
+    def test_halves_on_429(self):
+        now = [100.0]
+        with mock.patch.object(
+            request_policy.time, "monotonic", side_effect=lambda: now[0]
+        ):
+            limiter = RateLimiter(
+                max_concurrency=16, min_concurrency=2, initial_concurrency=16
+            )
+            self.request(limiter, throttled=True)
+            self.assertEqual(limiter.limit, 8)
+            # 429s arriving together only halve the limit once
+            self.request(limiter, throttled=True)
+            self.assertEqual(limiter.limit, 8)
+            for _ in range(3):
+                now[0] += 2.0
+                self.request(limiter, throttled=True)
+            self.assertEqual(limiter.limit, 2)
+            self.assertEqual(limiter.throttled, 5)
+
+    def test_acquire_blocks_at_limit(self):
+        limiter = RateLimiter(max_concurrency=1, initial_concurrency=1)
+        limiter.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            limiter.acquire()
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        limiter.release()
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+        self.assertEqual(limiter.in_flight, 1)
+
+
+class AsyncWaitersTest(unittest.TestCase):
+    def test_woken_by_release_from_a_thread(self):
+        async def main():
+            limiter = RateLimiter(max_concurrency=1, initial_concurrency=1)
+            await limiter.acquire_async()
+            waiter = asyncio.ensure_future(limiter.acquire_async())
+            await asyncio.sleep(0.05)
+            self.assertFalse(waiter.done())
+            threading.Thread(target=limiter.release).start()
+            await asyncio.wait_for(waiter, 5)
+            self.assertEqual(limiter.in_flight, 1)
+
+        asyncio.run(main())
+
+    def test_cancelled_waiter_passes_the_slot_on(self):
+        async def main():
+            limiter = RateLimiter(max_concurrency=1, initial_concurrency=1)
+            await limiter.acquire_async()
+            first = asyncio.ensure_future(limiter.acquire_async())
+            second = asyncio.ensure_future(limiter.acquire_async())
+            await asyncio.sleep(0.05)
+            # The first waiter is woken and cancelled before it runs
+            limiter.release()
+            first.cancel()
+            await asyncio.wait_for(second, 5)
+            self.assertTrue(first.cancelled())
+            self.assertEqual(limiter.in_flight, 1)
+            self.assertEqual(len(limiter._async_waiters), 0)
+
+        asyncio.run(main())
+
+    def test_cancelled_waiter_is_removed(self):
+        async def main():
+            limiter = RateLimiter(max_concurrency=1, initial_concurrency=1)
+            await limiter.acquire_async()
+            waiter = asyncio.ensure_future(limiter.acquire_async())
+            await asyncio.sleep(0.05)
+            waiter.cancel()
+            await asyncio.sleep(0)
+            self.assertEqual(len(limiter._async_waiters), 0)
+            limiter.release()
+            self.assertEqual(limiter.in_flight, 0)
+
+        asyncio.run(main())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+"""Layers written chunk by chunk with spatial_export.LayerWriter"""
+
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+import spatial_export
+
+try:
+    import pyogrio
+except ImportError:
+    pyogrio = None
+
+
+def diagram(i):
+    x = i * 0.001
+    if i % 3:
+        geometry = {
+            "type": "Polygon",
+            "coordinates": [[[x, 0], [x + 0.001, 0], [x, 0.001], [x, 0]]],
+        }
+    else:
+        geometry = {"type": "LineString", "coordinates": [[x, 0], [x, 0.001]]}
+    properties = {"area": i} if i >= 500 else {}
+    return {
+        "id": i,
+        "description": "Diagram %s" % i,
+        "geojson": {
+            "type": "FeatureCollection",
+            "features": [
+                {"type": "Feature", "properties": properties, "geometry": geometry}
+            ],
+        },
+    }
+
+
+@unittest.skipIf(spatial_export.gpd is None, "geopandas is not installed")
+class LayerWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_many_chunks(self):
+        diagrams = [diagram(i) for i in range(1000)]
+        for spatial_format in spatial_export.SPATIAL_FORMATS:
+            with self.subTest(spatial_format=spatial_format):
+                path = self.directory / spatial_export.file_name(
+                    "diagrams", spatial_format
+                )
+                layer_writer = spatial_export.LayerWriter(
+                    path,
+                    spatial_format,
+                    columns=spatial_export.layer_columns(
+                        ["id", "description", "geojson"], ["area"]
+                    ),
+                )
+                for start in range(0, len(diagrams), 20):
+                    layer_writer.write(diagrams[start : start + 20])
+                layer_writer.close()
+
+                self.assertFalse(layer_writer.staging_path.exists())
+                info = pyogrio.read_info(path, layer="diagrams")
+                self.assertEqual(info["features"], len(diagrams))
+                self.assertEqual(layer_writer.features, len(diagrams))
+                self.assertIn("area", list(info["fields"]))
+                # Only layers with a spatial index have fast spatial filters
+                self.assertTrue(info["capabilities"]["fast_spatial_filter"])
+
+    def test_no_features(self):
+        path = self.directory / "diagrams.fgb"
+        layer_writer = spatial_export.LayerWriter(path, "flatgeobuf")
+        layer_writer.write([{"id": 1, "geojson": None}])
+        layer_writer.close()
+        self.assertFalse(layer_writer.written)
+        self.assertFalse(path.exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+"""Round trips of the members zip_compression adds to zip files.
+
+Run from the repository root with python -m unittest discover tests"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+import zipfile
+from pathlib import Path
+from unittest import mock
+
+import pandas as pd
+
+import archive_writers
+import zip_compression
+
+CONTENT = b"id,description\n" + b"".join(
+    b"%d,Diagram %d\n" % (i, i) for i in range(20000)
+)
+
+
+class AddCompressedTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.source = self.directory / "diagrams.csv"
+        self.source.write_bytes(CONTENT)
+
+    def write_zip(self, codec, add):
+        compression = zip_compression.MemberCompression(codec)
+        zip_path = self.directory / f"{codec}.zip"
+        with zipfile.ZipFile(zip_path, "w") as zip_file:
+            for name in ["diagrams.csv", "systems/diagrams.csv"]:
+                add(zip_file, name, compression)
+        return zip_path
+
+    def add_compressed(self, zip_file, name, compression):
+        compressed, data_path = zip_compression.compress_file(
+            self.source, self.directory / "member.compressed", compression
+        )
+        zip_compression.add_compressed(
+            zip_file, compressed.member_info(name), data_path
+        )
+
+    def add_file(self, zip_file, name, compression):
+        zip_compression.add_file(zip_file, name, self.source, compression)
+
+    def check_zip(self, zip_path):
+        with zipfile.ZipFile(zip_path) as zip_file:
+            infos = zip_file.infolist()
+            self.assertEqual(
+                [info.filename for info in infos],
+                ["diagrams.csv", "systems/diagrams.csv"],
+            )
+            for info in infos:
+                with zip_compression.open_member(zip_file, info) as member:
+                    self.assertEqual(member.read(), CONTENT)
+            if infos[0].compress_type != zip_compression.ZIP_ZSTANDARD:
+                self.assertIsNone(zip_file.testzip())
+        if shutil.which("unzip") and infos[0].compress_type in (
+            zipfile.ZIP_DEFLATED,
+            zipfile.ZIP_STORED,
+        ):
+            subprocess.run(
+                ["unzip", "-tq", str(zip_path)], check=True, stdout=subprocess.DEVNULL
+            )
+
+    @unittest.skipUnless(zip_compression.RAW_MEMBERS, "zipfile internals changed")
+    def test_add_compressed(self):
+        for codec in ["deflate", "store"]:
+            with self.subTest(codec=codec):
+                self.check_zip(self.write_zip(codec, self.add_compressed))
+
+    @unittest.skipUnless(zip_compression.RAW_MEMBERS, "zipfile internals changed")
+    @unittest.skipIf(zip_compression.zstandard is None, "zstandard is not installed")
+    def test_add_compressed_zstd(self):
+        self.check_zip(self.write_zip("zstd", self.add_compressed))
+
+    def test_add_file(self):
+        for codec in ["deflate", "store"]:
+            with self.subTest(codec=codec):
+                self.check_zip(self.write_zip(codec, self.add_file))
+
+    def test_untested_python(self):
+        with mock.patch.object(
+            zip_compression, "RAW_MEMBERS_PYTHON_VERSIONS", ((3, 0), (3, 1))
+        ):
+            self.assertFalse(zip_compression._raw_members_supported())
+
+    def test_corrupt_member(self):
+        zip_path = self.write_zip("store", self.add_file)
+        data = bytearray(zip_path.read_bytes())
+        data[200] ^= 0xFF
+        zip_path.write_bytes(bytes(data))
+        with zipfile.ZipFile(zip_path) as zip_file:
+            self.assertEqual(zip_file.testzip(), "diagrams.csv")
+
+
+class ArchiveWriterTest(unittest.TestCase):
+    """Both zip writers, with and without the zipfile internals"""
+
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.df = pd.DataFrame({"id": range(1000), "description": "Diagram"})
+
+    def write_archive(self, writer_class):
+        writer = writer_class(
+            "PROJECT", output_directory=self.directory, excel_workbook=False
+        )
+        writer.write_table("diagrams", self.df)
+        with writer.open_table("systems") as table:
+            table.write(self.df.head(10))
+            table.write(self.df.tail(10))
+        writer.write_bytes("metrics.json", b"{}")
+        writer.close()
+        return self.directory / "PROJECT.zip"
+
+    def check_archive(self, zip_path):
+        with zipfile.ZipFile(zip_path) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(
+                sorted(zip_file.namelist()),
+                ["diagrams.csv", "metrics.json", "systems.csv"],
+            )
+            with zip_file.open("diagrams.csv") as member:
+                self.assertEqual(len(pd.read_csv(member)), len(self.df))
+        if shutil.which("unzip"):
+            subprocess.run(
+                ["unzip", "-tq", str(zip_path)], check=True, stdout=subprocess.DEVNULL
+            )
+
+    def test_writers(self):
+        for raw_members in sorted({zip_compression.RAW_MEMBERS, False}):
+            for writer_class in [
+                archive_writers.DirectoryArchiveWriter,
+                archive_writers.ZipArchiveWriter,
+            ]:
+                with self.subTest(
+                    writer=writer_class.__name__, raw_members=raw_members
+                ), mock.patch.object(zip_compression, "RAW_MEMBERS", raw_members):
+                    self.check_archive(self.write_archive(writer_class))
+                    os.remove(self.directory / "PROJECT.zip")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,7 @@
 import requests
+import argparse
+import csv
+import hashlib
 import json
 import GeodesignHub
 import os
@@ -7,8 +10,22 @@ import pandas as pd
 
 import logging
 import logging.handlers
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from json.decoder import JSONDecodeError
 from pathlib import Path
+from request_policy import RetryPolicy
+
+# Columns of the results file, one line is appended for every uploaded row
+RESULT_COLUMNS = ["row_key", "row", "status", "status_code", "description", "response"]
+# Columns of the upload CSV that make up a diagram
+DIAGRAM_COLUMNS = [
+    "description",
+    "feature_type",
+    "funding_type",
+    "flat_geobuf_url",
+    "project_or_policy",
+    "system_id",
+]
 
 
 class ScriptLogger:
@@ -39,11 +56,129 @@ class ScriptLogger:
         return self.logger
 
 
+def row_key(row):
+    """Identify a row by its contents, so rows that were uploaded are
+    recognised even if the CSV is reordered"""
+    values = json.dumps([row[column] for column in DIAGRAM_COLUMNS])
+    return hashlib.sha1(values.encode("utf-8")).hexdigest()
+
+
+def read_uploaded_keys(results_path):
+    """Keys of the rows a previous run uploaded successfully"""
+    if not results_path.exists():
+        return set()
+    uploaded = set()
+    with open(results_path, newline="") as results_file:
+        for result in csv.DictReader(results_file):
+            if result["status"] == "success":
+                uploaded.add(result["row_key"])
+    return uploaded
+
+
+def upload_row(my_api_helper, row):
+    response = my_api_helper.post_as_diagram_with_external_geometries(
+        url=row["flat_geobuf_url"],
+        layer_type="pmtiles-layer",
+        projectorpolicy=row["project_or_policy"],
+        featuretype=row["feature_type"],
+        description=row["description"],
+        fundingtype=row["funding_type"],
+        sysid=row["system_id"],
+        cost=0,
+        cost_type="t",
+    )
+    return response.status_code, response.text
+
+
+def upload_diagrams(my_api_helper, csv_path, results_path, logger, workers, chunk_size):
+    """Post every row of the CSV that has not been uploaded yet, workers rows
+    at a time. The CSV is read chunk_size rows at a time and the outcome of
+    each row is appended to the results file as soon as it is known."""
+    uploaded = read_uploaded_keys(results_path)
+    if uploaded:
+        logger.info(
+            "Skipping %s rows that were uploaded by an earlier run" % len(uploaded)
+        )
+    counts = {"success": 0, "failed": 0, "skipped": 0}
+    write_header = not results_path.exists()
+    results_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(results_path, "a", newline="") as results_file, ThreadPoolExecutor(
+        max_workers=workers
+    ) as executor:
+        results = csv.DictWriter(results_file, fieldnames=RESULT_COLUMNS)
+        if write_header:
+            results.writeheader()
+        # Everything is read as text, so ids and descriptions are posted as
+        # they are written in the file
+        chunks = pd.read_csv(
+            csv_path, chunksize=chunk_size, dtype=str, keep_default_na=False
+        )
+        row_number = 0
+        for chunk in chunks:
+            futures = {}
+            for row in chunk[DIAGRAM_COLUMNS].to_dict("records"):
+                key = row_key(row)
+                if key in uploaded:
+                    counts["skipped"] += 1
+                else:
+                    future = executor.submit(upload_row, my_api_helper, row)
+                    futures[future] = (row_number, key, row)
+                row_number += 1
+            for future in as_completed(futures):
+                number, key, row = futures[future]
+                try:
+                    status_code, response_text = future.result()
+                except requests.RequestException as e:
+                    status_code, response_text = None, repr(e)
+                status = (
+                    "success"
+                    if status_code is not None and status_code < 300
+                    else "failed"
+                )
+                counts[status] += 1
+                if status == "failed":
+                    logger.error(
+                        "Error uploading row %s (%s): %s"
+                        % (number, row["description"], response_text)
+                    )
+                results.writerow(
+                    {
+                        "row_key": key,
+                        "row": number,
+                        "status": status,
+                        "status_code": status_code,
+                        "description": row["description"],
+                        "response": response_text,
+                    }
+                )
+            results_file.flush()
+            logger.info(
+                "%s rows processed, %s uploaded, %s failed, %s skipped"
+                % (row_number, counts["success"], counts["failed"], counts["skipped"])
+            )
+    return counts
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Upload externally linked diagrams listed in a CSV file"
+    )
+    parser.add_argument("--csv", default="upload_data/japan_diagrams_v3.csv")
+    parser.add_argument(
+        "--workers", type=int, default=4, help="number of concurrent uploads"
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=1000, help="rows read from the CSV at a time"
+    )
+    parser.add_argument(
+        "--results",
+        default="output",
+        help="directory of the upload_results_<project_id>.csv files",
+    )
+    args = parser.parse_args()
 
     myLogger = ScriptLogger()
     logger = myLogger.getLogger()
-    session = requests.Session()
     logger.info("Starting job..")
 
     try:
@@ -55,7 +190,7 @@ if __name__ == "__main__":
         sys.exit(1)
 
     try:
-        assert c.keys() == set(["service_url", "project_ids", "api_token"])
+        assert c.keys() >= set(["service_url", "project_ids", "api_token"])
     except AssertionError:
         logger.error("Error in config file parameters..")
         sys.exit(1)
@@ -63,28 +198,24 @@ if __name__ == "__main__":
     project_ids = c["project_ids"]
     for project_id in project_ids:
         my_api_helper = GeodesignHub.GeodesignHubClient(
-            url=c["service_url"], project_id=project_id, token=c["api_token"]
+            url=c["service_url"],
+            project_id=project_id,
+            token=c["api_token"],
+            pool_maxsize=args.workers,
+            timeout=60,
+            # Only rows refused with 429 are posted again, so nothing is
+            # uploaded twice
+            retry_policy=RetryPolicy(),
+        )
+        counts = upload_diagrams(
+            my_api_helper,
+            args.csv,
+            Path(args.results, "upload_results_%s.csv" % project_id),
+            logger,
+            args.workers,
+            args.chunk_size,
+        )
+        logger.info(
+            "Project %s: %s rows uploaded, %s failed, %s skipped"
+            % (project_id, counts["success"], counts["failed"], counts["skipped"])
         )
-        df = pd.read_csv("upload_data/japan_diagrams_v3.csv")
-
-        for index, row in df.iterrows():
-            description = row["description"]
-            feature_type = row["feature_type"]
-            funding_type = row["funding_type"]
-            flat_geobuf_url = row["flat_geobuf_url"]
-            project_or_policy = row["project_or_policy"]
-            system_id = row["system_id"]
-
-            # print(description, feature_type, funding_type, flat_geobuf_url, project_or_policy)
-            response = my_api_helper.post_as_diagram_with_external_geometries(
-                url=flat_geobuf_url,
-                layer_type="pmtiles-layer",
-                projectorpolicy=project_or_policy,
-                featuretype=feature_type,
-                description=description,
-                fundingtype=funding_type,
-                sysid=system_id,
-                cost=0,
-                cost_type="t",
-            )
-            print(response.json())
@@ -0,0 +1,204 @@
+"""Verify project archives without extracting them.
+
+Every zip in a directory is checked in place: its central directory must be
+readable and list the expected tables, every member is read back as a stream
+so zipfile checks its CRC-32, and the rows of each table are counted from the
+member stream. Nothing is written to disk, each member is read once, and the
+archives are verified in parallel worker processes.
+
+    python verify_archives.py output --workers 8 --report verification.json
+"""
+
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import sys
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import table_formats
+import zip_compression
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is only needed for Parquet archives
+    pq = None
+
+# Tables every archive has, whatever the project contains
+EXPECTED_TABLES = [
+    "project",
+    "systems",
+    "diagrams",
+    "design_teams",
+    "design_syntheses",
+]
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def find_archives(directory):
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.endswith(".zip")
+    )
+
+
+def _drain(stream):
+    """Read stream to the end, zipfile raises BadZipFile on a CRC mismatch"""
+    while stream.read(READ_CHUNK_SIZE):
+        pass
+
+
+def _count_csv_rows(member):
+    text = io.TextIOWrapper(member, encoding="utf-8", newline="")
+    # GeoJSON values are far larger than the default field limit
+    csv.field_size_limit(sys.maxsize)
+    # Quoted values may span several lines, so count records rather than lines
+    rows = sum(1 for _ in csv.reader(text))
+    return max(0, rows - 1)
+
+
+def _count_parquet_rows(member):
+    # The row count is in the footer, parquet members are stored so seeking
+    # to it is cheap. The member is then read through for its CRC.
+    rows = pq.ParquetFile(member).metadata.num_rows
+    member.seek(0)
+    _drain(member)
+    return rows
+
+
+def table_name(member_name):
+    name, _, extension = member_name.rpartition(".")
+    if extension in table_formats.OUTPUT_FORMATS and "/" not in name:
+        return name, extension
+    return None, None
+
+
+def verify_member(zip_file, info):
+    """Read one member, returns its row count or None if it is not a table"""
+    table, extension = table_name(info.filename)
+    with zip_compression.open_member(zip_file, info) as member:
+        if table is None:
+            _drain(member)
+            return None
+        if extension == "csv":
+            return _count_csv_rows(member)
+        if pq is None:
+            _drain(member)
+            return None
+        return _count_parquet_rows(member)
+
+
+def verify_archive(path, expected_tables=EXPECTED_TABLES):
+    """Check one archive, returns a report with its members and any errors"""
+    report = {"archive": path, "ok": False, "errors": [], "members": {}}
+    try:
+        zip_file = zipfile.ZipFile(path)
+    except (OSError, zipfile.BadZipFile) as e:
+        report["errors"].append("unreadable central directory: %s" % e)
+        return report
+    with zip_file:
+        infos = zip_file.infolist()
+        names = [info.filename for info in infos]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            report["errors"].append("duplicate members: %s" % ", ".join(duplicates))
+        tables = {table_name(name)[0] for name in names}
+        missing = [table for table in expected_tables if table not in tables]
+        if missing:
+            report["errors"].append("missing tables: %s" % ", ".join(missing))
+        for info in infos:
+            if info.is_dir():
+                continue
+            member_report = {"bytes": info.file_size, "crc": "%08x" % info.CRC}
+            try:
+                member_report["rows"] = verify_member(zip_file, info)
+            except (
+                zipfile.BadZipFile,
+                zlib.error,
+                EOFError,
+                OSError,
+                # zstandard is missing, or zipfile can't read the method
+                ImportError,
+                NotImplementedError,
+            ) as e:
+                report["errors"].append("%s: %s" % (info.filename, e))
+            except (UnicodeDecodeError, csv.Error, ValueError) as e:
+                report["errors"].append(
+                    "%s is not a readable table: %s" % (info.filename, e)
+                )
+            report["members"][info.filename] = member_report
+    project_rows = [
+        member.get("rows")
+        for name, member in report["members"].items()
+        if table_name(name)[0] == "project"
+    ]
+    if project_rows and project_rows[0] not in (1, None):
+        report["errors"].append("project table has %s rows" % project_rows[0])
+    report["ok"] = not report["errors"]
+    return report
+
+
+def verify_archives(paths, workers=None, expected_tables=EXPECTED_TABLES):
+    """Verify the archives in parallel, returns their reports in order"""
+    if workers == 1 or len(paths) <= 1:
+        return [verify_archive(path, expected_tables) for path in paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(
+            executor.map(
+                verify_archive, paths, [expected_tables] * len(paths), chunksize=1
+            )
+        )
+
+
+def log_reports(reports, logger):
+    for report in reports:
+        if report["ok"]:
+            rows = {
+                name: member["rows"]
+                for name, member in report["members"].items()
+                if member.get("rows") is not None
+            }
+            logger.info(
+                "%s is intact, %s members, rows: %s"
+                % (report["archive"], len(report["members"]), rows)
+            )
+        else:
+            for error in report["errors"]:
+                logger.error("%s: %s" % (report["archive"], error))
+    failed = sum(not report["ok"] for report in reports)
+    logger.info("Verified %s archives, %s failed" % (len(reports), failed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", nargs="?", default="output")
+    parser.add_argument(
+        "--workers", type=int, default=None, help="worker processes, one per CPU"
+    )
+    parser.add_argument(
+        "--expected-tables",
+        default=",".join(EXPECTED_TABLES),
+        help="comma separated tables every archive must contain",
+    )
+    parser.add_argument("--report", help="write the reports to this JSON file")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s"
+    )
+    logger = logging.getLogger("verify_archives")
+    reports = verify_archives(
+        find_archives(args.directory),
+        workers=args.workers,
+        expected_tables=[table for table in args.expected_tables.split(",") if table],
+    )
+    log_reports(reports, logger)
+    if args.report:
+        with open(args.report, "w") as report_file:
+            json.dump(reports, report_file, indent=2)
+    sys.exit(0 if all(report["ok"] for report in reports) else 1)
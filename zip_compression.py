@@ -0,0 +1,271 @@
+"""Compression of the members of project archives.
+
+Members are compressed on their own into staging files, outside the lock that
+serializes writes to the zip, and the compressed bytes are then copied into
+the container. Stages writing tables at the same time therefore compress them
+at the same time, and close() of the directory writer compresses all staged
+files in a thread pool: zlib and zstandard release the GIL, so the members are
+compressed on as many cores as there are workers.
+
+The codec trades archive size against time: "deflate" at level 1 is fast,
+at level 9 small, "zstd" compresses better and faster than deflate but needs
+an unzip tool that supports it (7-Zip, Python 3.14), "store" does not
+compress at all. Parquet files and workbooks are compressed already and are
+always stored.
+
+Copying compressed bytes into a zip relies on internals of zipfile.ZipFile.
+RAW_MEMBERS is only true on the CPython versions add_compressed() is tested
+with, RAW_MEMBERS_PYTHON_VERSIONS, and when the internals are there. On other
+Pythons the writers stage the members uncompressed and add them with the
+public ZipFile.write(), see add_file()."""
+
+import copy
+import io
+import os
+import platform
+import shutil
+import sys
+import time
+import zipfile
+import zlib
+from contextlib import nullcontext
+
+try:
+    import zstandard
+except ImportError:  # zstandard is only needed for zstd compression
+    zstandard = None
+
+# Compression method id of Zstandard in the zip format
+ZIP_ZSTANDARD = 93
+# Codecs and the compression levels they accept
+ARCHIVE_COMPRESSIONS = {
+    "deflate": range(0, 10),
+    "zstd": range(1, 23),
+    "store": None,
+}
+DEFAULT_LEVELS = {"deflate": 6, "zstd": 3}
+PRECOMPRESSED_SUFFIXES = {".parquet", ".xlsx", ".zip", ".gz", ".zst"}
+COPY_CHUNK_SIZE = 1024 * 1024
+# The CPython versions whose zipfile add_compressed() is tested with, the
+# first included and the last excluded
+RAW_MEMBERS_PYTHON_VERSIONS = ((3, 8), (3, 15))
+# The ZipFile attributes add_compressed() uses
+ZIPFILE_INTERNALS = [
+    "_writing",
+    "_lock",
+    "_didModify",
+    "fp",
+    "start_dir",
+    "filelist",
+    "NameToInfo",
+]
+
+
+def _raw_members_supported():
+    """Whether add_compressed() works with the zipfile of this Python"""
+    first, last = RAW_MEMBERS_PYTHON_VERSIONS
+    if platform.python_implementation() != "CPython":
+        return False
+    if not first <= sys.version_info[:2] < last:
+        return False
+    if not hasattr(zipfile.ZipInfo, "FileHeader"):
+        return False
+    with zipfile.ZipFile(io.BytesIO(), "w") as zip_file:
+        return all(hasattr(zip_file, name) for name in ZIPFILE_INTERNALS)
+
+
+RAW_MEMBERS = _raw_members_supported()
+
+
+def check_compression(codec, level=None):
+    if codec not in ARCHIVE_COMPRESSIONS:
+        raise ValueError(f"Unknown archive compression {codec}")
+    if codec == "zstd" and zstandard is None:
+        raise ImportError(
+            "zstd archive compression requires zstandard, pip install zstandard"
+        )
+    if codec == "zstd" and not RAW_MEMBERS and not hasattr(zipfile, "ZIP_ZSTANDARD"):
+        raise ValueError("zstd archive compression is not supported by this Python")
+    levels = ARCHIVE_COMPRESSIONS[codec]
+    if level is not None and levels is not None and level not in levels:
+        raise ValueError(
+            f"{codec} compression levels are {levels.start} to {levels.stop - 1}"
+        )
+
+
+class MemberCompression:
+    """A codec and level, with the compressor that applies them"""
+
+    def __init__(self, codec="deflate", level=None):
+        check_compression(codec, level)
+        self.codec = codec
+        self.level = level if level is not None else DEFAULT_LEVELS.get(codec)
+
+    def for_member(self, name):
+        """The compression of a member, members that are compressed already
+        are stored"""
+        if os.path.splitext(name)[1].lower() in PRECOMPRESSED_SUFFIXES:
+            return MemberCompression("store")
+        return self
+
+    @property
+    def zip_method(self):
+        return {
+            "deflate": zipfile.ZIP_DEFLATED,
+            "zstd": ZIP_ZSTANDARD,
+            "store": zipfile.ZIP_STORED,
+        }[self.codec]
+
+    def compressor(self):
+        if self.codec == "deflate":
+            # A raw deflate stream, as the zip format stores it
+            return zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        if self.codec == "zstd":
+            return zstandard.ZstdCompressor(level=self.level).compressobj()
+        return None
+
+
+class CompressedFile(io.BufferedIOBase):
+    """A writable file that compresses what is written to it into target and
+    keeps the CRC-32 and sizes a zip member header needs. With target None
+    the data is only measured."""
+
+    def __init__(self, target, compression):
+        self.target = target
+        self.compression = compression
+        self._compressor = compression.compressor()
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.file_size
+
+    def _write_compressed(self, data):
+        if self.target is not None:
+            self.target.write(data)
+        self.compress_size += len(data)
+
+    def write(self, data):
+        data = bytes(data)
+        self.crc = zlib.crc32(data, self.crc)
+        self.file_size += len(data)
+        self._write_compressed(
+            self._compressor.compress(data) if self._compressor else data
+        )
+        return len(data)
+
+    def close(self):
+        if not self.closed and self._compressor is not None:
+            self._write_compressed(self._compressor.flush())
+        super().close()
+
+    def member_info(self, name, date_time=None):
+        """The ZipInfo of the compressed data, call after close()"""
+        info = zipfile.ZipInfo(name, date_time or time.localtime()[:6])
+        info.compress_type = self.compression.zip_method
+        info.CRC = self.crc
+        info.file_size = self.file_size
+        info.compress_size = self.compress_size
+        info.external_attr = 0o644 << 16
+        if info.compress_type == ZIP_ZSTANDARD:
+            # Version 6.3 of the zip format added Zstandard
+            info.extract_version = 63
+        return info
+
+
+def compress_file(source, destination, compression):
+    """Compress the file source into destination, returns the CompressedFile
+    describing it and the path of the member data. Stored members are not
+    copied, their data is source itself."""
+    if compression.codec == "store":
+        destination = None
+    with open(source, "rb") as source_file:
+        with open(destination, "wb") if destination else nullcontext() as target:
+            with CompressedFile(target, compression) as compressed:
+                shutil.copyfileobj(source_file, compressed, COPY_CHUNK_SIZE)
+    return compressed, destination or source
+
+
+def add_compressed(zip_file, info, compressed_path):
+    """Copy already compressed data into zip_file as the member info. The
+    header is written the way ZipFile.open(..., "w") writes it, callers must
+    serialize writes to zip_file. Only when RAW_MEMBERS is true."""
+    if not RAW_MEMBERS:
+        raise RuntimeError("zipfile internals have changed, use add_file()")
+    if zip_file._writing:
+        raise ValueError("Can't add a member while another one is being written")
+    zip64 = info.file_size > zipfile.ZIP64_LIMIT or (
+        info.compress_size > zipfile.ZIP64_LIMIT
+    )
+    with zip_file._lock:
+        zip_file.fp.seek(zip_file.start_dir)
+        info.header_offset = zip_file.fp.tell()
+        zip_file._didModify = True
+        zip_file.fp.write(info.FileHeader(zip64))
+        with open(compressed_path, "rb") as compressed_file:
+            shutil.copyfileobj(compressed_file, zip_file.fp, COPY_CHUNK_SIZE)
+        zip_file.start_dir = zip_file.fp.tell()
+        zip_file.filelist.append(info)
+        zip_file.NameToInfo[info.filename] = info
+
+
+def add_file(zip_file, name, path, compression):
+    """Compress the file path into zip_file as the member name with
+    ZipFile.write(), callers must serialize writes to zip_file"""
+    zip_file.write(
+        path,
+        name,
+        compress_type=compression.zip_method,
+        compresslevel=compression.level,
+    )
+
+
+class _CheckedReader(io.RawIOBase):
+    """Decompressed stream of a zstd member that checks its CRC-32 at the end,
+    for Python versions whose zipfile cannot read zstd members"""
+
+    def __init__(self, raw_member, info):
+        self.raw_member = raw_member
+        self.reader = zstandard.ZstdDecompressor().stream_reader(raw_member)
+        self.info = info
+        self.crc = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        try:
+            data = self.reader.read(len(buffer))
+        except zstandard.ZstdError as e:
+            raise zipfile.BadZipFile(
+                "Corrupt zstd data in %r: %s" % (self.info.filename, e)
+            )
+        if not data and self.crc != self.info.CRC:
+            raise zipfile.BadZipFile("Bad CRC-32 for file %r" % self.info.filename)
+        self.crc = zlib.crc32(data, self.crc)
+        buffer[: len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.raw_member.close()
+        super().close()
+
+
+def open_member(zip_file, info):
+    """zip_file.open(info), that can also read zstd members"""
+    if info.compress_type != ZIP_ZSTANDARD or hasattr(zipfile, "ZIP_ZSTANDARD"):
+        return zip_file.open(info)
+    if zstandard is None:
+        raise ImportError(
+            "Reading zstd members requires zstandard, pip install zstandard"
+        )
+    raw_info = copy.copy(info)
+    raw_info.compress_type = zipfile.ZIP_STORED
+    raw_info.file_size = info.compress_size
+    # The CRC-32 is of the decompressed data, it is checked by _CheckedReader
+    raw_info.CRC = None
+    return io.BufferedReader(_CheckedReader(zip_file.open(raw_info), info))